@@ -22,9 +22,188 @@
 __author__ = 'jonathanho@google.com (Jonathan Ho)'
 
 import base64
+import errno
+import httplib
+import os
+import Queue
+import socket
+import tempfile
 import threading
+import time
 import urllib2
 import xml.dom.minidom
+import xml.sax.saxutils
+import zlib
+
+# A feed sent with Connector.sendRecord is pushed once it holds this many
+# records, or this many bytes, or once its first record is this many seconds
+# old
+FEED_MAX_RECORDS = 1000
+FEED_MAX_BYTES = 10 * 1024 * 1024
+FEED_MAX_SECONDS = 30
+
+# Number of feeds waiting to be pushed, before sendRecord waits for the GSA
+FEED_QUEUE_SIZE = 4
+
+# Retries of a failed feed push, waiting PUSH_BACKOFF seconds before the first
+# one, twice longer before each next one
+PUSH_RETRIES = 3
+PUSH_BACKOFF = 1.0
+
+# The feed service of a GSA
+FEED_PORT = 19900
+FEED_PATH = '/xmlfeed'
+
+# Seconds to wait for the GSA while pushing a feed
+PUSH_TIMEOUT = 300
+
+# Idle connections kept open to each GSA
+POOL_MAX_IDLE = 4
+
+# Small strings of a request body are joined up to this size before being
+# sent, not to wait for the acknowledgement of each small TCP segment
+SEND_BUFFER_SIZE = 64 * 1024
+
+MULTIPART_BOUNDARY = '----------boundary_of_feed_data$'
+
+# Bytes of a content file read and encoded at a time, a multiple of 3 for
+# base64
+CONTENT_CHUNK_SIZE = 3 * 64 * 1024
+
+
+class ConnectionPool(object):
+  """Persistent HTTP connections to the feed service of the GSAs.
+
+  A connection is taken for a push and given back once the response is read,
+  unless the GSA closes it, so that frequent small feeds do not pay for a new
+  connection each time.
+  """
+
+  def __init__(self, max_idle=POOL_MAX_IDLE, timeout=PUSH_TIMEOUT):
+    """Creates an empty pool.
+
+    Args:
+      max_idle: The number of idle connections kept open per GSA.
+      timeout: Seconds to wait for the GSA, as a float or int.
+    """
+    self._max_idle = max_idle
+    self._timeout = timeout
+    self._idle = {}
+    self._lock = threading.Lock()
+
+  def _get(self, host, port):
+    """Returns a connection and whether it was already open."""
+    self._lock.acquire()
+    try:
+      idle = self._idle.get((host, port))
+      if idle:
+        return idle.pop(), True
+    finally:
+      self._lock.release()
+    return httplib.HTTPConnection(host, port, timeout=self._timeout), False
+
+  def _put(self, host, port, connection):
+    self._lock.acquire()
+    try:
+      idle = self._idle.setdefault((host, port), [])
+      if len(idle) < self._max_idle:
+        idle.append(connection)
+        return
+    finally:
+      self._lock.release()
+    connection.close()
+
+  def post(self, host, port, path, headers, chunks):
+    """Posts a request over a pooled connection.
+
+    Args:
+      host: The GSA host.
+      port: The port of the service.
+      path: The path of the service.
+      headers: A dictionary of request headers, with the Content-length.
+      chunks: A list of the strings of the body, sent one after the other,
+        or of iterables of strings such as FileContent.
+
+    Returns:
+      The response body as a string.
+
+    Raises:
+      urllib2.HTTPError: The response status is not 200, like urllib2.urlopen.
+      httplib.HTTPException, socket.error: The request failed.
+    """
+    while True:
+      connection, reused = self._get(host, port)
+      # Whether the GSA closed a connection kept open, before reading the
+      # request: only then is the request sent again, on a new connection.
+      # A timeout is never retried, the GSA may have received the feed.
+      stale = False
+      try:
+        try:
+          connection.putrequest('POST', path)
+          for key, value in headers.iteritems():
+            connection.putheader(key, value)
+          buffers = _JoinChunks(chunks, SEND_BUFFER_SIZE)
+          # the headers and the start of the body go in the same packet
+          connection.endheaders(next(buffers, ''))
+          for data in buffers:
+            connection.send(data)
+          response = connection.getresponse()
+        except httplib.BadStatusLine:
+          stale = reused
+          raise
+        except socket.timeout:
+          raise
+        except socket.error, e:
+          stale = reused and e.errno in (errno.ECONNRESET, errno.EPIPE)
+          raise
+        body = response.read()
+      except:
+        connection.close()
+        if stale:
+          continue
+        raise
+      if response.will_close:
+        connection.close()
+      else:
+        self._put(host, port, connection)
+      if response.status != 200:
+        raise urllib2.HTTPError('http://%s:%d%s' % (host, port, path),
+                                response.status, response.reason,
+                                response.msg, None)
+      return body
+
+
+def _JoinChunks(chunks, size):
+  """Yields the strings joined into strings of at least size bytes.
+
+  Strings larger than size are yielded as they are, not copied. The chunks
+  which are not strings are iterated for their strings.
+  """
+  pending = []
+  pending_size = 0
+  for piece in chunks:
+    if isinstance(piece, basestring):
+      piece = [piece]
+    for chunk in piece:
+      if len(chunk) >= size:
+        if pending:
+          yield ''.join(pending)
+          pending = []
+          pending_size = 0
+        yield chunk
+        continue
+      pending.append(chunk)
+      pending_size += len(chunk)
+      if pending_size >= size:
+        yield ''.join(pending)
+        pending = []
+        pending_size = 0
+  if pending:
+    yield ''.join(pending)
+
+
+# The connections shared by all the connectors
+_pool = ConnectionPool()
 
 
 class Connector(object):
@@ -38,8 +217,14 @@ class Connector(object):
 
   The ExampleConnector and TimedConnector serve as examples of direct
   implementations of this interface.
+
+  The content of the records sent with sendRecord is encoded as
+  FEED_CONTENT_ENCODING, which a connector can set to 'base64compressed' for
+  the GSA to receive zlib compressed content.
   """
 
+  FEED_CONTENT_ENCODING = 'base64binary'
+
   def __init__(self, manager, name, config, schedule, data):
     """Creates a connector, and then calls init().
 
@@ -57,6 +242,8 @@ class Connector(object):
     self._config = config
     self._schedule = schedule
     self._data = data
+    self._senders = {}
+    self._senders_lock = threading.Lock()
     self.init()
 
   def init(self):
@@ -367,62 +554,83 @@ class Connector(object):
     Returns:
       The GSA response status as a string.
     """
+    return self._pushRecords([data], feed_type)
 
+  def _pushRecords(self, records, feed_type):
+    """Pushes a feed to the GSA, over a pooled connection.
+
+    The records are sent one after the other, they are not joined into one
+    request body, and the content files are read as they are sent.
+
+    Args:
+      records: A list of XML record strings and FileContent objects.
+      feed_type: The feed type string.
+
+    Returns:
+      The GSA response status as a string.
+    """
     self.logger().debug('Posting Aggregated Feed to : %s' % self._name)
-    xmldata = ('<?xml version="1.0" encoding="UTF-8" ?>'
-               '<!DOCTYPE gsafeed PUBLIC "-//Google//DTD GSA Feeds//EN" "gsafeed.dtd">'
-               '<gsafeed>'
-               '<header>'
-               '<datasource>%s</datasource>'
-               '<feedtype>%s</feedtype>'
-               '</header>'
-               '<group>%s</group>'
-               '</gsafeed>') % (str(self._name), str(feed_type), data)
-            
-    content_type, body = self.encode_multipart_formdata(feed_type,xmldata)
+    xmlheader = ('<?xml version="1.0" encoding="UTF-8" ?>'
+                 '<!DOCTYPE gsafeed PUBLIC "-//Google//DTD GSA Feeds//EN" "gsafeed.dtd">'
+                 '<gsafeed>'
+                 '<header>'
+                 '<datasource>%s</datasource>'
+                 '<feedtype>%s</feedtype>'
+                 '</header>'
+                 '<group>') % (xml.sax.saxutils.escape(str(self._name)),
+                               xml.sax.saxutils.escape(str(feed_type)))
+    xmlfooter = '</group></gsafeed>'
+    content_type, chunks = self._multipartChunks(
+        feed_type, [xmlheader] + records + [xmlfooter])
     headers = {}
     headers['Content-type'] = content_type
-    headers['Content-length'] = str(len(body))
-    u = 'http://%s:19900/xmlfeed' % self._manager.gsa
-    request_url = urllib2.Request(u, body, headers)
+    headers['Content-length'] = str(sum([len(chunk) for chunk in chunks]))
     if self._manager.debug_flag:
       self.logger().debug('POSTING Feed to GSA %s ' % self._manager.gsa)
-      self.logger().debug(request_url.get_method())
-      self.logger().debug(request_url.get_full_url())
-      self.logger().debug(request_url.headers)
-      self.logger().debug(request_url.get_data())
-    status = urllib2.urlopen(request_url).read()
+      self.logger().debug('http://%s:%d%s' % (self._manager.gsa, FEED_PORT,
+                                              FEED_PATH))
+      self.logger().debug(headers)
+    status = _pool.post(self._manager.gsa, FEED_PORT, FEED_PATH, headers,
+                        chunks)
     self.logger().debug("Response status from GSA [%s]" % status)
     return status
-  
 
+  def _multipartChunks(self, feed_type, xmlchunks):
+    """Returns the content type and the chunks of a multipart feed post.
+
+    Args:
+      feed_type: The feed type string.
+      xmlchunks: The XML feed, as a list of strings and FileContent objects.
+
+    Returns:
+      A 2-tuple: the content type, the list of the chunks of the body,
+      unicode strings being UTF-8 encoded.
+    """
+    fields = ('--%s\r\n'
+              'Content-Disposition: form-data; name="datasource"\r\n'
+              '\r\n'
+              '%s\r\n'
+              '--%s\r\n'
+              'Content-Disposition: form-data; name="feedtype"\r\n'
+              '\r\n'
+              '%s\r\n'
+              '--%s\r\n'
+              'Content-Disposition: form-data; name="data"\r\n'
+              'Content-Type: application/xml\r\n'
+              '\r\n') % (MULTIPART_BOUNDARY, str(self._name),
+                         MULTIPART_BOUNDARY, feed_type, MULTIPART_BOUNDARY)
+    chunks = [fields]
+    for chunk in xmlchunks:
+      if isinstance(chunk, unicode):
+        chunk = chunk.encode('UTF-8')
+      chunks.append(chunk)
+    chunks.append('\r\n--%s--\r\n' % MULTIPART_BOUNDARY)
+    return 'multipart/form-data; boundary=%s' % MULTIPART_BOUNDARY, chunks
 
   def encode_multipart_formdata(self,feed_type,xmldata):
-    BOUNDARY = '----------boundary_of_feed_data$'
-    CRLF = '\r\n'
-    L = []
-    L.append('--' + BOUNDARY)
-    L.append('Content-Disposition: form-data; name="datasource"')
-    L.append('')
-    L.append(str(self._name))
-
-    L.append('--' + BOUNDARY)
-    L.append('Content-Disposition: form-data; name="feedtype"')
-    L.append('')
-    L.append(feed_type)
-
-    L.append('--' + BOUNDARY)
-    L.append('Content-Disposition: form-data; name="data"')
-    L.append('Content-Type: application/xml')
-    L.append('')
-
-    L.append(xmldata)
-    L.append('')
-    L.append('--' + BOUNDARY + '--')
-    L.append('')
-    #return ('multipart/form-data; boundary=%s' % BOUNDARY, unicode(CRLF.join(L),'UTF-8').encode('UTF-8'))
-    return ('multipart/form-data; boundary=%s' % BOUNDARY, CRLF.join(L))
-  
+    content_type, chunks = self._multipartChunks(feed_type, [xmldata])
+    return content_type, ''.join(chunks)
+
   def pushFeed(self, feed):
     """Pushes a feed (as a Feed object) to the GSA.
 
@@ -432,7 +640,7 @@ class Connector(object):
     Returns:
       The GSA response string.
     """
-    return self.pushRaw(feed.toXML(), feed.getType())
+    return self._pushRecords(feed.getRecords(), feed.getType())
 
   def pushFeedSingleRecord(self, feed_type, **attrs):
     """Pushes a feed with a single record to the GSA.
@@ -445,9 +653,46 @@ class Connector(object):
       The GSA response string.
     """
     feed = Feed(feed_type)
-    feed.addRecord(attrs)
+    feed.addRecord(**attrs)
     return self.pushFeed(feed)
 
+  def sendRecord(self, feed_type, **attrs):
+    """Adds a record to the feeds pushed to the GSA in the background.
+
+    The records are pushed by a FeedSender, one per feed type, so that the
+    traversal goes on while the feeds are pushed. This waits only when
+    FEED_QUEUE_SIZE feeds are already waiting to be pushed.
+
+    Args:
+      feed_type: The feed type. See the constructor for Feed.
+      **attrs: Other args. See Feed.addRecord.
+    """
+    self._senders_lock.acquire()
+    try:
+      sender = self._senders.get(feed_type)
+      if not sender:
+        sender = self._senders[feed_type] = FeedSender(
+            self, feed_type, content_encoding=self.FEED_CONTENT_ENCODING)
+    finally:
+      self._senders_lock.release()
+    sender.addRecord(**attrs)
+
+  def flushFeeds(self):
+    """Pushes the records added by sendRecord, and waits for the pushes.
+
+    Returns:
+      The number of feeds which could not be pushed since the last flush.
+    """
+    self._senders_lock.acquire()
+    try:
+      senders = self._senders.values()
+    finally:
+      self._senders_lock.release()
+    failed = 0
+    for sender in senders:
+      failed += sender.flush()
+    return failed
+
   def logger(self):
     """Returns this connector's logger.
 
@@ -521,6 +766,266 @@ class TimedConnector(Connector):
     self._interval = interval
 
 
+class FeedSender(object):
+  """Pushes the records of a connector to the GSA from a background thread.
+
+  The records are added to a Feed, serialized as they are added. Once the feed
+  holds max_records records or max_bytes bytes, it is queued for the sender
+  thread and a new feed is started: the traversal and the push overlap. The
+  feed is also pushed once its first record is max_seconds old, so that the
+  records of a slow traversal are not held back.
+
+  The queue is bounded: when the GSA is slower than the traversal, addRecord
+  waits, and memory use stays within (queue_size + 2) feeds.
+
+  Example:
+    sender = FeedSender(self, 'metadata-and-url', max_records=100)
+    for url in urls:
+      sender.addRecord(url=url, action='add', mimetype='text/html')
+    sender.close()
+  """
+
+  def __init__(self, connector, feed_type, max_records=FEED_MAX_RECORDS,
+               max_bytes=FEED_MAX_BYTES, max_seconds=FEED_MAX_SECONDS,
+               queue_size=FEED_QUEUE_SIZE, retries=PUSH_RETRIES,
+               content_encoding='base64binary'):
+    """Starts the sender thread.
+
+    Args:
+      connector: The Connector pushing the feeds.
+      feed_type: The feed type. See the constructor for Feed.
+      max_records: Number of records of a feed.
+      max_bytes: Size of the records of a feed, a record larger than this is
+        pushed alone.
+      max_seconds: Age of the first record of a feed.
+      queue_size: Number of feeds waiting to be pushed.
+      retries: Number of retries of a failed push, waiting PUSH_BACKOFF
+        seconds before the first one, twice longer before each next one.
+      content_encoding: The encoding of the content. See the constructor for
+        Feed.
+    """
+    self._connector = connector
+    self._type = feed_type
+    self._max_records = max_records
+    self._max_bytes = max_bytes
+    self._max_seconds = max_seconds
+    self._retries = retries
+    self._content_encoding = content_encoding
+    self._lock = threading.Lock()
+    self._feed = Feed(feed_type, content_encoding)
+    self._started = None
+    self._queue = Queue.Queue(queue_size)
+    self._failed = 0
+    self._thread = threading.Thread(target=self._run)
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def _takeFeed(self):
+    """Returns the current feed, or None if empty, and starts a new one.
+
+    Must be called with the lock held.
+    """
+    if not self._feed.getRecordCount():
+      return None
+    feed = self._feed
+    self._feed = Feed(self._type, self._content_encoding)
+    self._started = None
+    return feed
+
+  def addRecord(self, **kwargs):
+    """Adds a record to the feed, see Feed.addRecord.
+
+    The feed is queued if full; this waits while the queue is full.
+    """
+    self._lock.acquire()
+    try:
+      self._feed.addRecord(**kwargs)
+      if self._started is None:
+        self._started = time.time()
+      feed = None
+      if (self._feed.getRecordCount() >= self._max_records or
+          self._feed.getSize() >= self._max_bytes):
+        feed = self._takeFeed()
+    finally:
+      self._lock.release()
+    if feed:
+      self._queue.put(feed)
+
+  def flush(self):
+    """Queues the current feed and waits until all the feeds are pushed.
+
+    Returns:
+      The number of feeds which could not be pushed since the last flush.
+    """
+    self._lock.acquire()
+    try:
+      feed = self._takeFeed()
+    finally:
+      self._lock.release()
+    if feed:
+      self._queue.put(feed)
+    self._queue.join()
+    self._lock.acquire()
+    try:
+      failed, self._failed = self._failed, 0
+    finally:
+      self._lock.release()
+    return failed
+
+  def close(self):
+    """Pushes the remaining records and stops the sender thread.
+
+    Returns:
+      The number of feeds which could not be pushed since the last flush.
+    """
+    failed = self.flush()
+    self._queue.put(None)
+    self._thread.join()
+    return failed
+
+  def _run(self):
+    while True:
+      self._lock.acquire()
+      try:
+        timeout = self._max_seconds
+        if self._started is not None:
+          timeout = max(0, self._started + self._max_seconds - time.time())
+      finally:
+        self._lock.release()
+      try:
+        feed = self._queue.get(True, timeout)
+      except Queue.Empty:
+        # No full feed for a while: queue the records added so far, so that
+        # flush() waits for their push too. The sender thread cannot wait on
+        # its own queue: if the queue is full, the feed is left in place and
+        # queued once a queued feed is pushed.
+        self._lock.acquire()
+        try:
+          if (self._started is not None and
+              time.time() - self._started >= self._max_seconds):
+            try:
+              self._queue.put_nowait(self._feed)
+            except Queue.Full:
+              pass
+            else:
+              self._feed = Feed(self._type, self._content_encoding)
+              self._started = None
+        finally:
+          self._lock.release()
+        continue
+      try:
+        if feed is None:
+          return
+        self._push(feed)
+      finally:
+        self._queue.task_done()
+
+  def _push(self, feed):
+    """Pushes a feed, retrying with an exponential backoff."""
+    logger = self._connector.logger()
+    pushed = False
+    try:
+      for attempt in range(self._retries + 1):
+        if attempt:
+          time.sleep(PUSH_BACKOFF * 2 ** (attempt - 1))
+        try:
+          response = self._connector.pushFeed(feed)
+        except (IOError, httplib.HTTPException), e:
+          # IOError covers urllib2.URLError, socket.error, and content files
+          response = '%s: %s' % (e.__class__.__name__, e)
+        if response == 'Success':
+          logger.debug('Pushed a feed of %d records, %d bytes' % (
+              feed.getRecordCount(), feed.getSize()))
+          pushed = True
+          break
+        logger.warning('Feed push failed (%s), attempt %d of %d' % (
+            response, attempt + 1, self._retries + 1))
+      else:
+        logger.error('Dropped a feed of %d records after %d attempts' % (
+            feed.getRecordCount(), self._retries + 1))
+    except Exception:
+      # an error a retry would not fix, the sender thread must go on
+      logger.exception('Dropped a feed of %d records' %
+                       feed.getRecordCount())
+    feed.clear()
+    if not pushed:
+      self._lock.acquire()
+      try:
+        self._failed += 1
+      finally:
+        self._lock.release()
+
+
+def _QuoteAttr(value):
+  """Returns a value quoted and escaped as an XML attribute value."""
+  if not isinstance(value, basestring):
+    value = str(value)
+  return xml.sax.saxutils.quoteattr(value)
+
+
+class FileContent(object):
+  """The content of a record read from a file, base64 encoded as it is sent.
+
+  The encoded content is produced CONTENT_CHUNK_SIZE bytes at a time by
+  iterating the object, and can be produced again for a retry; its length is
+  known beforehand. The file is read from its current position, and closed
+  by close().
+
+  The files which cannot be sized, and the compressed content, are first
+  copied to a temporary file, compressed a chunk at a time.
+  """
+
+  def __init__(self, fileobj, encoding='base64binary'):
+    """Prepares the content.
+
+    Args:
+      fileobj: An open file, or a file-like object with a read method.
+      encoding: 'base64binary' or 'base64compressed'.
+    """
+    self.encoding = encoding
+    try:
+      self._offset = fileobj.tell()
+      self._size = os.fstat(fileobj.fileno()).st_size - self._offset
+    except (AttributeError, IOError, OSError):
+      self._size = None
+    if self._size is None or encoding == 'base64compressed':
+      spool = tempfile.TemporaryFile()
+      compressor = None
+      if encoding == 'base64compressed':
+        compressor = zlib.compressobj()
+      while True:
+        chunk = fileobj.read(CONTENT_CHUNK_SIZE)
+        if not chunk:
+          break
+        if compressor:
+          chunk = compressor.compress(chunk)
+        spool.write(chunk)
+      if compressor:
+        spool.write(compressor.flush())
+      fileobj.close()
+      fileobj = spool
+      self._offset = 0
+      self._size = spool.tell()
+    self._file = fileobj
+
+  def __len__(self):
+    return (self._size + 2) / 3 * 4
+
+  def __iter__(self):
+    self._file.seek(self._offset)
+    remaining = self._size
+    while remaining:
+      chunk = self._file.read(min(CONTENT_CHUNK_SIZE, remaining))
+      if not chunk:
+        raise IOError('The content file is shorter than when it was added')
+      remaining -= len(chunk)
+      yield base64.b64encode(chunk)
+
+  def close(self):
+    """Closes the file."""
+    self._file.close()
+
+
 class Feed(object):
   """A set of records to be placed in an XML feed.
 
@@ -530,15 +1035,23 @@ class Feed(object):
   produced, not a complete <gsafeed>...</gsafeed> element.
   """
 
-  def __init__(self, feedtype):
+  def __init__(self, feedtype, content_encoding='base64binary'):
     """Creates the feed.
 
     Args:
       feedtype: The feed type. Must be a string, either 'incremental', 'full',
       or 'metadata-and-url'.
+      content_encoding: The encoding of the content of the records, either
+      'base64binary', or 'base64compressed' for zlib compressed content: the
+      feed is smaller, the GSA uncompresses it.
     """
+    if content_encoding not in ('base64binary', 'base64compressed'):
+      raise ValueError('Unknown content encoding: %s' % content_encoding)
     self._type = feedtype
+    self._content_encoding = content_encoding
     self._records = []
+    self._count = 0
+    self._size = 0
 
   def _generateRecordElement(self, attrs, metadata, content):
     """Generates a <record> element for a record.
@@ -553,34 +1066,47 @@ class Feed(object):
         Note that the 'url' and 'mimetype' attributes are required by the GSA.
       metadata: Metadata tags to add to the feed (can be None if not needed).
         Should be a dictionary that maps strings to strings.
-      content: Adds a content tag for content feeds. Should be a string, or None
-       if this is not to be a content feed.
+      content: Adds a content tag for content feeds. Should be a string, an
+        open file, or None if this is not to be a content feed.
 
     Returns:
-      The constructed record XML element (string).
+      The constructed record XML element, as a list: one string, or for
+      content read from a file larger than CONTENT_CHUNK_SIZE, the start of
+      the element, a FileContent, and the end of the element.
     """
     # generate the record attrib list string
-    attrlist = []
-    for key, value in attrs.iteritems():
-      attrlist.append('%s="%s"' % (key, value))
-    attrstr = ' '.join(attrlist)
+    attrstr = ' '.join(['%s=%s' % (key, _QuoteAttr(value))
+                        for key, value in attrs.iteritems()])
     # generate metadata tags
     metastr = ''
     if metadata:
-      metalist = []
-      for key, value in metadata.iteritems():
-        metalist.append('<meta name="%s" content="%s"/>' % (key, value))
-      metastr = '<metadata>%s</metadata>' % ''.join(metalist)
+      metastr = '<metadata>%s</metadata>' % ''.join(
+          ['<meta name=%s content=%s/>' % (_QuoteAttr(key), _QuoteAttr(value))
+           for key, value in metadata.iteritems()])
+    start = '<record %s>%s' % (attrstr, metastr)
     # generate content tag
+    if hasattr(content, 'read'):
+      content = FileContent(content, self._content_encoding)
+      if len(content) > CONTENT_CHUNK_SIZE:
+        return [start + '<content encoding="%s">' % self._content_encoding,
+                content, '</content></record>']
+      # a small file is encoded right away, not to keep many files open
+      encoded = ''.join(content)
+      content.close()
+      return [start + '<content encoding="%s">%s</content></record>' % (
+          self._content_encoding, encoded)]
     contentstr = ''
     if content:
-      contentstr = ('<content encoding="base64binary">'
-                    '%s'
-                    '</content>') % base64.encodestring(content)
-    return '<record %s>%s%s</record>' % (attrstr, metastr, contentstr)
+      if isinstance(content, unicode):
+        content = content.encode('UTF-8')
+      if self._content_encoding == 'base64compressed':
+        content = zlib.compress(content)
+      contentstr = '<content encoding="%s">%s</content>' % (
+          self._content_encoding, base64.b64encode(content))
+    return [start + contentstr + '</record>']
 
   def addRecord(self, **kwargs):
-    """Adds a record to the feed.
+    """Adds a record to the feed, serialized right away.
 
     Args:
       url, displayurl, mimetype, etc.: Attributes for the record tag, to be
@@ -591,7 +1117,9 @@ class Feed(object):
       metadata: Optional. Metadata tags to add to the feed, as a dictionary
         that maps strings to strings.
       content: Optional; required if the feed is a content feed. Adds a content
-        tag to the record. Should be a string.
+        tag to the record. Should be a string, or an open file: the file is
+        read and encoded a chunk at a time when the feed is pushed, so that
+        large documents are not held in memory, and it is closed by clear().
 
     Example:
       addRecord(url='http://example.com/index.html', action='add',
@@ -612,19 +1140,28 @@ class Feed(object):
       del kwargs['content']
     metadata = None
     if 'metadata' in kwargs:
-      metadata = kwargs['metdata']
-      del kwargs['metdata']
-    self._records.append((kwargs, metadata, content))
+      metadata = kwargs['metadata']
+      del kwargs['metadata']
+    record = self._generateRecordElement(kwargs, metadata, content)
+    self._records.extend(record)
+    self._count += 1
+    self._size += sum([len(piece) for piece in record])
 
   def toXML(self):
     """Returns the XML version of all the records added.
     Like this: <record>...</record><record>...</record>...
+    The content files are read and encoded in memory.
 
     Returns:
       A string of XML.
     """
-    return ''.join(self._generateRecordElement(rec[0], rec[1], rec[2])
-                   for rec in self._records)
+    xml = []
+    for piece in self._records:
+      if isinstance(piece, FileContent):
+        xml.extend(piece)
+      else:
+        xml.append(piece)
+    return ''.join(xml)
 
   def getType(self):
     """Returns the connector type.
@@ -634,6 +1171,35 @@ class Feed(object):
     """
     return self._type
 
+  def getRecords(self):
+    """Returns the XML of the records added, with their content files.
+
+    Returns:
+      A list of strings and FileContent objects.
+    """
+    return self._records
+
+  def getRecordCount(self):
+    """Returns the number of records added.
+
+    Returns:
+      The number of records (int).
+    """
+    return self._count
+
+  def getSize(self):
+    """Returns the size of the XML of the records added.
+
+    Returns:
+      The size of the records (int).
+    """
+    return self._size
+
   def clear(self):
-    """Clears the list of records."""
+    """Clears the list of records, closing their content files."""
+    for piece in self._records:
+      if isinstance(piece, FileContent):
+        piece.close()
     self._records = []
+    self._count = 0
+    self._size = 0
@@ -96,6 +96,11 @@ usage:
     from this class and override the run() method. See the TimedConnector
     documentation for more details.
 
+    Instead of building Feed objects and pushing them with pushFeed, a
+    connector can hand each record to sendRecord: the records are pushed by a
+    background thread, in feeds of a bounded size, while the traversal goes
+    on. flushFeeds waits until they are all pushed. See FeedSender.
+
     Three example connector implementations are provided:
       ExampleConnector: Does absolutely nothing. This serves as boilerplate
         code, useful for writing new connectors.
@@ -65,32 +65,23 @@ class SitemapConnector(connector.TimedConnector):
 #          lastmodtime_time = time.strptime(strt, "%Y-%m-%d")
 #          lastmodtime_date = datetime.datetime(*lastmodtime_time[:6])
     #for each url in the sitemap, send them in batches to the GSA
-    #the batch size is specified by the 'load' parameter from the config page
-    i = 0
+    #the batch size is specified by the 'load' parameter from the config page;
+    #the batches are pushed in the background while the next ones are built
     feed_type = 'metadata-and-url'
     #feed_type = 'incremental'
-    feed = connector.Feed(feed_type)
+    sender = connector.FeedSender(self, feed_type,
+                                  max_records=max(1, self.getLoad()))
     for url in sitemap_urls:
       if feed_type == 'metadata-and-url':
-        feed.addRecord(url=url, displayurl=url, action='add',
-                       mimetype='text/html')
+        sender.addRecord(url=url, displayurl=url, action='add',
+                         mimetype='text/html')
       else:
         content = urllib2.urlopen(url).read()
-        feed.addRecord(url=url, displayurl=url, action='add',
-                       mimetype='text/html', content=content)
-      #if the number of urls were going to send to the GSA right now is more
-      #than what its expecting, send what we have now and reset the counter
-      #afer waiting 1 min (this is the poormans traversal rate limit delay)
-      if i >= float(self.getLoad()):
-        self.logger().debug('Posting %s URLs to the GSA for connector [%s]' % (
-            i, self.getName()))
-        self.pushFeed(feed)
-        feed.clear()
-        i = 0
-      else:
-        i = i+1
-    if i>0:
-      self.logger().debug(('Final posting %s URLs to the GSA '
-                           'for connector [%s]') % (i, self.getName()))
-      self.pushFeed(feed)
-      feed.clear()
\ No newline at end of file
+        sender.addRecord(url=url, displayurl=url, action='add',
+                         mimetype='text/html', content=content)
+    self.logger().debug('Posting %s URLs to the GSA for connector [%s]' % (
+        len(sitemap_urls), self.getName()))
+    failed = sender.close()
+    if failed:
+      self.logger().error('%s feeds could not be pushed for connector [%s]' % (
+          failed, self.getName()))
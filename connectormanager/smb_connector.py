@@ -39,8 +39,9 @@ class SMBConnector(connector.TimedConnector):
     - Get a list of documents in the SMB share using smbcrawler
     - For each document:
       - Download it with smbclient to a temporary file
-      - Read the file's contents to memory
-      - Send the file's contents to the GSA as a content feed.
+      - Send the file's contents to the GSA as a content feed, pushed in the
+        background while the next files are downloaded. The file is read a
+        chunk at a time as the feed is sent, then deleted.
 
   The mimetypes of a file in the SMB share is inferred from its name.
   """
@@ -65,21 +66,18 @@ class SMBConnector(connector.TimedConnector):
 
     # now download each file individually with smbclient into a temporary file,
     # then send the file content as a content feed to the GSA
-    feed = connector.Feed('incremental')
     devnull = open(os.devnull, 'w')
     for url, doc in output.urls_map.iteritems():
       if not doc.IsFile():
         continue
       filename = doc.filename[1:] # strip out initial slash
       mimetype = mimetypes.guess_type(url)[0] or 'application/octet-stream'
-      # download the file to a temporary place, and read out its contents
+      # download the file to a temporary place, the feed reads and closes it
       tmp = tempfile.NamedTemporaryFile()
       subprocess.call(['smbclient', self.share, '-N', '-c',
                        'get %s %s' % (filename, tmp.name)],
                       stdout=devnull, stderr=devnull)
-      tmp.seek(0)
-      filedata = tmp.read()
-      tmp.close()
-      feed.addRecord(url=url, action='add', mimetype=mimetype, content=filedata)
+      self.sendRecord('incremental', url=url, action='add', mimetype=mimetype,
+                      content=tmp)
     devnull.close()
-    self.pushFeed(feed)
+    self.flushFeeds()
@@ -0,0 +1,390 @@
+#!/usr/bin/env python2
+#
+# Copyright 2014 Google, Inc.
+# All Rights Reserved.
+
+"""feed_benchmark.py measures how fast feeds are pushed, without a GSA.
+
+1. runs a stand-in for the feed service of a GSA
+2. measures the feed pushes of gsa_feed.py and of the connectors
+
+
+=== 1/2 Run a stand-in feed service
+  ~$ feed_benchmark.py --serve
+  ~$ feed_benchmark.py --serve --latency 0.5 --error-rate 0.1
+
+  It listens on port 19900 like a GSA, and accepts the multipart feed posts
+  on /xmlfeed. Each feed is parsed and its records are counted, then the
+  service responds "Success", after --latency seconds. A --error-rate
+  fraction of the feeds gets an HTTP 503 error instead, and a feed which
+  does not parse gets an "Error - ..." response.
+
+
+=== 2/2 Measure the feed pushes
+  ~$ feed_benchmark.py --records 1000,10000,100000 --content-bytes 2048
+
+  A feed of each number of records is written in a temporary directory,
+  then pushed by each client to a stand-in feed service started for the
+  run, or to the one already running on --host:
+
+  client        records        MB  seconds  records/s     MB/s  peak RSS MB
+  send-feed        1000       2.3     0.05    20408.2     47.1         11.2
+  push-raw         1000       2.3     0.06    16129.0     37.2         15.8
+
+  Each push runs in its own process, for its peak memory to be measured;
+  the peak RSS includes the Python interpreter. The clients are:
+    send-feed  gsa_feed.SendFeed, the feed file is streamed
+    push-raw   connector.Connector.pushRaw, the records are a string
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+import cgi
+import logging
+import multiprocessing
+import optparse
+import os
+import random
+import shutil
+import socket
+import SocketServer
+import StringIO
+import sys
+import tempfile
+import time
+import urlparse
+
+import gsa_feed
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'connectormanager'))
+import connector
+
+# The feed service port of a GSA, also hard coded in Connector.pushRaw
+FEED_PORT = 19900
+
+# Seconds to wait for the stand-in feed service to start
+SERVE_TIMEOUT = 10
+
+
+p = optparse.OptionParser(usage=__doc__.strip())
+
+p.add_option(
+    '--serve',
+    help='Run the stand-in feed service, until interrupted.',
+    action='store_true',
+    default=False)
+p.add_option(
+    '--latency',
+    help='Seconds the stand-in feed service waits before each response.',
+    type='float',
+    default=0)
+p.add_option(
+    '--error-rate',
+    help=('Fraction of the feeds, between 0 and 1, getting an HTTP 503 error '
+          'from the stand-in feed service.'),
+    type='float',
+    default=0)
+p.add_option(
+    '--host',
+    help=('Host of a stand-in feed service already running. By default, one '
+          'is started for the run.'),
+    default=None)
+p.add_option(
+    '--records',
+    help='Comma separated numbers of records of the feeds pushed.',
+    default='1000,10000,100000')
+p.add_option(
+    '--content-bytes',
+    help='Size of the content of each record, 0 for a metadata-and-url feed.',
+    type='int',
+    default=1024)
+p.add_option(
+    '--encoding',
+    help='Encoding of the content: base64binary, base64compressed or none.',
+    default='base64binary')
+p.add_option(
+    '--clients',
+    help='Comma separated clients to measure: send-feed, push-raw.',
+    default='send-feed,push-raw')
+
+
+class FeedServiceHandler(BaseHTTPRequestHandler):
+  """Handles the feed posts of the stand-in feed service."""
+
+  # Keeps the connections open between the feeds, as a GSA does
+  protocol_version = 'HTTP/1.1'
+  # Sends the status line and headers together, flushed after each response
+  wbufsize = -1
+
+  def do_POST(self):
+    if urlparse.urlparse(self.path).path != '/xmlfeed':
+      self.send_error(404)
+      return
+    start = time.time()
+    form = cgi.FieldStorage(
+        fp=self.rfile, headers=self.headers,
+        environ={'REQUEST_METHOD': 'POST',
+                 'CONTENT_TYPE': self.headers['Content-Type']})
+    try:
+      if 'data' not in form:
+        raise ValueError('no data')
+      data = form['data']
+      if data.file:
+        data.file.seek(0)
+        records = CountRecords(data.file)
+      else:
+        records = CountRecords(StringIO.StringIO(data.value))
+      response = 'Success'
+    except (SyntaxError, ValueError), e:
+      records = 0
+      response = 'Error - %s' % e
+      # the rest of the request may not have been read
+      self.close_connection = 1
+    time.sleep(self.server.latency)
+    if random.random() < self.server.error_rate:
+      self.send_error(503)
+      response = 'Injected error'
+    else:
+      self.send_response(200)
+      self.send_header('Content-type', 'text/plain')
+      self.send_header('Content-length', str(len(response)))
+      self.end_headers()
+      self.wfile.write(response)
+    self.log_message('%s feed of %s: %d records, %s bytes, %.2fs: %s',
+                     form.getfirst('feedtype'), form.getfirst('datasource'),
+                     records, self.headers.get('Content-length'),
+                     time.time() - start, response)
+
+
+class FeedServer(SocketServer.ThreadingMixIn, HTTPServer):
+  """The stand-in feed service, one thread per connection."""
+
+  daemon_threads = True
+
+  def __init__(self, port=FEED_PORT, latency=0, error_rate=0):
+    HTTPServer.__init__(self, ('', port), FeedServiceHandler)
+    self.latency = latency
+    self.error_rate = error_rate
+
+
+def CountRecords(xmlfile):
+  """Returns the number of records of a feed, parsed as a stream."""
+  records = 0
+  parents = []
+  for event, elem in gsa_feed.iterparse(xmlfile, events=('start', 'end')):
+    if event == 'start':
+      parents.append(elem)
+      continue
+    parents.pop()
+    if elem.tag == 'record':
+      records += 1
+      elem.clear()
+      parents[-1].remove(elem)
+  return records
+
+
+def Serve(latency=0, error_rate=0):
+  """Runs the stand-in feed service until interrupted."""
+  server = FeedServer(FEED_PORT, latency, error_rate)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+def WaitForServer(host, timeout=SERVE_TIMEOUT):
+  """Waits until the feed service accepts connections."""
+  deadline = time.time() + timeout
+  while True:
+    try:
+      socket.create_connection((host, FEED_PORT), 1).close()
+      return
+    except socket.error:
+      if time.time() > deadline:
+        raise
+      time.sleep(0.1)
+
+
+class BenchmarkFeed(object):
+  """A feed file written for the benchmark."""
+
+  def __init__(self, filename, records, content_bytes, encoding):
+    """Writes the feed file.
+
+    Args:
+      filename: where to write the feed.
+      records: number of records.
+      content_bytes: size of the content of each record, or 0 for a
+        metadata-and-url feed.
+      encoding: the encoding of the content, see gsa_feed.EncodeContent.
+    """
+    self.filename = filename
+    self.datasource = 'benchmark'
+    if content_bytes:
+      self.feedtype = 'incremental'
+    else:
+      self.feedtype = 'metadata-and-url'
+    words = [''.join([random.choice('abcdefghijklmnopqrstuvwxyz')
+                      for _ in range(random.randint(2, 10))])
+             for _ in range(1000)]
+    text = []
+    size = 0
+    while size < content_bytes:
+      text.append(random.choice(words))
+      size += len(text[-1]) + 1
+    text = ' '.join(text)[:content_bytes]
+    writer = gsa_feed.FeedWriter(filename, self.datasource, self.feedtype)
+    for number in xrange(records):
+      content = None
+      if content_bytes:
+        content = text
+      writer.AddRecord('http://benchmark.example.com/doc/%d' % number,
+                       'text/plain', content=content,
+                       encoding=encoding, metadata={'number': number},
+                       last_modified='Tue, 6 Nov 2007 12:45:26 GMT')
+    writer.Close()
+    self.records = records
+    self.bytes = writer.bytes
+    # Where the records start and end, for the clients sending records only
+    self.records_start = len(writer.header)
+    self.records_end = writer.bytes - len(gsa_feed.FEED_FOOTER)
+
+  def ReadRecords(self):
+    """Returns the records of the feed, as a string."""
+    xmlfile = open(self.filename, 'rb')
+    try:
+      xmlfile.seek(self.records_start)
+      return xmlfile.read(self.records_end - self.records_start)
+    finally:
+      xmlfile.close()
+
+
+class BenchmarkManager(object):
+  """The parts of a ConnectorManager used by Connector.pushRaw."""
+
+  debug_flag = False
+
+  def __init__(self, gsa):
+    self.gsa = gsa
+
+  def logger(self, unused_src=None):
+    return logging.getLogger('feed_benchmark')
+
+
+def PushWithSendFeed(feed, host):
+  """Pushes the feed file with gsa_feed.SendFeed."""
+  return gsa_feed.SendFeed(feed.filename,
+                           'http://%s:%d/xmlfeed' % (host, FEED_PORT),
+                           feed.feedtype, feed.datasource)
+
+
+def PushWithPushRaw(feed, host):
+  """Pushes the records of the feed with connector.Connector.pushRaw."""
+  pusher = connector.Connector(BenchmarkManager(host), feed.datasource,
+                               None, None, None)
+  return pusher.pushRaw(feed.ReadRecords(), feed.feedtype)
+
+
+CLIENTS = {
+    'send-feed': PushWithSendFeed,
+    'push-raw': PushWithPushRaw}
+
+
+def RunClient(client, feed, host):
+  """Pushes a feed with a client, in a child process.
+
+  Args:
+    client: one of the CLIENTS names.
+    feed: a BenchmarkFeed.
+    host: host of the feed service.
+
+  Returns:
+    A 3-tuple: the response of the feed service, the seconds taken by the
+    push, the peak RSS of the child process in bytes.
+  """
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if not pid:
+    os.close(read_fd)
+    sys.stdout = open(os.devnull, 'w')
+    try:
+      start = time.time()
+      try:
+        response = CLIENTS[client](feed, host)
+      except Exception, e:
+        response = '%s: %s' % (e.__class__.__name__, e)
+      os.write(write_fd, '%f %s' % (time.time() - start, response))
+    finally:
+      os._exit(0)
+  os.close(write_fd)
+  output = []
+  while True:
+    data = os.read(read_fd, 4096)
+    if not data:
+      break
+    output.append(data)
+  os.close(read_fd)
+  unused_pid, unused_status, usage = os.wait4(pid, 0)
+  seconds, response = ''.join(output).split(' ', 1)
+  # ru_maxrss is in kilobytes on Linux, in bytes on Mac OS X
+  peak_rss = usage.ru_maxrss
+  if sys.platform != 'darwin':
+    peak_rss *= 1024
+  return response, float(seconds), peak_rss
+
+
+def main(options):
+  if options.serve:
+    print 'Feed service on http://localhost:%d/xmlfeed' % FEED_PORT
+    Serve(options.latency, options.error_rate)
+    return
+
+  clients = options.clients.split(',')
+  for client in clients:
+    if client not in CLIENTS:
+      print 'Unknown client %s, the clients are: %s' % (
+          client, ', '.join(sorted(CLIENTS)))
+      sys.exit(1)
+  encoding = options.encoding
+  if encoding == 'none':
+    encoding = None
+
+  server = None
+  host = options.host
+  if not host:
+    host = 'localhost'
+    server = multiprocessing.Process(
+        target=Serve, args=(options.latency, options.error_rate))
+    server.daemon = True
+    server.start()
+  WaitForServer(host)
+
+  directory = tempfile.mkdtemp(prefix='feed_benchmark')
+  try:
+    print '%-10s %9s %9s %8s %10s %8s %12s' % (
+        'client', 'records', 'MB', 'seconds', 'records/s', 'MB/s',
+        'peak RSS MB')
+    for records in [int(records) for records in options.records.split(',')]:
+      feed = BenchmarkFeed(os.path.join(directory, 'feed-%d.xml' % records),
+                           records, options.content_bytes, encoding)
+      megabytes = feed.bytes / 1048576.0
+      for client in clients:
+        response, seconds, peak_rss = RunClient(client, feed, host)
+        seconds = max(seconds, 0.001)
+        print '%-10s %9d %9.1f %8.2f %10.1f %8.1f %12.1f' % (
+            client, records, megabytes, seconds, records / seconds,
+            megabytes / seconds, peak_rss / 1048576.0),
+        if response != 'Success':
+          print '  %s' % response,
+        print
+      os.remove(feed.filename)
+  finally:
+    shutil.rmtree(directory)
+    if server:
+      server.terminate()
+
+
+if __name__ == '__main__':
+  o, unused_a = p.parse_args()
+  main(o)
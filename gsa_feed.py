@@ -24,6 +24,15 @@
   Make sure, in the case of a web feed, that the content server owner
   granted you permission to crawl its content server.
 
+  A large incremental or metadata-and-url feed can be cut into smaller
+  feeds, pushed over several connections:
+  ~$ gsa_feed.py --split-records 10000 --split-bytes 100000000 \\
+  >   --connections 4 feed.xml entzo34.hot
+
+
+  The feed file can be inspected without being pushed:
+  ~$ gsa_feed.py --inspect feed.xml
+
 
 === 2/3 Show examples feeds
   ~$ gsa_feed.py --example full
@@ -42,27 +51,66 @@
   ~$ gsa_feed.py --dtd gsafeed.dtd feed.xml
 
   The DTD filename must end with '.dtd'. It is always available at
-  http://<gsa hostname>/gsafeed.dtd.
+  http://<gsa hostname>/gsafeed.dtd, DTDs fetched from a GSA are kept a day
+  in ~/.gsa_feed.
+
+  The feed is validated as it is read, and the first errors are reported
+  with their line numbers:
+  ~$ gsa_feed.py --dtd --max-errors 20 gsafeed.dtd feed.xml
 
 Backward compatible with pushfeed_client.py: the same options are supported.
 """
 
+import base64
+import httplib
 import optparse
+import os
+import Queue
+import re
+import stat
+import StringIO
 import sys
+import tempfile
+import threading
+import time
 import urllib2
 import urlparse
-from xml.etree.ElementTree import iterparse
+import zlib
+from xml.parsers import expat
+from xml.sax import saxutils
 
 try:
-  from lxml import etree
+  from xml.etree.cElementTree import iterparse
+  from xml.etree.cElementTree import tostring
 except ImportError:
-  etree = None
-  print ('DTD validation is not available as the lxml library is missing.\n'
-         'To enable this feature, you can install the library, on Linux:\n'
-         '~$ sudo aptitude install python-lxml')
+  from xml.etree.ElementTree import iterparse
+  from xml.etree.ElementTree import tostring
 
 VERSION = (1, 0)
 
+BOUNDARY = '----------boundary_of_feed_data$'
+
+# Header and footer of the feeds written by SplitFeed and FeedWriter
+FEED_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE gsafeed PUBLIC "-//Google//DTD GSA Feeds//EN" "">
+<gsafeed>
+  <header>
+    <datasource>%s</datasource>
+    <feedtype>%s</feedtype>
+  </header>
+"""
+FEED_FOOTER = '</group>\n</gsafeed>\n'
+
+# Seconds to wait before the first retry of a feed push, doubled each retry
+RETRY_BACKOFF = 1.0
+
+# Bytes of content read at a time by FeedWriter, a multiple of 3 for base64
+CONTENT_CHUNK_SIZE = 3 * 64 * 1024
+
+# Where the DTDs fetched from GSAs are kept, and for how long
+DTD_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.gsa_feed')
+DTD_CACHE_SECONDS = 24 * 3600
+
 
 EXAMPLES = {
     'full': """<?xml version="1.0" encoding="UTF8"?>
@@ -97,7 +145,7 @@ EXAMPLES = {
   </group>
 </gsafeed>""",
     'metadata-and-url-base64': """<?xml version="1.0" encoding="utf-8"?>
-<!DOCTYPE gsafeed PUBLIC "-//Google//DTD GSA Feeds//EN" ">"
+<!DOCTYPE gsafeed PUBLIC "-//Google//DTD GSA Feeds//EN" "">
 <gsafeed>
   <header>
     <datasource>example3</datasource>
@@ -106,7 +154,7 @@ EXAMPLES = {
   <group>
     <record url="http://example.com/myfeed.html" action="add" mimetype="text/html">
       <metadata>
-        <meta encoding="base64binary" name="cHJvamVjdF9uYW1l" content="Y2lyY2xlZ19yb2Nrcw==">
+        <meta encoding="base64binary" name="cHJvamVjdF9uYW1l" content="Y2lyY2xlZ19yb2Nrcw=="/>
       </metadata>
     </record>
   </group>
@@ -185,6 +233,17 @@ p.add_option(
           'address http://<gsa hostname>/gsafeed.dtd.'),
     action='store_true',
     default=False)
+p.add_option(
+    '--max-errors',
+    help='Number of errors reported by the DTD validation.',
+    type='int',
+    default=10)
+p.add_option(
+    '--inspect',
+    help=('Print the feed type, datasource, number of records, sizes and '
+          'minimal set of follow URLs of the feed, without pushing it.'),
+    action='store_true',
+    default=False)
 p.add_option(
     '--example',
     help='can be: %s' % ', '.join(EXAMPLES.keys()),
@@ -206,6 +265,29 @@ p.add_option(
           'Deprecated option: the GSA host is the positional arg that does not '
           'end in ".xml"'),
     default=None)
+p.add_option(
+    '--split-records',
+    help=('Cut the feed into feeds of at most this number of records, '
+          'pushed one after the other. Not available for full feeds.'),
+    type='int',
+    default=None)
+p.add_option(
+    '--split-bytes',
+    help=('Cut the feed into feeds of at most this number of bytes, '
+          'pushed one after the other. Not available for full feeds.'),
+    type='int',
+    default=None)
+p.add_option(
+    '--connections',
+    help='Number of cut feeds pushed at the same time.',
+    type='int',
+    default=4)
+p.add_option(
+    '--retries',
+    help=('Number of retries of a cut feed push that failed, with an '
+          'exponential backoff.'),
+    type='int',
+    default=3)
 p.add_option(
     '--xmlfilename',
     help=('The feed xml file you want to feed. '
@@ -221,106 +303,829 @@ def ShowExamples(example):
   print EXAMPLES[example]
 
 
-def SendFeed(xmlfilename=None, url=None, feedtype=None, datasource=None):
-  """Sends an HTTP post from the command line flags.
+class MultipartBody(object):
+  """A multipart/form-data request body, read as a stream.
+
+  The values of the fields are strings or open files.  Files are read as
+  the body is sent, so that a 1GB feed is not held in memory; the length
+  of the body is known beforehand for the Content-length header.
+  """
+
+  def __init__(self, fields, boundary=BOUNDARY):
+    """Prepares the body.
+
+    Args:
+      fields: list of 2-tuples, a name and a string or an open file.
+        Example: [('feedtype', 'incremental'),
+                  ('datasource', 'mydatasource')
+                  ('data', open('feed.xml', 'rb'))]
+      boundary: the string separating the parts.
+    """
+    self.content_type = 'multipart/form-data; boundary=%s' % boundary
+    self.parts = []
+    self.length = 0
+    for key, value in fields:
+      self._Append('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n'
+                   % (boundary, key))
+      if hasattr(value, 'read'):
+        self.parts.append(value)
+        self.length += os.fstat(value.fileno()).st_size - value.tell()
+      else:
+        self._Append(value)
+      self._Append('\r\n')
+    self._Append('--%s--\r\n' % boundary)
+
+  def _Append(self, data):
+    self.parts.append(StringIO.StringIO(data))
+    self.length += len(data)
+
+  def read(self, size=-1):
+    """Returns up to size bytes of the body, all of it if size is negative."""
+    chunks = []
+    while self.parts and size:
+      data = self.parts[0].read(size)
+      if not data:
+        self.parts.pop(0)
+        continue
+      chunks.append(data)
+      if size > 0:
+        size -= len(data)
+    return ''.join(chunks)
+
+
+def PostFeed(url, feedtype, datasource, data):
+  """Posts a feed to the feed service of a GSA.
 
   Args:
-    xmlfilename: the filename of a XML GSA feed
     url: the URL of the feed service on the GSA
     feedtype: incremental, full, etc (more details in the reference)
     datasource: a string label of the user choice
+    data: the XML feed, a string or an open file
 
   Returns:
-    None. All side effect.
+    The response of the feed service, 'Success' if the feed was accepted.
   """
+  body = MultipartBody([('feedtype', feedtype),
+                        ('datasource', datasource),
+                        ('data', data)])
+  headers = {'Content-type': body.content_type,
+             'Content-length': str(body.length)}
+  return urllib2.urlopen(urllib2.Request(url, body, headers)).read()
 
-  def EncodeMultipart(fields):
-    """Returns input  data in multipart/form-data encoding.
 
-    Args:
-      fields: list of 2-strings tuples.
-        Example: [('feedtype', 'incremental'),
-                  ('datasource', 'mydatasource')
-                  ('data', '<xml feed string ...')]
-
-    Returns:
-       a 2-tuple of strings:
-        - the content_type (with the part 'boundary=')
-        - a multipart/form-data encoding string
-    """
-    boundary = '----------boundary_of_feed_data$'
+def SendFeed(xmlfilename=None, url=None, feedtype=None, datasource=None):
+  """Sends an HTTP post from the command line flags.
 
-    lines = []
-    for key, value in fields:
-      lines.extend(('--' + boundary,
-                    'Content-Disposition: form-data; name="%s"' % key,
-                    '',
-                    value))
-    lines.extend(('--' + boundary + '--', ''))
+  The feed file is streamed to the GSA, not loaded in memory.
 
-    return 'multipart/form-data; boundary=%s' % boundary, '\r\n'.join(lines)
+  Args:
+    xmlfilename: the filename of a XML GSA feed
+    url: the URL of the feed service on the GSA
+    feedtype: incremental, full, etc (more details in the reference)
+    datasource: a string label of the user choice
 
-  parts = [('feedtype', feedtype),
-           ('datasource', datasource),
-           ('data', open(xmlfilename, 'r').read())]
+  Returns:
+    None. All side effect.
+  """
 
-  content_type, body = EncodeMultipart(parts)
-  headers = {'Content-type': content_type,
-             'Content-length': str(len(body))}
+  def Post(url):
+    """Posts the feed file to the URL, returns the response."""
+    xmlfile = open(xmlfilename, 'rb')
+    try:
+      return PostFeed(url, feedtype, datasource, xmlfile)
+    finally:
+      xmlfile.close()
 
   try:
     print 'Sending the feed to:', url
-    return urllib2.urlopen(urllib2.Request(
-        url, body, headers)).read()
+    return Post(url)
   except urllib2.URLError:
 
     url = url.replace(
         'http', 'https').replace('19900', '19902')
     print 'Trying sending the feed to:', url
-    return urllib2.urlopen(urllib2.Request(
-        url, body, headers)).read()
+    return Post(url)
 
 
-def Validate(dtd_filename_or_url, xmlfilename):
-  """Validate the input file against a GSA feed DTD.
+def SplitFeed(filename, max_records=None, max_bytes=None, feedtype=None,
+              datasource=None):
+  """Cuts a feed into smaller feeds, reading it as a stream.
+
+  The records are copied to the smaller feeds in the same order, inside
+  groups with the same attributes.  A record larger than max_bytes is
+  sent alone in its feed.
 
   Args:
-    dtd_filename_or_url: string either a .dtd file in the current directory,
-      or the hostname of a GSA on which to fetch the DTD.
+    filename: string filename of a XML GSA feed document.
+    max_records: maximum number of records per feed, or None.
+    max_bytes: maximum size of a feed, or None.
+    feedtype: overrides the feed type of the feed file, if set.
+    datasource: overrides the datasource of the feed file, if set.
 
-  Returns:
-    True if validation passed, otherwise an exception is raised.
+  Yields:
+    (feedtype, datasource, xml, records) tuples, one per smaller feed.
 
   Raises:
-    ImportError: A DTD validation exception or an error when the hostname
-      set is not reachable on the port 80, on the URL
-      http://<ip address>/gsafeed.dtd.
+    ValueError: for a full feed, as each part would replace the previous ones.
+  """
+
+  group, group_elem, group_count = None, None, 0
+  parts, records, size, open_group = [], 0, 0, None
+  header = None
+  for event, elem in iterparse(filename, events=('start', 'end')):
+    if event == 'start':
+      if elem.tag == 'group':
+        group_count += 1
+        group = '<group%s>\n' % ''.join(
+            [' %s=%s' % (key, saxutils.quoteattr(value))
+             for key, value in elem.attrib.items()])
+        group_elem = elem
+      continue
+    if elem.tag == 'feedtype':
+      feedtype = feedtype or elem.text.strip()
+    elif elem.tag == 'datasource':
+      datasource = datasource or elem.text.strip()
+    elif elem.tag == 'record':
+      if feedtype == 'full':
+        raise ValueError(
+            'A full feed cannot be split: each part would delete the records '
+            'of the previous parts. Push it as an incremental feed instead.')
+      if header is None:
+        header = FEED_HEADER % (
+            saxutils.escape(datasource).encode('utf-8'),
+            saxutils.escape(feedtype).encode('utf-8'))
+      # The tail, if already parsed, is not part of the record
+      tail, elem.tail = elem.tail, None
+      record = tostring(elem, 'utf-8') + '\n'
+      elem.tail = tail
+      # Records are already serialized, drop them from the tree
+      group_elem.clear()
+      if records and (
+          (max_records and records >= max_records) or
+          (max_bytes and size + len(group) + len(record) > max_bytes)):
+        parts.append(FEED_FOOTER)
+        yield feedtype, datasource, ''.join(parts), records
+        parts, records, open_group = [], 0, None
+      if not parts:
+        parts.append(header)
+        size = len(header) + len(FEED_FOOTER)
+      if open_group != group_count:
+        if open_group is not None:
+          parts.append('</group>\n')
+        parts.append(group)
+        size += len(group) + len('</group>\n')
+        open_group = group_count
+      parts.append(record)
+      size += len(record)
+      records += 1
+  if records:
+    parts.append(FEED_FOOTER)
+    yield feedtype, datasource, ''.join(parts), records
+
+
+def SendSplitFeed(url, feeds, connections=4, retries=3):
+  """Pushes feeds over a pool of connections, retrying the failed pushes.
+
+  Args:
+    url: the URL of the feed service on the GSA
+    feeds: iterable of (feedtype, datasource, xml, records) tuples, see
+      SplitFeed
+    connections: number of feeds pushed at the same time
+    retries: number of retries of a failed push, waiting RETRY_BACKOFF
+      seconds before the first one, twice longer before each next one.
+
+  Returns:
+    A 4-tuple: feeds pushed, records pushed, bytes pushed, feeds failed.
   """
 
-  if not etree:
-    raise ImportError(
-        'As the lxml module not available, feed validation is not '
-        'available, please check http://lxml.de/installation.html\n'
-        'On Linux, "sudo aptitude install python-lxml"')
+  queue = Queue.Queue(connections)
+  lock = threading.Lock()
+  stats = {'feeds': 0, 'records': 0, 'bytes': 0, 'failed': 0}
+
+  def Worker():
+    while True:
+      item = queue.get()
+      if item is None:
+        return
+      number, (feedtype, datasource, xml, records) = item
+      response = None
+      try:
+        for attempt in range(retries + 1):
+          if attempt:
+            time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+          try:
+            response = PostFeed(url, feedtype, datasource, xml)
+          except (IOError, httplib.HTTPException), e:
+            # IOError covers urllib2.URLError and socket errors, which
+            # urllib2 does not wrap once the response is being read
+            response = '%s: %s' % (e.__class__.__name__, e)
+          if response == 'Success':
+            break
+          print 'Feed %d: push failed (%s), attempt %d of %d' % (
+              number, response, attempt + 1, retries + 1)
+      except Exception, e:
+        # the worker goes on with the next feed, this one counts as failed
+        print 'Feed %d: push failed (%s: %s)' % (
+            number, e.__class__.__name__, e)
+      finally:
+        lock.acquire()
+        try:
+          if response == 'Success':
+            stats['feeds'] += 1
+            stats['records'] += records
+            stats['bytes'] += len(xml)
+            print 'Feed %d: %d records, %d bytes pushed' % (
+                number, records, len(xml))
+          else:
+            stats['failed'] += 1
+        finally:
+          lock.release()
+
+  workers = [threading.Thread(target=Worker) for _ in range(connections)]
+  for worker in workers:
+    worker.setDaemon(True)
+    worker.start()
+  number = 0
+  for feed in feeds:
+    number += 1
+    queue.put((number, feed))
+  for worker in workers:
+    queue.put(None)
+  for worker in workers:
+    # join with a timeout lets the main thread get KeyboardInterrupt
+    while worker.isAlive():
+      worker.join(1)
+  return stats['feeds'], stats['records'], stats['bytes'], stats['failed']
+
+
+def _Utf8(value):
+  """Returns a string or unicode value as an UTF-8 string."""
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return str(value)
+
+
+def EncodeContent(content, encoding=None):
+  """Yields the content of a record, encoded, a chunk at a time.
+
+  Args:
+    content: a string, or an open file read CONTENT_CHUNK_SIZE bytes at a
+      time.
+    encoding: None for text, escaped for XML, 'base64binary', or
+      'base64compressed' for zlib compressed then base64 encoded content.
+  """
+  if not hasattr(content, 'read'):
+    content = StringIO.StringIO(_Utf8(content))
+  if encoding == 'base64compressed':
+    compressor = zlib.compressobj()
+  pending = ''
+  while True:
+    chunk = content.read(CONTENT_CHUNK_SIZE)
+    if encoding is None:
+      if not chunk:
+        return
+      yield saxutils.escape(chunk)
+    elif encoding == 'base64binary':
+      if not chunk:
+        return
+      yield base64.b64encode(chunk)
+    elif encoding == 'base64compressed':
+      if chunk:
+        pending += compressor.compress(chunk)
+      else:
+        pending += compressor.flush()
+      # base64 encodes 3 bytes at a time, keep the rest for the next chunk
+      size = len(pending)
+      if chunk:
+        size -= size % 3
+      if size:
+        yield base64.b64encode(pending[:size])
+        pending = pending[size:]
+      if not chunk:
+        return
+    else:
+      raise ValueError('Unknown content encoding: %s' % encoding)
+
+
+def EncodedSize(content, encoding=None):
+  """Returns the size of an open file content once encoded, at most.
+
+  Text is read once to count the characters escaped for XML, then the file
+  is rewound; the other encodings are bounded.  Returns None for a content
+  which is not a regular file, see SpoolContent.
+  """
+  try:
+    offset = content.tell()
+    status = os.fstat(content.fileno())
+  except (AttributeError, IOError, OSError):
+    return None
+  if not stat.S_ISREG(status.st_mode):
+    return None
+  size = status.st_size - offset
+  if encoding is None:
+    while True:
+      chunk = content.read(CONTENT_CHUNK_SIZE)
+      if not chunk:
+        break
+      # saxutils.escape: & is &amp;, < is &lt; and > is &gt;
+      size += (4 * chunk.count('&') +
+               3 * (chunk.count('<') + chunk.count('>')))
+    content.seek(offset)
+  elif encoding == 'base64compressed':
+    # zlib output is at most 0.1% and a few bytes larger than its input
+    size += size / 1000 + 64
+  if encoding in ('base64binary', 'base64compressed'):
+    size = (size + 2) / 3 * 4
+  return size
+
+
+def SpoolContent(content):
+  """Copies a file-like content to a temporary file, for it to be sized.
+
+  Returns the temporary file, at its start; the caller closes it.
+  """
+  spool = tempfile.TemporaryFile()
+  while True:
+    chunk = content.read(CONTENT_CHUNK_SIZE)
+    if not chunk:
+      break
+    spool.write(chunk)
+  spool.seek(0)
+  return spool
+
+
+class FeedWriter(object):
+  """Writes a GSA feed one record at a time, without building it in memory.
+
+  The records are written to a file, or to any object with a write method,
+  such as a socket file.  With a byte limit, the feed rolls over to a new
+  part once the next record would not fit.
+
+  Example:
+    writer = FeedWriter('feed-%d.xml', 'docs', max_bytes=100000000)
+    writer.AddRecord('http://example.com/a.pdf', 'application/pdf',
+                     content=open('a.pdf', 'rb'),
+                     encoding='base64compressed',
+                     metadata=[('author', 'jwong')],
+                     acl=[('user', 'permit', 'jwong')],
+                     last_modified='Tue, 6 Nov 2007 12:45:26 GMT')
+    writer.Close()
+    for part in writer.parts:
+      SendFeed(part, url, 'incremental', 'docs')
+  """
+
+  def __init__(self, output, datasource, feedtype='incremental',
+               max_bytes=None):
+    """Starts the first part of the feed.
+
+    Args:
+      output: a filename, with %d standing for the part number if the feed
+        may roll over; or an open file, not closed by the writer; or a
+        function taking the part number and returning an open file.
+      datasource: a string label of the user choice
+      feedtype: incremental or metadata-and-url.  A full feed cannot roll
+        over, as each part would delete the records of the previous parts.
+      max_bytes: maximum size of a part, or None.
+
+    Raises:
+      ValueError: for a full feed with a byte limit.
+    """
+    if feedtype == 'full' and max_bytes:
+      raise ValueError('A full feed cannot roll over to several parts.')
+    self.output = output
+    self.max_bytes = max_bytes
+    self.header = FEED_HEADER % (saxutils.escape(_Utf8(datasource)),
+                                 saxutils.escape(_Utf8(feedtype))) + '<group>\n'
+    self.parts = []
+    self.records = 0
+    self.bytes = 0
+    self.fd = None
+    self.part_records = 0
+    self.part_bytes = 0
+    self._Open()
+
+  def _Open(self):
+    """Starts a new part of the feed."""
+    number = len(self.parts) + 1
+    if isinstance(self.output, basestring):
+      if '%d' in self.output:
+        name = self.output % number
+      elif number == 1:
+        name = self.output
+      else:
+        name = '%s-%d%s' % (os.path.splitext(self.output)[0], number,
+                            os.path.splitext(self.output)[1])
+      self.fd = open(name, 'wb')
+      self.parts.append(name)
+    elif hasattr(self.output, 'write'):
+      if number > 1:
+        raise ValueError('An open file cannot roll over to a new part.')
+      self.fd = self.output
+      self.parts.append(self.output)
+    else:
+      self.fd = self.output(number)
+      self.parts.append(self.fd)
+    self.part_records = 0
+    self.part_bytes = 0
+    self._Write(self.header)
+
+  def _Close(self):
+    """Ends the current part of the feed."""
+    self._Write(FEED_FOOTER)
+    if self.fd is not self.output:
+      self.fd.close()
+    else:
+      self.fd.flush()
+    self.fd = None
+
+  def _Write(self, data):
+    self.fd.write(data)
+    self.part_bytes += len(data)
+    self.bytes += len(data)
+
+  def AddRecord(self, url, mimetype, content=None, encoding=None,
+                metadata=None, acl=None, **attrs):
+    """Writes a record to the feed.
+
+    Args:
+      url: the URL of the record.
+      mimetype: the MIME type of the content.
+      content: a string or an open file, for content feeds.  A file-like
+        object which is not a regular file, e.g. a socket file, is first
+        copied to a temporary file for its size to be known.
+      encoding: None, 'base64binary' or 'base64compressed', see
+        EncodeContent.
+      metadata: list of (name, content) pairs, or a dictionary.
+      acl: list of (scope, access, principal) tuples, e.g.
+        ('group', 'permit', 'engineering').
+      attrs: other attributes of the record, underscores in the names are
+        replaced by dashes, e.g. action='delete', last_modified='...'.
+    """
+    attributes = [('url', url), ('mimetype', mimetype)]
+    attributes.extend(sorted(
+        [(key.replace('_', '-'), value) for key, value in attrs.items()]))
+    head = ['<record%s>' % ''.join(
+        [' %s=%s' % (key, saxutils.quoteattr(_Utf8(value)))
+         for key, value in attributes])]
+    if acl:
+      head.append('<acl>')
+      for scope, access, principal in acl:
+        head.append('<principal scope=%s access=%s>%s</principal>' % (
+            saxutils.quoteattr(scope), saxutils.quoteattr(access),
+            saxutils.escape(_Utf8(principal))))
+      head.append('</acl>')
+    if metadata:
+      if hasattr(metadata, 'items'):
+        metadata = sorted(metadata.items())
+      head.append('<metadata>')
+      for name, value in metadata:
+        head.append('<meta name=%s content=%s/>' % (
+            saxutils.quoteattr(_Utf8(name)), saxutils.quoteattr(_Utf8(value))))
+      head.append('</metadata>')
+    chunks = []
+    size = 0
+    spool = None
+    tail = '</record>\n'
+    if content is not None:
+      if encoding:
+        head.append('<content encoding="%s">' % encoding)
+      else:
+        head.append('<content>')
+      tail = '</content>' + tail
+      if hasattr(content, 'read'):
+        size = EncodedSize(content, encoding)
+        if size is None:
+          content = spool = SpoolContent(content)
+          size = EncodedSize(content, encoding)
+        chunks = EncodeContent(content, encoding)
+      else:
+        chunks = list(EncodeContent(content, encoding))
+        size = sum([len(chunk) for chunk in chunks])
+    head = ''.join(head)
+    size += len(head) + len(tail)
+    try:
+      if (self.max_bytes and self.part_records and
+          self.part_bytes + size + len(FEED_FOOTER) > self.max_bytes):
+        self._Close()
+        self._Open()
+      self._Write(head)
+      for chunk in chunks:
+        self._Write(chunk)
+      self._Write(tail)
+    finally:
+      if spool:
+        spool.close()
+    self.part_records += 1
+    self.records += 1
+
+  def Close(self):
+    """Ends the feed, closing the files opened by the writer."""
+    if self.fd is not None:
+      self._Close()
+
+
+class ValidationError(ValueError):
+  """The feed is not valid, errors holds the error messages."""
+
+  def __init__(self, errors):
+    ValueError.__init__(self, '\n'.join(errors))
+    self.errors = errors
+
+
+class ContentModel(object):
+  """The content model of an element declared in a DTD.
+
+  Children models like (header, group+) are turned into a Glushkov
+  automaton: each element name in the model is a state, and the children
+  of an element are checked one at a time, keeping only the current state.
+  """
+
+  def __init__(self, spec):
+    """Parses the content model of an <!ELEMENT> declaration.
 
+    Args:
+      spec: the content model, e.g. EMPTY, ANY, (#PCDATA|a)* or (a, b+)
+    """
+    spec = spec.strip()
+    self.empty = spec == 'EMPTY'
+    self.any = spec == 'ANY'
+    self.mixed = '#PCDATA' in spec
+    self.names = set(re.findall(r'[^\s()|,?*+#]+', spec))
+    self.symbols = []
+    self.follow = []
+    self.nullable, self.first, self.last = True, set(), set()
+    if not (self.empty or self.any or self.mixed):
+      tokens = re.findall(r'[()|,?*+]|[^\s()|,?*+]+', spec)
+      tree = self._Parse(tokens)
+      self.nullable, self.first, self.last = self._Build(tree)
+
+  def _Parse(self, tokens):
+    """Returns the tree of a model: ('name', n), ('seq', [...]),
+    ('alt', [...]) or ('rep', tree, '?*+')."""
+    token = tokens.pop(0)
+    if token == '(':
+      children = [self._Parse(tokens)]
+      kind = 'seq'
+      while tokens[0] != ')':
+        kind = tokens.pop(0) == '|' and 'alt' or 'seq'
+        children.append(self._Parse(tokens))
+      tokens.pop(0)
+      tree = (kind, children)
+    else:
+      tree = ('name', token)
+    if tokens and tokens[0] in '?*+':
+      tree = ('rep', tree, tokens.pop(0))
+    return tree
+
+  def _Build(self, tree):
+    """Numbers the names of a tree, returns (nullable, first, last)."""
+    if tree[0] == 'name':
+      self.symbols.append(tree[1])
+      self.follow.append(set())
+      position = len(self.symbols) - 1
+      return False, set([position]), set([position])
+    if tree[0] == 'rep':
+      nullable, first, last = self._Build(tree[1])
+      if tree[2] in '*+':
+        for position in last:
+          self.follow[position] |= first
+      return nullable or tree[2] in '?*', first, last
+    if tree[0] == 'alt':
+      nullable, first, last = False, set(), set()
+      for child in tree[1]:
+        child_nullable, child_first, child_last = self._Build(child)
+        nullable = nullable or child_nullable
+        first |= child_first
+        last |= child_last
+      return nullable, first, last
+    nullable, first, last = True, set(), set()
+    for child in tree[1]:
+      child_nullable, child_first, child_last = self._Build(child)
+      for position in last:
+        self.follow[position] |= child_first
+      if nullable:
+        first |= child_first
+      if child_nullable:
+        last |= child_last
+      else:
+        last = child_last
+      nullable = nullable and child_nullable
+    return nullable, first, last
+
+  def Next(self, state, name):
+    """Returns the state after a child element, None if not allowed here.
+
+    Args:
+      state: -1 before the first child, then the value returned for the
+        previous child.
+      name: the name of the child element.
+    """
+    if self.any or (self.mixed and name in self.names):
+      return state
+    if self.empty or self.mixed:
+      return None
+    if state == -1:
+      positions = self.first
+    else:
+      positions = self.follow[state]
+    for position in positions:
+      if self.symbols[position] == name:
+        return position
+    return None
+
+  def Accepts(self, state):
+    """Returns true iff the element may end in this state."""
+    if self.any or self.mixed or self.empty:
+      return True
+    if state == -1:
+      return self.nullable
+    return state in self.last
+
+  def Expected(self, state):
+    """Returns the names of the children allowed in this state."""
+    if state == -1:
+      positions = self.first
+    else:
+      positions = self.follow[state]
+    return sorted(set([self.symbols[position] for position in positions]))
+
+
+class Dtd(object):
+  """The element and attribute declarations of a DTD.
+
+  Parameter entities and conditional sections are not supported, the GSA
+  feed DTD does not use them.
+  """
+
+  def __init__(self, text):
+    text = re.sub(r'(?s)<!--.*?-->', '', text)
+    self.elements = {}
+    self.attributes = {}
+    for name, spec in re.findall(r'<!ELEMENT\s+(\S+)\s+([^>]*)>', text):
+      self.elements[name] = ContentModel(spec)
+    for name, body in re.findall(
+        r'<!ATTLIST\s+(\S+)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>', text):
+      attributes = self.attributes.setdefault(name, {})
+      for attribute, kind, default in re.findall(
+          r'(\S+)\s+(\([^)]*\)|NOTATION\s*\([^)]*\)|\S+)\s+'
+          r'(#REQUIRED|#IMPLIED|(?:#FIXED\s+)?(?:"[^"]*"|\'[^\']*\'))', body):
+        values = None
+        if kind.endswith(')'):
+          values = [value.strip() for value in
+                    kind[kind.index('(') + 1:-1].split('|')]
+        attributes[attribute] = (values, default)
+
+  def CheckAttributes(self, name, attrs):
+    """Returns the error messages for the attributes of an element."""
+    errors = []
+    declared = self.attributes.get(name, {})
+    for attribute, value in attrs.items():
+      if attribute not in declared:
+        errors.append('undeclared attribute %s of <%s>' % (attribute, name))
+        continue
+      values, default = declared[attribute]
+      if values is not None and value not in values:
+        errors.append('attribute %s of <%s> is "%s", must be one of: %s' % (
+            attribute, name, value, ', '.join(values)))
+      if default.startswith('#FIXED'):
+        fixed = default.split(None, 1)[1]
+        if value != fixed[1:-1]:
+          errors.append('attribute %s of <%s> must be %s' % (
+              attribute, name, fixed))
+    for attribute, (values, default) in sorted(declared.items()):
+      if default == '#REQUIRED' and attribute not in attrs:
+        errors.append('missing attribute %s of <%s>' % (attribute, name))
+    return errors
+
+
+def LoadDtd(dtd_filename_or_url):
+  """Returns the text of a GSA feed DTD, from a file, a cache or a GSA.
+
+  DTDs fetched from a GSA are kept DTD_CACHE_SECONDS in DTD_CACHE_DIR.
+
+  Args:
+    dtd_filename_or_url: string either a .dtd file in the current directory,
+      or the hostname of a GSA on which to fetch the DTD.
+
+  Raises:
+    Exception: when the hostname set is not reachable on the port 80 or 443,
+      or does not return a DTD.
+  """
   if dtd_filename_or_url.endswith('.dtd'):
-    f = open(dtd_filename_or_url)
-  else:
+    return open(dtd_filename_or_url).read()
+
+  cached = os.path.join(DTD_CACHE_DIR, '%s.dtd' % dtd_filename_or_url)
+  if (os.path.exists(cached) and
+      time.time() - os.path.getmtime(cached) < DTD_CACHE_SECONDS):
+    return open(cached).read()
+  try:
+    dtd_url = 'http://%s/gsafeed.dtd' % dtd_filename_or_url
+    print 'Trying to fetch the dtd from:', dtd_url
+    text = urllib2.urlopen(dtd_url).read()
+  except urllib2.URLError:
     try:
-      dtd_url = 'http://%s/gsafeed.dtd' % dtd_filename_or_url
+      dtd_url = dtd_url.replace('http', 'https').replace('19900', '19902')
       print 'Trying to fetch the dtd from:', dtd_url
-      f = urllib2.urlopen(dtd_url)
+      text = urllib2.urlopen(dtd_url).read()
     except urllib2.URLError:
-      try:
-        dtd_url = dtd_url.replace('http', 'https').replace('19900', '19902')
-        print 'Trying to fetch the dtd from:', dtd_url
-      except:
-        raise Exception(
-            'Could not download the dtd from %s. '
-            'Is this GSA reachable, is the port 80 or 443 open and reachable?'
-            % dtd_url)
-
-  etree.DTD(f).validate(etree.parse(xmlfilename))
+      raise Exception(
+          'Could not download the dtd from %s. '
+          'Is this GSA reachable, is the port 80 or 443 open and reachable?'
+          % dtd_url)
+  # a login or error page is not kept in the cache
+  if '<!ELEMENT' not in text:
+    raise Exception(
+        'The document at %s is not a DTD. Is this the hostname of a GSA?'
+        % dtd_url)
+  if not os.path.isdir(DTD_CACHE_DIR):
+    os.makedirs(DTD_CACHE_DIR)
+  f = open(cached, 'w')
+  f.write(text)
+  f.close()
+  return text
+
+
+def Validate(dtd_filename_or_url, xmlfilename, max_errors=10):
+  """Validate the input file against a GSA feed DTD.
+
+  The feed is validated while it is parsed, without building a tree: the
+  children of each element must match its content model, its attributes
+  must be declared, the required ones present, the enumerated ones among
+  their values.
+
+  Args:
+    dtd_filename_or_url: string either a .dtd file in the current directory,
+      or the hostname of a GSA on which to fetch the DTD.
+    xmlfilename: the filename of a XML GSA feed
+    max_errors: validation stops after this number of errors.
+
+  Returns:
+    True if validation passed, otherwise an exception is raised.
+
+  Raises:
+    ValidationError: listing the first errors with their line numbers.
+  """
+
+  dtd = Dtd(LoadDtd(dtd_filename_or_url))
+  errors = []
+  # (element name, content model, state) of the open elements
+  stack = []
+  doctype = []
+  p = expat.ParserCreate()
+
+  def Error(message):
+    errors.append('line %d: %s' % (p.CurrentLineNumber, message))
+    if len(errors) >= max_errors:
+      raise ValidationError(errors)
+
+  def StartDoctypeDecl(name, system_id, public_id, has_internal_subset):
+    doctype.append(name)
+
+  def StartElement(name, attrs):
+    if stack:
+      parent, model, state = stack[-1]
+      if model is not None:
+        next_state = model.Next(state, name)
+        if next_state is None:
+          Error('<%s> not allowed in <%s> here, expected: %s' % (
+              name, parent, ', '.join(model.Expected(state)) or 'nothing'))
+        else:
+          stack[-1] = (parent, model, next_state)
+    elif doctype and name != doctype[0]:
+      Error('root element is <%s>, the DOCTYPE declares <%s>' % (
+          name, doctype[0]))
+    model = dtd.elements.get(name)
+    if model is None:
+      Error('undeclared element <%s>' % name)
+    for message in dtd.CheckAttributes(name, attrs):
+      Error(message)
+    stack.append((name, model, -1))
+
+  def EndElement(name):
+    name, model, state = stack.pop()
+    if model is not None and not model.Accepts(state):
+      Error('<%s> ends too early, expected: %s' % (
+          name, ', '.join(model.Expected(state))))
+
+  def CharData(data):
+    if stack and data.strip():
+      name, model, state = stack[-1]
+      if model is not None and not (model.mixed or model.any):
+        Error('text not allowed in <%s>' % name)
+
+  p.StartDoctypeDeclHandler = StartDoctypeDecl
+  p.StartElementHandler = StartElement
+  p.EndElementHandler = EndElement
+  p.CharacterDataHandler = CharData
+  f = open(xmlfilename, 'rb')
+  try:
+    p.ParseFile(f)
+  except expat.ExpatError, e:
+    errors.append('line %d: %s' % (e.lineno, expat.ErrorString(e.code)))
+  finally:
+    f.close()
+  if errors:
+    raise ValidationError(errors)
   return True
 
 
@@ -352,26 +1157,110 @@ def ExtractFeedtypeAndDatasource(filename):
 
 def ExtractFollowUrls(filename):
   """Returns a minimal set of hostnames matching the URLs in the feed."""
-  follow_urls = set()
-  for event, elem in iterparse(filename):
-    if event == 'end':
-      if elem.tag == 'record':
-        if 'url' in elem.attrib:
-          url = urlparse.urlparse(elem.attrib['url'])
-          follow_urls.add('%s://%s/' % (url.scheme, url.netloc))
-  return follow_urls
+  return InspectFeed(filename).follow_urls
+
+
+class FeedInfo(object):
+  """What InspectFeed found in a feed file."""
+
+  def __init__(self):
+    self.feedtype = None
+    self.datasource = None
+    self.follow_urls = set()
+    self.records = 0
+    self.actions = {}
+    self.bytes = 0
+    self.content_bytes = 0
+    self.largest_content = 0
+
+  def __str__(self):
+    # The header fields are unicode when not ASCII, str() must return bytes
+    lines = ['Datasource: %s' % _Utf8(self.datasource),
+             'Feed type: %s' % _Utf8(self.feedtype),
+             'Records: %d' % self.records]
+    for action, count in sorted(self.actions.items()):
+      lines.append('  %s: %d' % (action, count))
+    lines.append('Feed size: %d bytes' % self.bytes)
+    if self.records:
+      lines.append('Content: %d bytes, %d bytes per record, largest %d bytes'
+                   % (self.content_bytes, self.content_bytes / self.records,
+                      self.largest_content))
+    return '\n'.join(lines)
+
+
+def InspectFeed(filename):
+  """Reads a feed file once, gathering its header and records statistics.
+
+  The records are dropped from the tree as soon as parsed, so that memory
+  use does not depend on the size of the feed.
+
+  Args:
+    filename: string filename of a XML GSA feed document.
+
+  Returns:
+    A FeedInfo object: feedtype, datasource, follow_urls (a minimal set of
+    hostnames matching the URLs in the feed), number of records, records
+    per action, feed size, content size.
+  """
+
+  info = FeedInfo()
+  info.bytes = os.path.getsize(filename)
+  parents = []
+  group_action = None
+  for event, elem in iterparse(filename, events=('start', 'end')):
+    if event == 'start':
+      parents.append(elem)
+      if elem.tag == 'group':
+        group_action = elem.get('action')
+      continue
+    parents.pop()
+    if elem.tag == 'feedtype':
+      info.feedtype = (elem.text or '').strip()
+    elif elem.tag == 'datasource':
+      info.datasource = (elem.text or '').strip()
+    elif elem.tag == 'content':
+      size = len(elem.text or '')
+      info.content_bytes += size
+      info.largest_content = max(info.largest_content, size)
+    elif elem.tag == 'record':
+      info.records += 1
+      action = elem.get('action') or group_action or 'add'
+      info.actions[action] = info.actions.get(action, 0) + 1
+      if 'url' in elem.attrib:
+        url = urlparse.urlparse(elem.attrib['url'])
+        info.follow_urls.add('%s://%s/' % (url.scheme, url.netloc))
+      # Drop the record, its parent then holds one child at most
+      elem.clear()
+      parents[-1].remove(elem)
+  return info
 
 
 def main(options):
   if options.example:
     ShowExamples(options.example)
 
+  elif options.inspect:
+    if not options.xmlfilename:
+      print 'Provide a document to inspect'
+      sys.exit(1)
+
+    info = InspectFeed(options.xmlfilename)
+    print info
+    for l in info.follow_urls:
+      print 'Follow URL:', l
+
   elif options.dtd:
     if not options.xmlfilename:
       print 'Provide a document to validate'
 
-    if Validate(options.host, options.xmlfilename):
-      print 'Valid XML document, valid GSA feed.'
+    try:
+      if Validate(options.host, options.xmlfilename, options.max_errors):
+        print 'Valid XML document, valid GSA feed.'
+    except ValidationError, e:
+      print 'Invalid GSA feed, first errors:'
+      for error in e.errors:
+        print ' ', error
+      sys.exit(1)
 
   else:
     if not options.url or not options.xmlfilename:
@@ -379,26 +1268,46 @@ def main(options):
              '\n  gsa_feed.py feed.xml gsa.company.com')
       sys.exit(1)
 
+    info = InspectFeed(options.xmlfilename)
+    print info
+
     # If the datasource or the feedtype is empty extract it from the feed file.
     if options.feedtype is None or options.datasource is None:
-      feedtype, datasource = ExtractFeedtypeAndDatasource(options.xmlfilename)
+      if not info.feedtype or not info.datasource:
+        raise ValueError(
+            'Could not find the feed type and datasource in the XML file')
 
       if options.feedtype is None:
-        options.feedtype = feedtype
+        options.feedtype = info.feedtype
 
       if options.datasource is None:
-        o.datasource = datasource
-
-    response = SendFeed(
-        options.xmlfilename, options.url, options.feedtype, options.datasource)
-    print 'Feed service responded:', response
+        options.datasource = info.datasource
+
+    if options.split_records or options.split_bytes:
+      start = time.time()
+      feeds, records, size, failed = SendSplitFeed(
+          options.url,
+          SplitFeed(options.xmlfilename, options.split_records,
+                    options.split_bytes, options.feedtype, options.datasource),
+          options.connections, options.retries)
+      seconds = max(time.time() - start, 0.001)
+      print ('%d feeds pushed, %d failed: %d records, %d bytes in %.1fs, '
+             '%.1f records/s, %.1f bytes/s' % (
+                 feeds, failed, records, size, seconds, records / seconds,
+                 size / seconds))
+      response = failed and 'Failure' or 'Success'
+    else:
+      response = SendFeed(
+          options.xmlfilename, options.url, options.feedtype,
+          options.datasource)
+      print 'Feed service responded:', response
     if response == 'Success':
       print ('\nMake sure the GSA is configured in "Content Sources > Feeds" '
              'for receiving feeds from this workstation IP address. ')
       print ('Make sure the URLs you push are matching a "follow URL". '
              'See below for minimal set of matching follow URLs:')
 
-      for l in ExtractFollowUrls(options.xmlfilename):
+      for l in info.follow_urls:
         print l
 
 
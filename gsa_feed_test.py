@@ -0,0 +1,454 @@
+#!/usr/bin/env python2
+#
+# Copyright 2014 Google, Inc.
+# All Rights Reserved.
+
+"""Unit tests for gsa_feed.py.
+
+The tests run offline: the DTD below stands for the one of a GSA, and the
+feeds are pushed to servers on localhost.
+"""
+
+import base64
+import os
+import shutil
+import socket
+import StringIO
+import tempfile
+import threading
+import unittest
+import zlib
+
+import gsa_feed
+
+GSA_FEED_DTD = """<?xml version="1.0" encoding="UTF-8"?>
+<!-- GSA feed DTD -->
+<!ELEMENT gsafeed (header, group+)>
+<!ELEMENT header (datasource, feedtype)>
+<!ELEMENT datasource (#PCDATA)>
+<!ELEMENT feedtype (#PCDATA)>
+<!ELEMENT group (acl?, record+)>
+<!ATTLIST group
+    action (add|delete) "add"
+    pagerank CDATA #IMPLIED
+    feedrank CDATA #IMPLIED>
+<!ELEMENT record (acl?, metadata*, content*)>
+<!ATTLIST record
+    url CDATA #REQUIRED
+    displayurl CDATA #IMPLIED
+    action (add|delete) #IMPLIED
+    mimetype CDATA #REQUIRED
+    last-modified CDATA #IMPLIED
+    lock (true|false) "false"
+    authmethod (none|httpbasic|ntlm|httpsso|negotiate) "none"
+    pagerank CDATA #IMPLIED
+    feedrank CDATA #IMPLIED
+    crawl-immediately (true|false) "false"
+    crawl-once (true|false) "false">
+<!ELEMENT metadata (meta*)>
+<!ATTLIST metadata overwrite-acls (true|false) "true">
+<!ELEMENT meta EMPTY>
+<!ATTLIST meta
+    encoding (base64binary) #IMPLIED
+    name CDATA #REQUIRED
+    content CDATA #REQUIRED>
+<!ELEMENT content (#PCDATA)>
+<!ATTLIST content encoding (base64binary|base64compressed) #IMPLIED>
+<!ELEMENT acl (principal*)>
+<!ATTLIST acl
+    url CDATA #IMPLIED
+    inherit-from CDATA #IMPLIED>
+<!ELEMENT principal (#PCDATA)>
+<!ATTLIST principal
+    scope (user|group) #REQUIRED
+    access (permit|deny) #REQUIRED
+    namespace CDATA "Default">
+"""
+
+# The records of a test feed start on line 6
+FEED = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE gsafeed PUBLIC "-//Google//DTD GSA Feeds//EN" "">
+<gsafeed>
+<header><datasource>test</datasource><feedtype>incremental</feedtype></header>
+<group>
+%s
+</group>
+</gsafeed>
+"""
+
+RECORD = '<record url="http://example.com/%d" mimetype="text/plain"/>'
+
+
+class ContentModelTest(unittest.TestCase):
+
+  def matches(self, spec, names):
+    """Returns true iff the sequence of children names matches the model."""
+    model = gsa_feed.ContentModel(spec)
+    state = -1
+    for name in names:
+      state = model.Next(state, name)
+      if state is None:
+        return False
+    return model.Accepts(state)
+
+  def testSequenceWithOneOrMore(self):
+    self.assertTrue(self.matches('(a, b+)', ['a', 'b']))
+    self.assertTrue(self.matches('(a, b+)', ['a', 'b', 'b', 'b']))
+    self.assertFalse(self.matches('(a, b+)', []))
+    self.assertFalse(self.matches('(a, b+)', ['a']))
+    self.assertFalse(self.matches('(a, b+)', ['b']))
+    self.assertFalse(self.matches('(a, b+)', ['a', 'b', 'a']))
+
+  def testChoiceZeroOrMore(self):
+    self.assertTrue(self.matches('(a|b)*', []))
+    self.assertTrue(self.matches('(a|b)*', ['a']))
+    self.assertTrue(self.matches('(a|b)*', ['b', 'a', 'a', 'b']))
+    self.assertFalse(self.matches('(a|b)*', ['a', 'c']))
+
+  def testOptional(self):
+    self.assertTrue(self.matches('(a, b?, c)', ['a', 'c']))
+    self.assertTrue(self.matches('(a, b?, c)', ['a', 'b', 'c']))
+    self.assertFalse(self.matches('(a, b?, c)', ['a', 'b', 'b', 'c']))
+    self.assertFalse(self.matches('(a, b?, c)', ['a', 'b']))
+    self.assertFalse(self.matches('(a, b?, c)', ['b', 'c']))
+
+  def testExpected(self):
+    model = gsa_feed.ContentModel('(acl?, metadata*, content*)')
+    self.assertEqual(['acl', 'content', 'metadata'], model.Expected(-1))
+    state = model.Next(-1, 'content')
+    self.assertEqual(['content'], model.Expected(state))
+
+  def testMixedAndEmpty(self):
+    self.assertTrue(self.matches('(#PCDATA)', []))
+    self.assertFalse(self.matches('(#PCDATA)', ['a']))
+    self.assertTrue(self.matches('(#PCDATA|a)*', ['a', 'a']))
+    self.assertTrue(self.matches('EMPTY', []))
+    self.assertFalse(self.matches('EMPTY', ['a']))
+
+
+class FeedTestCase(unittest.TestCase):
+  """Writes the DTD and the feeds of a test in a temporary directory."""
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.dtd = self.write('gsafeed.dtd', GSA_FEED_DTD)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def write(self, name, text):
+    """Writes a file of the test, returns its filename."""
+    filename = os.path.join(self.directory, name)
+    f = open(filename, 'w')
+    f.write(text)
+    f.close()
+    return filename
+
+  def validate(self, xml, max_errors=10):
+    """Returns the validation errors of a feed, [] if it is valid."""
+    filename = self.write('feed.xml', xml)
+    try:
+      self.assertTrue(gsa_feed.Validate(self.dtd, filename, max_errors))
+    except gsa_feed.ValidationError, e:
+      return e.errors
+    return []
+
+
+class ValidateTest(FeedTestCase):
+
+  def testExamples(self):
+    # groupsdb is a groups database, not a feed
+    for name in ('full', 'incremental', 'metadata-and-url',
+                 'metadata-and-url-base64'):
+      self.assertEqual([], self.validate(gsa_feed.EXAMPLES[name]), name)
+
+  def testValidFeed(self):
+    records = '\n'.join([RECORD % number for number in range(3)])
+    self.assertEqual([], self.validate(FEED % records))
+
+  def testWrongChildOrder(self):
+    records = ('<record url="http://example.com/" mimetype="text/plain">\n'
+               '<content>hello</content>\n'
+               '<metadata><meta name="a" content="b"/></metadata>\n'
+               '</record>')
+    self.assertEqual(
+        ['line 8: <metadata> not allowed in <record> here, expected: '
+         'content'],
+        self.validate(FEED % records))
+
+  def testMissingRequiredAttributes(self):
+    records = ('<record mimetype="text/plain"/>\n'
+               '<record url="http://example.com/"/>')
+    self.assertEqual(
+        ['line 6: missing attribute url of <record>',
+         'line 7: missing attribute mimetype of <record>'],
+        self.validate(FEED % records))
+
+  def testBadAttributeValue(self):
+    records = ('<record url="http://example.com/" mimetype="text/plain" '
+               'action="remove"/>')
+    self.assertEqual(
+        ['line 6: attribute action of <record> is "remove", must be one of: '
+         'add, delete'],
+        self.validate(FEED % records))
+
+  def testTextInElementContent(self):
+    records = 'some text\n' + RECORD % 1
+    self.assertEqual(
+        ['line 6: text not allowed in <group>'],
+        self.validate(FEED % records))
+
+  def testUndeclaredAttribute(self):
+    records = ('<record url="http://example.com/" mimetype="text/plain" '
+               'color="red"/>')
+    self.assertEqual(
+        ['line 6: undeclared attribute color of <record>'],
+        self.validate(FEED % records))
+
+  def testMissingChild(self):
+    self.assertEqual(
+        ['line 7: <group> ends too early, expected: acl, record'],
+        self.validate(FEED % ''))
+
+  def testMaxErrors(self):
+    records = '\n'.join(['<record mimetype="text/plain"/>'] * 5)
+    errors = self.validate(FEED % records, max_errors=3)
+    self.assertEqual(
+        ['line 6: missing attribute url of <record>',
+         'line 7: missing attribute url of <record>',
+         'line 8: missing attribute url of <record>'],
+        errors)
+
+  def testNotWellFormed(self):
+    errors = self.validate(FEED % '<record url="http://example.com/"')
+    self.assertEqual(1, len(errors))
+    self.assertTrue(errors[0].startswith('line 7: '), errors)
+
+
+class FeedWriterTest(FeedTestCase):
+
+  def contents(self, filename):
+    """Returns the decoded contents of the records of a feed, by URL."""
+    contents = {}
+    for _, elem in gsa_feed.iterparse(filename):
+      if elem.tag != 'record':
+        continue
+      content = elem.find('content')
+      text = content.text or ''
+      encoding = content.get('encoding')
+      if encoding in ('base64binary', 'base64compressed'):
+        text = base64.b64decode(text)
+      if encoding == 'base64compressed':
+        text = zlib.decompress(text)
+      contents[elem.get('url')] = text
+    return contents
+
+  def testContentEncodings(self):
+    # longer than a chunk, for the base64 encoding to cross chunk boundaries
+    text = ''.join([chr(number % 256) for number in range(
+        gsa_feed.CONTENT_CHUNK_SIZE + 1000)])
+    content = self.write('content', text)
+    filename = os.path.join(self.directory, 'feed.xml')
+    writer = gsa_feed.FeedWriter(filename, 'test')
+    writer.AddRecord('http://example.com/text', 'text/plain',
+                     content='a < b & "c"')
+    for encoding in ('base64binary', 'base64compressed'):
+      writer.AddRecord('http://example.com/%s' % encoding,
+                       'application/octet-stream', encoding=encoding,
+                       content=open(content, 'rb'))
+    writer.Close()
+    self.assertEqual(3, writer.records)
+    self.assertEqual(os.path.getsize(filename), writer.bytes)
+    self.assertEqual({'http://example.com/text': 'a < b & "c"',
+                      'http://example.com/base64binary': text,
+                      'http://example.com/base64compressed': text},
+                     self.contents(filename))
+    self.assertEqual([], self.validate(open(filename).read()))
+
+  def rollOver(self, name, contents, encoding=None):
+    """Writes records with a byte limit, checks the parts and the contents.
+
+    Args:
+      name: the name of the parts, in the test directory.
+      contents: functions returning the content of a record, a string or a
+        file, called twice: once for the writer, once for the expected one.
+      encoding: the encoding of the contents.
+    """
+    max_bytes = 1000
+    writer = gsa_feed.FeedWriter(
+        os.path.join(self.directory, name + '-%d.xml'), 'test',
+        max_bytes=max_bytes)
+    expected = {}
+    for number, content in enumerate(contents):
+      url = 'http://example.com/%d' % number
+      expected[url] = content()
+      if hasattr(expected[url], 'read'):
+        expected[url] = expected[url].read()
+      writer.AddRecord(url, 'text/plain', content=content(),
+                       encoding=encoding, metadata={'number': number})
+    writer.Close()
+    self.assertTrue(len(writer.parts) > 1)
+    self.assertEqual(len(contents), writer.records)
+    found = {}
+    for part in writer.parts:
+      self.assertTrue(os.path.getsize(part) <= max_bytes,
+                      (part, os.path.getsize(part)))
+      self.assertEqual([], self.validate(open(part).read()))
+      found.update(self.contents(part))
+    self.assertEqual(expected, found)
+
+  def testRollOver(self):
+    self.rollOver('string', [lambda: 'x' * 100] * 20)
+
+  # The files follow a small record, so that a part only fits them when they
+  # are not undersized
+
+  def testRollOverFileLikeContent(self):
+    # StringIO has no file descriptor, its size is only known once read
+    self.rollOver('stringio', [lambda: 'x',
+                               lambda: StringIO.StringIO('y' * 420)] * 4,
+                  encoding='base64binary')
+
+  def testRollOverEscapedText(self):
+    # Text grows when escaped, up to 5 times for &
+    escaped = self.write('escaped', '&' * 120)
+    self.rollOver('escaped', [lambda: 'x', lambda: open(escaped)] * 4)
+    text = self.write('text', 'a < b & c > d ' * 20)
+    self.rollOver('text', [lambda: 'x', lambda: open(text)] * 4)
+
+  def testOpenFile(self):
+    output = StringIO.StringIO()
+    writer = gsa_feed.FeedWriter(output, 'test', 'metadata-and-url')
+    writer.AddRecord('http://example.com/', 'text/html',
+                     acl=[('group', 'permit', 'engineering')],
+                     last_modified='Tue, 6 Nov 2007 12:45:26 GMT')
+    writer.Close()
+    self.assertEqual([output], writer.parts)
+    self.assertEqual([], self.validate(output.getvalue()))
+
+  def testFullFeedCannotRollOver(self):
+    self.assertRaises(ValueError, gsa_feed.FeedWriter,
+                      os.path.join(self.directory, 'feed.xml'), 'test',
+                      'full', max_bytes=1000)
+
+
+class InspectFeedTest(FeedTestCase):
+
+  def testNonAsciiDatasource(self):
+    filename = self.write('feed.xml', (FEED % RECORD % 1).replace(
+        '<datasource>test<', '<datasource>d\xc3\xa9<'))
+    info = gsa_feed.InspectFeed(filename)
+    self.assertEqual(u'd\xe9', info.datasource)
+    self.assertEqual(1, info.records)
+    self.assertTrue('Datasource: d\xc3\xa9\n' in str(info), str(info))
+
+  def testEmptyFeedType(self):
+    filename = self.write('feed.xml', (FEED % RECORD % 1).replace(
+        '<feedtype>incremental</feedtype>', '<feedtype/>'))
+    info = gsa_feed.InspectFeed(filename)
+    self.assertEqual('', info.feedtype)
+    self.assertEqual('test', info.datasource)
+
+
+class SplitFeedTest(FeedTestCase):
+
+  def testSplitByRecords(self):
+    filename = self.write('feed.xml', FEED % '\n'.join(
+        [RECORD % number for number in range(5)]))
+    feeds = list(gsa_feed.SplitFeed(filename, max_records=2))
+    self.assertEqual([2, 2, 1], [records for _, _, _, records in feeds])
+    urls = []
+    for feedtype, datasource, xml, records in feeds:
+      self.assertEqual(('incremental', 'test'), (feedtype, datasource))
+      self.assertEqual([], self.validate(xml))
+      urls.extend([elem.get('url') for _, elem in
+                   gsa_feed.iterparse(StringIO.StringIO(xml))
+                   if elem.tag == 'record'])
+    self.assertEqual(['http://example.com/%d' % number
+                      for number in range(5)], urls)
+
+  def testSplitByBytes(self):
+    filename = self.write('feed.xml', FEED % '\n'.join(
+        [RECORD % number for number in range(10)]))
+    max_bytes = 600
+    feeds = list(gsa_feed.SplitFeed(filename, max_bytes=max_bytes))
+    self.assertTrue(len(feeds) > 1)
+    self.assertEqual(10, sum([records for _, _, _, records in feeds]))
+    for _, _, xml, _ in feeds:
+      self.assertTrue(len(xml) <= max_bytes, len(xml))
+      self.assertEqual([], self.validate(xml))
+
+  def testFullFeedIsNotSplit(self):
+    filename = self.write('feed.xml', gsa_feed.EXAMPLES['full'])
+    self.assertRaises(ValueError, list,
+                      gsa_feed.SplitFeed(filename, max_records=1))
+
+
+class SendSplitFeedTest(unittest.TestCase):
+
+  def setUp(self):
+    self.backoff = gsa_feed.RETRY_BACKOFF
+    gsa_feed.RETRY_BACKOFF = 0
+    self.server = socket.socket()
+    self.server.bind(('127.0.0.1', 0))
+    self.server.listen(5)
+    self.url = 'http://127.0.0.1:%d/xmlfeed' % self.server.getsockname()[1]
+    thread = threading.Thread(target=self.closeConnections)
+    thread.setDaemon(True)
+    thread.start()
+
+  def tearDown(self):
+    gsa_feed.RETRY_BACKOFF = self.backoff
+    self.server.close()
+
+  def closeConnections(self):
+    """Reads each request, then closes the connection without responding."""
+    while True:
+      try:
+        connection = self.server.accept()[0]
+      except socket.error:
+        return
+      data = ''
+      while not data.endswith('--\r\n'):
+        chunk = connection.recv(65536)
+        if not chunk:
+          break
+        data += chunk
+      connection.close()
+
+  def testFailedPushesAreCounted(self):
+    feeds = [('incremental', 'test', FEED % RECORD % number, 1)
+             for number in range(3)]
+    self.assertEqual((0, 0, 0, 3), gsa_feed.SendSplitFeed(
+        self.url, feeds, connections=2, retries=1))
+
+
+class LoadDtdTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.cache_dir = gsa_feed.DTD_CACHE_DIR
+    self.urlopen = gsa_feed.urllib2.urlopen
+    gsa_feed.DTD_CACHE_DIR = self.directory
+    self.served = None
+    gsa_feed.urllib2.urlopen = lambda url: StringIO.StringIO(self.served)
+
+  def tearDown(self):
+    gsa_feed.DTD_CACHE_DIR = self.cache_dir
+    gsa_feed.urllib2.urlopen = self.urlopen
+    shutil.rmtree(self.directory)
+
+  def testFetchedDtdIsCached(self):
+    self.served = GSA_FEED_DTD
+    self.assertEqual(GSA_FEED_DTD, gsa_feed.LoadDtd('gsa.example.com'))
+    self.served = None
+    self.assertEqual(GSA_FEED_DTD, gsa_feed.LoadDtd('gsa.example.com'))
+
+  def testHtmlPageIsNotCached(self):
+    self.served = '<html><body>Please log in</body></html>'
+    self.assertRaises(Exception, gsa_feed.LoadDtd, 'gsa.example.com')
+    self.assertEqual([], os.listdir(self.directory))
+
+
+if __name__ == '__main__':
+  unittest.main()
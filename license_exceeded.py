@@ -33,8 +33,8 @@ counted as a different document.
 
 - The script shows the number of URLs which are duplicate only for
   their URL parameters. The script can additionaly show the URL paths
-  and the number of duplicates (not the default, this can hog the
-  memory for large list of URLs) and the parameters involved in the
+  and the number of duplicates (not the default, the URLs are spilled
+  to temporary files to do so) and the parameters involved in the
   permutations. This is the option --param_permutation.
 
 - The content owner can then setup Block URLs patterns to only accept
@@ -70,17 +70,28 @@ __author__ = 'jeandaniel.browne@gmail.com (Jean-Daniel Browne)'
 
 from BaseHTTPServer import BaseHTTPRequestHandler
 from BaseHTTPServer import HTTPServer
+import array
+import atexit
+import base64
 import collections
 import contextlib
+import heapq
+import itertools
 import json
+import multiprocessing
 import optparse
+import os
 import platform
+import re
+import shutil
 import socket
 import sys
+import tempfile
 import textwrap
 import urllib
 import urlparse
 import webbrowser
+import zlib
 
 
 try:
@@ -170,6 +181,26 @@ p.add_option(
     action='store_true', default=False)
 
 
+#### Simulating "Do Not Follow" patterns before setting them on the GSA
+p.add_option(
+    '--block-patterns',
+    help=('A file of GSA URL patterns, one per line, as they would be set in '
+          '"Do Not Follow Patterns" or coverage tuning. Shows how many URLs '
+          'each pattern removes, and the license count if they were all set. '
+          'Off by default.'),
+    default=None)
+
+
+p.add_option(
+    '--state',
+    help=('A file where the counts of this run are saved. When the file '
+          'exists, the counts of the previous run are read from it first, '
+          'and the report shows what changed since then: the growth per '
+          'directory and per URL parameter, and which checks got worse. '
+          'Only used for the general report. Off by default.'),
+    default=None)
+
+
 p.add_option(
     '--skip-header',
     help=('Exported URLs may have a header first line that needs '
@@ -193,6 +224,20 @@ p.add_option(
     help=('Decrease memory usage, directories deeper than 10 (the default), '
           'are not detailed when parsing the file.'),
     default=10)
+p.add_option(
+    '--processes',
+    help=('Number of worker processes parsing the URLs. The counts of each '
+          'worker are merged at the end. Defaults to 1, no worker process.'),
+    type=int,
+    default=1)
+p.add_option(
+    '--partitions',
+    help=('With --%s or --%s, the URLs are grouped in this many temporary '
+          'files, and only one file at a time is loaded in memory. Increase '
+          'this for very large lists of URLs. Defaults to 64.'
+          % (CASE, PARAM_PERMUTATION)),
+    type=int,
+    default=64)
 
 CONF, ARGS = p.parse_args()
 CONF.error = 1
@@ -247,54 +292,261 @@ class Counters(object):
     if CONF.param_permutation:
       self.paths = collections.defaultdict(int)
 
+  def Merge(self, other):
+    """Adds the counts of other, a Counters built on other URLs."""
+    self.url += other.url
+    for name in ('url_sortedquery', 'val', 'key', 'path', 'query', 'casei'):
+      getattr(self, name).update(getattr(other, name))
+    for k, v in other.keyval_num_per_urls.iteritems():
+      self.keyval_num_per_urls[k] += v
+    if CONF.param_permutation:
+      for k, v in other.paths.iteritems():
+        self.paths[k] += v
 
-class Node(dict):
+  HLL_NAMES = ('url_sortedquery', 'val', 'key', 'path', 'query', 'casei')
 
-  __slots__ = ('count',)
-  # __slots__ is a documented "trick" to save memory when large number
-  # of small Python objects are instantiated.
+  @staticmethod
+  def EncodeHll(hll):
+    # The registers of the sketch are small integers, one byte each.
+    return base64.b64encode(str(bytearray(hll.M)))
+
+  @staticmethod
+  def DecodeHll(data):
+    hll = Counters.hll()
+    registers = list(bytearray(base64.b64decode(data)))
+    if len(registers) != len(hll.M):
+      raise ValueError('HyperLogLog sketch saved with a different precision')
+    hll.M = registers
+    return hll
+
+  def State(self):
+    """The counts as a JSON serializable dict, see FromState."""
+    state = {'url': self.url,
+             'keyval_num_per_urls': self.keyval_num_per_urls}
+    for name in self.HLL_NAMES:
+      state[name] = self.EncodeHll(getattr(self, name))
+    return state
+
+  @classmethod
+  def FromState(cls, state):
+    counters = cls()
+    counters.url = state['url']
+    for k, v in state['keyval_num_per_urls'].iteritems():
+      counters.keyval_num_per_urls[int(k)] = v
+    for name in cls.HLL_NAMES:
+      setattr(counters, name, cls.DecodeHll(state[name]))
+    return counters
+
+
+class Tree(object):
+  """A tree of URL counts per directory, stored in flat arrays.
+
+  Node i has the directory name self.names[self.segment[i]], the parent
+  node self.parent[i] and self.count[i] URLs below it. Node 0 is the
+  root. The directory names are interned: a name shared by many
+  directories (say "images") is stored once. Compared to one Python dict
+  per directory, this uses several times less memory for large trees.
+
+  A child is always appended after its parent, so iterating on the node
+  indexes in increasing order visits parents first.
+  """
 
   CONF = CONF
   # The configuration taken from the command line flags is a static
   # attribute to make sure instances do not all duplicate this
   # pointer.
 
+  ROOT = 0
+
   def __init__(self):
-    dict.__init__(self)
-    self.count = 0
-
-  def Add(self, path, depth=0):
-    self.count += 1
-    if path and (depth < CONF.depth_parsed):
-      depth += 1
-      child, path = path[0], path[1:]
-      if child not in self:
-        self[child] = Node()
-      self[child].Add(path, depth)
-
-  def BigEnough(self, node):
+    self.names = []
+    self.name_ids = {}
+    # Interned directory names, and their index in self.names
+
+    self.parent = array.array('l', [-1])
+    self.segment = array.array('l', [-1])
+    self.count = array.array('l', [0])
+
+    self.child_ids = {}
+    # Maps (parent << 32 | segment) to the child node index, to find a
+    # child when adding a path. An int key is much more compact than a
+    # tuple.
+
+    self.children = None
+    # Built on demand by Children() for the traversals: the children of
+    # node i are self.children[1][self.children[0][i]:
+    # self.children[0][i + 1]]
+
+  def __len__(self):
+    return len(self.count)
+
+  def Intern(self, name):
+    name_id = self.name_ids.get(name)
+    if name_id is None:
+      name_id = self.name_ids[name] = len(self.names)
+      self.names.append(name)
+    return name_id
+
+  def Child(self, node, name):
+    """Returns the index of the child of node called name, adds it if new."""
+    key = node << 32 | self.Intern(name)
+    child = self.child_ids.get(key)
+    if child is None:
+      child = self.child_ids[key] = len(self.count)
+      self.parent.append(node)
+      self.segment.append(key & 0xffffffff)
+      self.count.append(0)
+      self.children = None
+    return child
+
+  def Add(self, path, count=1):
+    node = self.ROOT
+    self.count[node] += count
+    for name in path[:CONF.depth_parsed]:
+      node = self.Child(node, name)
+      self.count[node] += count
+
+  def Merge(self, other):
+    """Adds the counts of the tree other to this tree."""
+    self.count[self.ROOT] += other.count[other.ROOT]
+    mapping = array.array('l', [self.ROOT]) * len(other)
+    # node index in other -> node index in self. Parents come first in
+    # other, so their mapping is known when their children are reached.
+    for i in xrange(1, len(other)):
+      node = self.Child(mapping[other.parent[i]], other.names[other.segment[i]])
+      mapping[i] = node
+      self.count[node] += other.count[i]
+
+  def Children(self, node):
+    """Returns the list of the indexes of the children of node."""
+    if self.children is None:
+      # Counting sort of the nodes by parent index.
+      start = array.array('l', [0]) * (len(self) + 1)
+      for i in xrange(1, len(self)):
+        start[self.parent[i] + 1] += 1
+      for i in xrange(len(self)):
+        start[i + 1] += start[i]
+      fill = array.array('l', start)
+      index = array.array('l', [0]) * max(len(self) - 1, 0)
+      for i in xrange(1, len(self)):
+        index[fill[self.parent[i]]] = i
+        fill[self.parent[i]] += 1
+      self.children = start, index
+    start, index = self.children
+    return index[start[node]:start[node + 1]]
+
+  def Name(self, node, root_name='root'):
+    if node == self.ROOT:
+      return root_name
+    return self.names[self.segment[node]]
+
+  def BigEnough(self, node, child):
+    count = self.count[child]
     if CONF.min_count is not None:
-      if node.count <= CONF.min_count:
+      if count <= CONF.min_count:
         return False
     if CONF.min is not None:
-      return node.count/float(self.count) > CONF.min/float(100)
+      return count/float(self.count[node]) > CONF.min/float(100)
     else:
       raise ValueError('Either --min-count or --min should be set')
 
-  # pylint: disable=dangerous-default-value
-  # for each append, I made sure there is a pop, so no worries. Not re-entrant!
-  def Traverse(self, path=[], depth=0, pcount=None):
-    percent = None if pcount is None else (100 * self.count / float(pcount))
-    yield path, self.count, percent
-    if depth < CONF.depth:
-      depth += 1
-      for name, child in sorted(self.items(),
-                                key=lambda e: -e[1].count)[:CONF.max_siblings]:
-        if self.BigEnough(child):
-          path.append(name)
-          for d in child.Traverse(path, depth, self.count):
-            yield d
+  def ShownChildren(self, node):
+    """The children of node displayed: largest first, and big enough."""
+    children = sorted(self.Children(node), key=lambda c: -self.count[c])
+    return [c for c in children[:CONF.max_siblings] if self.BigEnough(node, c)]
+
+  def Traverse(self):
+    """Yields (path, count, percent of the parent count), depth first."""
+    yield [], self.count[self.ROOT], None
+    path = []
+    stack, parents = [], []
+    if CONF.depth > 0:
+      stack.append(iter(self.ShownChildren(self.ROOT)))
+      parents.append(self.ROOT)
+    while stack:
+      node = next(stack[-1], None)
+      if node is None:
+        stack.pop()
+        parents.pop()
+        if path:
           path.pop()
+        continue
+      path.append(self.Name(node))
+      yield path, self.count[node], 100 * self.count[node] / float(
+          self.count[parents[-1]])
+      if len(stack) < CONF.depth:
+        stack.append(iter(self.ShownChildren(node)))
+        parents.append(node)
+      else:
+        path.pop()
+
+  def Map(self, other):
+    """Returns, for each node of self, the same directory's node in other.
+
+    The index is -1 when the directory is not in other.
+    """
+    mapping = array.array('l', [-1]) * len(self)
+    mapping[self.ROOT] = other.ROOT
+    for i in xrange(1, len(self)):
+      parent = mapping[self.parent[i]]
+      name = other.name_ids.get(self.names[self.segment[i]])
+      if parent != -1 and name is not None:
+        mapping[i] = other.child_ids.get(parent << 32 | name, -1)
+    return mapping
+
+  def Depths(self):
+    depths = array.array('l', [0]) * len(self)
+    for i in xrange(1, len(self)):
+      depths[i] = depths[self.parent[i]] + 1
+    return depths
+
+  def Path(self, node):
+    path = []
+    while node != self.ROOT:
+      path.append(self.Name(node))
+      node = self.parent[node]
+    return '/'.join(reversed(path))
+
+  def Growth(self, previous, max_depth):
+    """Yields (count difference, path) for the directories which changed.
+
+    Only directories up to max_depth are compared, the new directories and
+    the ones which disappeared since previous are included.
+    """
+    mapping = self.Map(previous)
+    depths = self.Depths()
+    for i in xrange(1, len(self)):
+      if depths[i] > max_depth:
+        continue
+      before = previous.count[mapping[i]] if mapping[i] != -1 else 0
+      if self.count[i] != before:
+        yield self.count[i] - before, self.Path(i)
+    mapping = previous.Map(self)
+    depths = previous.Depths()
+    for i in xrange(1, len(previous)):
+      if depths[i] <= max_depth and mapping[i] == -1:
+        yield -previous.count[i], previous.Path(i)
+
+  def Page(self, node, top):
+    """The top largest children of node, and the count of the others.
+
+    This is what the browser visualization fetches when a directory is
+    expanded. The others are the smaller children, and the URLs in the
+    directory itself or deeper than --depth-parsed.
+    """
+    children = self.Children(node)
+    shown = heapq.nlargest(top, children, key=lambda c: self.count[c])
+    out = {'id': node,
+           'name': self.Name(node),
+           'count': self.count[node],
+           'children': [{'id': c,
+                         'name': self.Name(c),
+                         'count': self.count[c],
+                         'leaf': not self.Children(c)} for c in shown]}
+    others = self.count[node] - sum(self.count[c] for c in shown)
+    if others:
+      out['others'] = {'dirs': len(children) - len(shown), 'count': others}
+    return out
 
   def Format(self):
     gen = self.Traverse()
@@ -321,12 +573,134 @@ class Node(dict):
     return '\n'.join(self.Format())
 
   def Json(self, name='root'):
-    out = {'name': name}
-    if self:
-      out['children'] = [v.Json(k) for k, v in self.items()]
-    else:
-      out['count'] = self.count
-    return out
+    """The nested {name, children} or {name, count} dicts of the tree."""
+    out = [{'name': self.Name(i, name)} for i in xrange(len(self))]
+    for i in xrange(1, len(self)):
+      out[self.parent[i]].setdefault('children', []).append(out[i])
+    for i, node in enumerate(out):
+      if 'children' not in node:
+        node['count'] = self.count[i]
+    return out[self.ROOT]
+
+  def Serialize(self):
+    """A compact JSON string of the arrays, to store the tree.
+
+    The nested form of Json() repeats the keys and the shared directory
+    names for every node. This form holds the interned names and one
+    array per attribute, and is turned back into a tree by Deserialize.
+    """
+    return json.dumps({'names': self.names,
+                       'parent': self.parent.tolist(),
+                       'segment': self.segment.tolist(),
+                       'count': self.count.tolist()},
+                      separators=(',', ':'))
+
+  @classmethod
+  def Deserialize(cls, data):
+    data = json.loads(data)
+    tree = cls()
+    tree.names = data['names']
+    tree.name_ids = dict((n, i) for (i, n) in enumerate(tree.names))
+    tree.parent = array.array('l', data['parent'])
+    tree.segment = array.array('l', data['segment'])
+    tree.count = array.array('l', data['count'])
+    for i in xrange(1, len(tree)):
+      tree.child_ids[tree.parent[i] << 32 | tree.segment[i]] = i
+    return tree
+
+
+class SpilledGroups(object):
+  """Groups URLs by a key, like a defaultdict(list), in temporary files.
+
+  The (key, URL) pairs are appended to one of CONF.partitions files,
+  chosen by a hash of the key. All the URLs of a key end up in the same
+  file, so the groups can be rebuilt one file at a time: the memory used
+  is the size of one partition, not of the whole list of URLs.
+  """
+
+  def __init__(self):
+    self.dirs = [tempfile.mkdtemp(prefix='license_exceeded-')]
+    self.paths = [[os.path.join(self.dirs[0], '%04d' % i)]
+                  for i in range(CONF.partitions)]
+    self.files = None
+    atexit.register(self.Cleanup)
+    # Worker processes exit without running the atexit functions: the
+    # files they spilled are removed by the parent, after Merge.
+
+  def __getstate__(self):
+    return {'dirs': self.dirs, 'paths': self.paths}
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.files = None
+    atexit.register(self.Cleanup)
+
+  def Add(self, key, url):
+    if self.files is None:
+      self.files = [open(paths[0], 'ab') for paths in self.paths]
+    self.files[zlib.crc32(key) % len(self.files)].write(
+        '%s\t%s\n' % (key, url))
+
+  def Close(self):
+    """Flushes the files, needed before reading or pickling."""
+    if self.files is not None:
+      for f in self.files:
+        f.close()
+      self.files = None
+
+  def Merge(self, other):
+    """Adds the groups spilled by other, built on other URLs."""
+    other.Close()
+    self.dirs.extend(other.dirs)
+    for paths, other_paths in zip(self.paths, other.paths):
+      paths.extend(other_paths)
+
+  def itervalues(self):
+    """Yields the list of URLs of each key, one partition at a time."""
+    self.Close()
+    for paths in self.paths:
+      groups = collections.defaultdict(list)
+      for path in paths:
+        if not os.path.exists(path):
+          continue
+        with open(path, 'rb') as f:
+          for line in f:
+            key, url = line.rstrip('\n').split('\t', 1)
+            groups[key].append(url)
+      for urls in groups.itervalues():
+        yield urls
+
+  def Cleanup(self):
+    for d in self.dirs:
+      shutil.rmtree(d, ignore_errors=True)
+
+
+class DuplicateGroups(object):
+  """The groups of more than one URL, formatted as they are read."""
+
+  def __init__(self, groups):
+    self.groups = groups
+
+  def __iter__(self):
+    for urls in self.groups.itervalues():
+      if len(urls) > 1:
+        yield '\n'.join(urls)
+
+  def __nonzero__(self):
+    return any(True for _ in self)
+
+  def __str__(self):
+    return '\n\n'.join(self)
+
+  def Write(self, out):
+    """Writes the groups to out without building the full string."""
+    group = None
+    for i, group in enumerate(self):
+      if i:
+        out.write('\n\n')
+      out.write(group)
+    if group is not None:
+      out.write('\n')
 
 
 def Parse(fd, detailed_flag):
@@ -341,20 +715,19 @@ def Parse(fd, detailed_flag):
 
   counters = Counters()
   details = {
-      TOP_DIR: Node(),
-      # This is a dictionary of Node, recursively. Each node has a
-      # count of URLs "in the directory". Each node is also a
-      # dictionary, whose keys are the name of the childrens and the
-      # values are the Node having holding the count of the subtree
-
-      CASE: collections.defaultdict(list),
-      # This is a dictionary of list of strings. For each unique
-      # lowercase, this dict has a list of URLs that only differ per
+      TOP_DIR: Tree(),
+      # This is a tree of directories. Each node has a count of URLs
+      # "in the directory", see Tree.
+
+      CASE: SpilledGroups() if CASE in detailed_flag else {},
+      # This groups lists of strings by key. For each unique
+      # lowercase, this has a list of URLs that only differ per
       # their case sensitivity
 
-      PARAM_PERMUTATION: collections.defaultdict(list),
-      # This dict maps strings to list of strings. For each unique URL
-      # with regard to param permutation, this dict has a list of URLs
+      PARAM_PERMUTATION: (SpilledGroups() if PARAM_PERMUTATION in detailed_flag
+                          else {}),
+      # This groups lists of strings by key. For each unique URL
+      # with regard to param permutation, this has a list of URLs
       # that are duplicates (their URL parameters are in different
       # orders)
 
@@ -391,7 +764,7 @@ def Parse(fd, detailed_flag):
     counters.url += 1
 
     if PARAM_PERMUTATION in detailed_flag:
-      details['param-permutation'][url_with_params_sorted].append(l)
+      details[PARAM_PERMUTATION].Add(url_with_params_sorted, l)
     counters.url_sortedquery.add(url_with_params_sorted)
 
     counters.query.add(u.query)
@@ -409,7 +782,7 @@ def Parse(fd, detailed_flag):
     low = l.lower()
     counters.casei.add(low)
     if CASE in detailed_flag:
-      details[CASE][low].append(l)
+      details[CASE].Add(low, l)
 
     for k, v in keyvals:
       counters.key.add(k)
@@ -420,6 +793,78 @@ def Parse(fd, detailed_flag):
   return counters, details
 
 
+def MergeDetails(details, other):
+  """Adds the details returned by another Parse call to details."""
+  details[TOP_DIR].Merge(other[TOP_DIR])
+  for flag in (CASE, PARAM_PERMUTATION):
+    if other[flag]:
+      details[flag].Merge(other[flag])
+  for k, hll in other[UNIQUE_PARAM_VALUE].iteritems():
+    details[UNIQUE_PARAM_VALUE][k].update(hll)
+
+
+def ParseWorker(batches, results, detailed_flag):
+  """Parses the batches of URLs of a queue until None is found.
+
+  This is run in a worker process, the counters and details are sent
+  back to the parent process through the results queue.
+  """
+  counters, details = Parse(
+      itertools.chain.from_iterable(iter(batches.get, None)), detailed_flag)
+  # defaultdict can not be pickled when their default is a lambda.
+  details[UNIQUE_PARAM_VALUE] = dict(details[UNIQUE_PARAM_VALUE])
+  for flag in (CASE, PARAM_PERMUTATION):
+    if details[flag]:
+      details[flag].Close()
+  results.put((counters, details))
+
+
+def ParseParallel(fd, detailed_flag, processes, batch_size=10000):
+  """Same as Parse, but the URLs are sharded across worker processes.
+
+  The parent process only reads the lines and hands them out in batches
+  to the workers. Each worker builds its own counters and tree, which are
+  merged when all the lines have been read: HyperLogLog sketches merge
+  without loss, as do the trees of counts.
+  """
+  batches = multiprocessing.Queue(2 * processes)
+  # The queue is bounded so that reading the input waits for the workers
+  results = multiprocessing.Queue()
+  workers = [multiprocessing.Process(target=ParseWorker,
+                                     args=(batches, results, detailed_flag))
+             for _ in range(processes)]
+  for w in workers:
+    w.daemon = True
+    w.start()
+
+  while True:
+    batch = list(itertools.islice(fd, batch_size))
+    if not batch:
+      break
+    batches.put(batch)
+  for _ in workers:
+    batches.put(None)
+
+  counters, details = results.get()
+  unique_param_value = collections.defaultdict(Counters.hll)
+  unique_param_value.update(details[UNIQUE_PARAM_VALUE])
+  details[UNIQUE_PARAM_VALUE] = unique_param_value
+  for _ in workers[1:]:
+    other_counters, other_details = results.get()
+    counters.Merge(other_counters)
+    MergeDetails(details, other_details)
+  for w in workers:
+    w.join()
+  return counters, details
+
+
+def ParseInput(fd, detailed_flag):
+  """Calls Parse, or ParseParallel when --processes is larger than 1."""
+  if CONF.processes > 1:
+    return ParseParallel(fd, detailed_flag, CONF.processes)
+  return Parse(fd, detailed_flag)
+
+
 def Wrap(string):
   return textwrap.fill(
       string, 80, initial_indent='  ', subsequent_indent='  ')
@@ -500,8 +945,8 @@ class ParamPermutation(object):
 
           '- The script shows the number of URLs which are duplicate '
           'only for their URL parameters. The script can additionaly show '
-          'the URL paths and the number of duplicates (not the default, this '
-          'can hog the memory for large list of URLs) and the parameters '
+          'the URL paths and the number of duplicates (not the default, the '
+          'URLs are spilled to temporary files to do so) and the parameters '
           'involved in the permutations. '
           'This is the option --param_permutation.\n'
 
@@ -520,9 +965,7 @@ class ParamPermutation(object):
   def __init__(self, counters, details):
     less = (counters.url - len(counters.url_sortedquery)) * 100 / counters.url
 
-    self.details = '\n\n'.join(
-        '\n'.join(v)
-        for v in details.itervalues() if len(v) > 1)
+    self.details = DuplicateGroups(details)
 
     if less > 5:
       self.status = 'warn' if less < 15 else 'fail'
@@ -555,8 +998,7 @@ class Case(object):
   def __init__(self, counters, details):
     percent_dup = (counters.url - len(counters.casei)) * 100 / counters.url
 
-    self.details = '\n\n'.join(
-        '\n'.join(v) for v in details.itervalues() if len(v) > 1)
+    self.details = DuplicateGroups(details)
 
     if percent_dup > 2:
       self.status = 'fail' if percent_dup > 10 else 'warn'
@@ -626,7 +1068,8 @@ class TopDir(object):
   hint = ('The customer can decide whether some of the large directories '
           'really are relevant or whether they should be discarded '
           'with by setting "Do Not Follow Patterns" in Content Sources '
-          '> Web Crawl > Start and Block URLs.')
+          '> Web Crawl > Start and Block URLs. The effect of the patterns '
+          'can be checked beforehand with --block-patterns.')
 
   example = ('100% 1,000,005  content.com/\n'
              ' 97%   970,003  content.com/webapp\n'
@@ -648,6 +1091,274 @@ actions = {
     'case': Case}
 
 
+class Growth(object):
+  """Compares this run with the counts saved by a previous run, --state."""
+
+  TOP = 20
+  # The number of directories and parameters listed, largest change first.
+
+  STATUS_ORDER = ['pass', 'see info', 'warn', 'fail']
+
+  @staticmethod
+  def Save(path, counters, details):
+    state = {'error': CONF.error,
+             'counters': counters.State(),
+             'params': dict((k, Counters.EncodeHll(v))
+                            for (k, v) in details[UNIQUE_PARAM_VALUE].items()),
+             'tree': details[TOP_DIR].Serialize()}
+    # Write then rename, so that an interrupted run keeps the old state.
+    with open(path + '.tmp', 'w') as f:
+      json.dump(state, f)
+    os.rename(path + '.tmp', path)
+
+  @staticmethod
+  def Load(path):
+    """Returns the counters and details saved in path, or None."""
+    if not os.path.exists(path):
+      return None
+    with open(path) as f:
+      state = json.load(f)
+    if state['error'] != CONF.error:
+      print 'Ignoring %s: saved with a different error rate.' % path
+      return None
+    details = {TOP_DIR: Tree.Deserialize(state['tree']),
+               UNIQUE_PARAM_VALUE: dict(
+                   (k, Counters.DecodeHll(v))
+                   for (k, v) in state['params'].iteritems())}
+    return Counters.FromState(state['counters']), details
+
+  @staticmethod
+  def Duplicates(counters):
+    """The rows compared between two runs: (name, count, percent)."""
+    def Row(name, count):
+      # The HyperLogLog estimates may exceed the exact count of URLs
+      count = max(0, count)
+      return name, count, count * 100.0 / max(counters.url, 1)
+    return [
+        Row('Duplicates by URL parameter permutations',
+            counters.url - len(counters.url_sortedquery)),
+        Row('Duplicates by case', counters.url - len(counters.casei)),
+        Row('Distinct URL parameter values', len(counters.val)),
+        Row('Distinct URL parameter names', len(counters.key))]
+
+  @staticmethod
+  def PrintChanges(previous, counters, details):
+    prev_counters, prev_details = previous
+    print '====== Changes since the previous run (--state %s)' % CONF.state
+    print '  Total num of URLs: %s -> %s (%+d)\n' % (
+        prev_counters.url, counters.url, counters.url - prev_counters.url)
+
+    print '  %-42s %16s %16s' % ('Check', 'before', 'now')
+    for (name, before, before_pc), (_, now, now_pc) in zip(
+        Growth.Duplicates(prev_counters), Growth.Duplicates(counters)):
+      print '  %-42s %10s (%4.1f%%) %10s (%4.1f%%)%s' % (
+          name, before, before_pc, now, now_pc,
+          # Below the error rate of the sketches, this is likely noise.
+          ' worse' if now_pc > before_pc + CONF.error else '')
+    for check in (ParamPermutation, Case):
+      before = check(prev_counters, {}).status
+      now = check(counters, {}).status
+      if (Growth.STATUS_ORDER.index(now) >
+          Growth.STATUS_ORDER.index(before)):
+        print '  Got worse: %s (%s -> %s)' % (check.title, before, now)
+
+    print '\n  Directories with the largest change (--depth %s):' % CONF.depth
+    changes = heapq.nlargest(
+        Growth.TOP, details[TOP_DIR].Growth(prev_details[TOP_DIR], CONF.depth),
+        key=lambda c: abs(c[0]))
+    for delta, path in changes:
+      print '  %+11d %s' % (delta, path)
+    if not changes:
+      print '  None'
+
+    print '\n  URL parameters with the largest change of distinct values:'
+    params = details[UNIQUE_PARAM_VALUE]
+    prev_params = prev_details[UNIQUE_PARAM_VALUE]
+    def Distinct(hlls, k):
+      return len(hlls[k]) if k in hlls else 0
+    changes = heapq.nlargest(
+        Growth.TOP,
+        ((Distinct(params, k) - Distinct(prev_params, k), k)
+         for k in set(params).union(prev_params)),
+        key=lambda c: abs(c[0]))
+    changes = [(delta, k) for (delta, k) in changes if delta]
+    for delta, k in changes:
+      print '  %+11d %s' % (delta, k)
+    if not changes:
+      print '  None'
+    print
+
+
+class PatternMatcher(object):
+  """Matches URLs against many GSA URL patterns at once.
+
+  The patterns are sorted by kind, and each kind has its own index, so
+  that the cost per URL does not grow with the number of patterns:
+
+  - ^http://host/dir/ and http://host/dir/ (prefixes): a trie, walked
+    once along the URL,
+  - ^http://host/file$ (exact URLs): a dict,
+  - .pdf$ (suffixes): str.endswith with all of them, then a dict,
+  - host.com/dir/ (domains): a dict of the host and its parent domains,
+  - /dir/, contains:string (substrings) and regexp:, regexpCase:,
+    regexpIgnoreCase: (regular expressions): one combined regular
+    expression each, only URLs matching it are tested pattern per pattern.
+
+  Lines starting with # are comments.
+  """
+
+  def __init__(self, lines):
+    self.patterns = []
+    self.trie = {}
+    self.exact = collections.defaultdict(list)
+    self.suffixes = collections.defaultdict(list)
+    self.domains = collections.defaultdict(list)
+    self.substrings = []
+    self.regexps = collections.defaultdict(list)
+    # Maps the re flags to the list of (compiled regexp, index)
+    for line in lines:
+      line = line.strip()
+      if line and not line.startswith('#'):
+        self.AddPattern(line)
+    self.suffix_tuple = tuple(self.suffixes)
+    self.filters = []
+    # (combined regexp, [(test, index)]): the tests are only run when the
+    # combined regexp matches.
+    if self.substrings:
+      self.filters.append((
+          re.compile(self.TrieRegexp(sub for (sub, _) in self.substrings)),
+          [(lambda url, sub=sub: sub in url, i) for (sub, i) in
+           self.substrings]))
+    for flags, regexps in self.regexps.items():
+      self.filters.append((
+          self.Combine([r.pattern for (r, _) in regexps], flags),
+          [(r.search, i) for (r, i) in regexps]))
+
+  @staticmethod
+  def TrieRegexp(literals):
+    """A regexp matching when one of the literals is found.
+
+    An alternation of hundreds of literals is tried branch by branch at
+    each position of the URL. The alternation is factored in a trie
+    instead, "/a/b/|/a/c/" becomes "/a/(?:b|c)/", so that most positions
+    are rejected on the first character.
+    """
+    trie = {}
+    for literal in literals:
+      node = trie
+      for c in literal:
+        if None in node:
+          break  # a shorter literal already matches
+        node = node.setdefault(c, {})
+      node.clear()
+      node[None] = True
+
+    def Emit(node):
+      if None in node:
+        return ''
+      alts = [re.escape(c) + Emit(child) for (c, child) in sorted(node.items())]
+      if len(alts) == 1:
+        return alts[0]
+      return '(?:%s)' % '|'.join(alts)
+    return Emit(trie)
+
+  @staticmethod
+  def Combine(regexps, flags):
+    """A regexp matching when one of regexps matches, None if it fails."""
+    try:
+      return re.compile('|'.join('(?:%s)' % r for r in regexps), flags)
+    except (re.error, OverflowError, AssertionError):
+      # Back references or too many groups: every pattern will be tried.
+      return None
+
+  def AddPattern(self, pattern):
+    i = len(self.patterns)
+    self.patterns.append(pattern)
+    for prefix, flags in (('regexpIgnoreCase:', re.IGNORECASE),
+                          ('regexpCase:', 0),
+                          ('regexp:', 0)):
+      if pattern.startswith(prefix):
+        self.regexps[flags].append((re.compile(pattern[len(prefix):], flags),
+                                    i))
+        return
+    if pattern.startswith('contains:'):
+      self.substrings.append((pattern[len('contains:'):], i))
+    elif pattern.startswith('^') and pattern.endswith('$'):
+      self.exact[pattern[1:-1]].append(i)
+    elif pattern.startswith('^') or '://' in pattern:
+      node = self.trie
+      for c in pattern.lstrip('^'):
+        node = node.setdefault(c, {})
+      node.setdefault(None, []).append(i)
+      # The None key holds the patterns ending at this node.
+    elif pattern.endswith('$'):
+      self.suffixes[pattern[:-1]].append(i)
+    elif not pattern.startswith('/') and '/' in pattern:
+      host, path = pattern.split('/', 1)
+      self.domains[host.lower()].append(('/' + path, i))
+    else:
+      self.substrings.append((pattern, i))
+
+  def Match(self, url):
+    """Returns the indexes of the patterns matching url."""
+    matches = []
+    node = self.trie
+    for c in url:
+      node = node.get(c)
+      if node is None:
+        break
+      if None in node:
+        matches.extend(node[None])
+    if url in self.exact:
+      matches.extend(self.exact[url])
+    if self.suffix_tuple and url.endswith(self.suffix_tuple):
+      for suffix in self.suffix_tuple:
+        if url.endswith(suffix):
+          matches.extend(self.suffixes[suffix])
+    if self.domains:
+      elems = url.split('/', 3)
+      if len(elems) > 2:
+        host = elems[2].lower()
+        path = '/' + elems[3] if len(elems) > 3 else '/'
+        while host:
+          for prefix, i in self.domains.get(host, ()):
+            if path.startswith(prefix):
+              matches.append(i)
+          host = host.partition('.')[2]
+    for combined, tests in self.filters:
+      if combined is None or combined.search(url):
+        matches.extend(i for (test, i) in tests if test(url))
+    return matches
+
+
+def SimulatePatterns(fd, matcher):
+  """Prints how many URLs each pattern of matcher removes from fd."""
+  total = removed = 0
+  matched = [0] * len(matcher.patterns)
+  only = [0] * len(matcher.patterns)
+  for url in fd:
+    total += 1
+    matches = matcher.Match(url)
+    if matches:
+      removed += 1
+      for i in set(matches):
+        matched[i] += 1
+      if len(set(matches)) == 1:
+        only[matches[0]] += 1
+
+  print 'Simulated %s patterns on %s URLs.\n' % (len(matcher.patterns), total)
+  print '  %11s %11s  %s' % ('#URLs', '#only this', 'pattern')
+  for i in sorted(range(len(matcher.patterns)), key=lambda i: -matched[i]):
+    print '  %11s %11s  %s' % (matched[i], only[i], matcher.patterns[i])
+  print
+  print Wrap('%s URLs (%s%%) are removed by at least one pattern. With all '
+             'these patterns set, the license count would be %s instead of '
+             '%s. "#only this" is the number of URLs removed by no other '
+             'pattern: the URLs back in the index if this pattern is not set.'
+             % (removed, removed * 100 / max(total, 1), total - removed,
+                total))
+
+
 class ServeViz(BaseHTTPRequestHandler):
 
   index = """<!DOCTYPE html>
@@ -697,28 +1408,59 @@ var arc = d3.svg.arc()
     .innerRadius(function(d) { return Math.sqrt(d.y); })
     .outerRadius(function(d) { return Math.sqrt(d.y + d.dy); });
 
-d3.json("url.json", function(error, root) {
-  var path = svg.datum(root).selectAll("path")
-      .data(partition.nodes)
-    .enter().append("path")
+var value = function() { return 1; };
+
+// The tree is fetched one directory at a time: children?node=<id>
+// returns the largest children of a directory and the count of the
+// URLs in the others. Clicking on a directory fetches its children.
+function load(d, callback) {
+  d3.json("children?node=" + d.id, function(error, data) {
+    if (error) return;
+    d.children = data.children;
+    if (data.others) {
+      d.children.push({name: "(" + data.others.dirs + " others)",
+                       key: d.id + "-others", count: data.others.count,
+                       leaf: true});
+    }
+    callback();
+  });
+}
+
+var root = {id: 0, name: "root"};
+
+function draw() {
+  var path = svg.selectAll("path")
+      .data(partition.value(value).nodes(root),
+            function(d) { return d.key || d.id; });
+  path.enter().append("path")
       .attr("display", function(d) { return d.depth ? null : "none"; }) // hide inner ring
-      .attr("d", arc)
       .style("stroke", "#fff")
-      .style("fill", function(d) { return color((d.children ? d : d.parent).name); })
       .style("fill-rule", "evenodd")
-      .each(stash);
-
-  d3.selectAll("input").on("change", function change() {
-    var value = this.value === "count"
-        ? function() { return 1; }
-        : function(d) { return d.count; };
-
-    path
-        .data(partition.value(value).nodes)
-      .transition()
-        .duration(1500)
-        .attrTween("d", arcTween);
-  });
+      .on("click", function(d) {
+        if (!d.leaf && !d.children) load(d, draw);
+      })
+      .append("title");
+  path.exit().remove();
+  path.style("fill", function(d) { return color((d.children ? d : d.parent).name); })
+      .attr("d", arc)
+      .each(stash)
+    .select("title")
+      .text(function(d) { return d.name + ": " + d.count + " URLs"; });
+}
+
+load(root, draw);
+
+d3.selectAll("input").on("change", function change() {
+  value = this.value === "count"
+      ? function() { return 1; }
+      : function(d) { return d.count; };
+
+  svg.selectAll("path")
+      .data(partition.value(value).nodes(root),
+            function(d) { return d.key || d.id; })
+    .transition()
+      .duration(1500)
+      .attrTween("d", arcTween);
 });
 
 // Stash the old values for transition.
@@ -746,17 +1488,33 @@ d3.select(self.frameElement).style("height", height + "px");
 </html>
 """
 
+  pages = {}
+  # The tree does not change once parsed: the children of a directory
+  # are computed on the first request only.
+
   def do_GET(self):   # pylint: disable=invalid-name
     if self.path == '/':
       self.send_response(200)
       self.send_header('Content-Type', 'text/html')
       self.end_headers()
       self.wfile.write(self.index)
-    elif self.path == '/url.json':
+    elif self.path.startswith('/children?'):
+      tree = self.details[TOP_DIR]
+      query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+      try:
+        node = int(query['node'][0])
+        if not 0 <= node < len(tree):
+          raise ValueError(node)
+      except (KeyError, ValueError):
+        self.send_response(404)
+        self.end_headers()
+        return
+      if node not in self.pages:
+        self.pages[node] = json.dumps(tree.Page(node, CONF.max_siblings))
       self.send_response(200)
       self.send_header('Content-Type', 'application/json')
       self.end_headers()
-      self.wfile.write(json.dumps(self.details[TOP_DIR].Json()))
+      self.wfile.write(self.pages[node])
     else:
       self.send_response(404)
       self.end_headers()
@@ -796,18 +1554,24 @@ def main():
 
   detailed_flag = [k for k in actions if getattr(CONF, k.replace('-', '_'))]
 
-  if detailed_flag:
+  if CONF.block_patterns:
+    with open(CONF.block_patterns) as f:
+      matcher = PatternMatcher(f)
+    SimulatePatterns(gen, matcher)
+  elif detailed_flag:
     if CONF.depth is None:
       CONF.depth = 8
-    counters, details = Parse(gen, detailed_flag)
+    counters, details = ParseInput(gen, detailed_flag)
     flag = detailed_flag[0]
     out = actions[flag](counters, details[flag]).details
-    if out:
+    if isinstance(out, DuplicateGroups):
+      out.Write(sys.stdout)
+    elif out:
       print out
   elif CONF.browser:
     if CONF.depth is None:
       CONF.depth = 8
-    counters, ServeViz.details = Parse(gen, [TOP_DIR])
+    counters, ServeViz.details = ParseInput(gen, [TOP_DIR])
 
     httpd, port = ServeViz.Bind()
     url = 'http://%s:%s/' % (platform.node(), port)
@@ -829,8 +1593,13 @@ def main():
     if CONF.depth is None:
       CONF.depth = 1
     detailed_flag.extend([TOP_DIR, UNIQUE_PARAM_VALUE])
-    counters, details = Parse(gen, detailed_flag)
+    counters, details = ParseInput(gen, detailed_flag)
     Report.PrintChecks(actions, counters, details)
+    if CONF.state:
+      previous = Growth.Load(CONF.state)
+      if previous:
+        Growth.PrintChanges(previous, counters, details)
+      Growth.Save(CONF.state, counters, details)
 
   if CONF.json:
     with open('url.json', 'w') as f:
@@ -33,6 +33,7 @@ Features
  + crawls as anonymous (guest) or authenticated user.
  + accepts following URL formats: \\\\filer\\share\\ [smb:|unc:]//filer/share/
  + accepts URLs from XML Sitemaps, CSV, plain text files (and partial content)
+   XML Sitemaps may be gzipped, or sitemap indexes
  + reports mismatch between file size on directory listing and readable size (*)
  + writes in plain text, CSV and XML Sitemap (**)
  + allows to limit directory depth
@@ -77,6 +78,18 @@ Examples
  - Take all URLs from XML sitemap and save unreachable ones:
    $ smbcrawler -I sitemap.xml -O unreachable.txt -G unreachable
 
+ - Crawl with 8 threads, no more than 4 at the same time on each server:
+   $ smbcrawler --threads 8 --perserver 4 smb://filer/share/ smb://host/share/
+
+ - Validate a share every night, reading only new and changed files:
+   $ smbcrawler --index docs.index -O unreachable.txt -G unreachable \
+   > smb://filer/docs/
+
+ - Record the progress of a long crawl, and resume it once interrupted:
+   $ smbcrawler --checkpoint crawl.journal -O report.csv smb://filer/share/
+   $ smbcrawler --checkpoint crawl.journal --resume -O report.csv \
+   > smb://filer/share/
+
 Known issues
   None yet, feel free to report issues or feature requests to
   https://github.com/google/gsa-admin-toolkit/issues
@@ -87,14 +100,22 @@ This script is not supported by Google.
 __pychecker__ = "no-argsused no-classattr"
 
 
-import commands
+import array
+import collections
 import datetime
 import getopt
 import getpass
 import os
 import re
+import StringIO
+import subprocess
 import sys
+import threading
+import time
 import urllib
+import urllib2
+import urlparse
+import zlib
 from xml.parsers import expat
 from xml.sax import saxutils
 
@@ -106,7 +127,8 @@ COMMAND_OPTIONS_WITH_SHORTCUTS = [
     "output=", "password=", "groups=", "maxdepth=", "client="]
 COMMAND_OPTIONS_WITHOUT_SHORTCUT = [
     "iformat=", "ilines=", "ifield=", "isep=", "iquot=", "oformat=", "olines=",
-    "ofield=", "osep=", "oquot="]
+    "ofield=", "osep=", "oquot=", "threads=", "perserver=", "order=",
+    "session", "checkpoint=", "resume", "index="]
 COMMAND_OPTIONS = (COMMAND_OPTIONS_WITH_SHORTCUTS +
                    COMMAND_OPTIONS_WITHOUT_SHORTCUT)
 DEFAULT_CSV_FIELD = 1
@@ -121,10 +143,24 @@ DEFAULT_OPTIONS = {
     "ofield": DEFAULT_CSV_FIELD,
     "osep": DEFAULT_CSV_SEPARATOR,
     "oquot": DEFAULT_CSV_QUOTATION,
-    "client": "smbclient"
+    "client": "smbclient",
+    "threads": 1,
+    "perserver": 0,
+    "order": "dfs"
 }
 SHORT_MONTH_NAMES = ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
                      "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+MONTH_NUMBERS = dict(
+    [(name, i + 1) for i, name in enumerate(SHORT_MONTH_NAMES)])
+# DOS attributes at the end of a smbclient directory listing entry
+ATTRIBUTES_REGEX = re.compile("^(A|H|S)(A|H|S)?(A|H|S)?$")
+# Prompts printed by an interactive smbclient before reading a command
+PROMPT_REGEX = re.compile(r"^(smb: \\[^>]*> )+")
+# Seconds between two flushes of the --checkpoint journal to disk
+CHECKPOINT_INTERVAL = 30
+# Bytes of XML Sitemap read and parsed at a time
+SITEMAP_CHUNK_SIZE = 64 * 1024
+GZIP_MAGIC = "\x1f\x8b"
 USAGE_TEXT = """Usage %s [OPTIONS] [[smb:|unc:]//server/share/path/to/file]
 
   -C,--client: smbclient, smbhelper or full path to binary
@@ -155,6 +191,19 @@ USAGE_TEXT = """Usage %s [OPTIONS] [[smb:|unc:]//server/share/path/to/file]
         notfound - returned NT_STATUS_OBJECT_NAME_NOT_FOUND
         others - returned any other NT_STATUS message
   -M,--maxdepth: limit directory depth, relative to share root
+     --threads: number of paths crawled at the same time (default to 1)
+     --perserver: limit the paths crawled at the same time on a file server
+                  (default to 0, no limit other than --threads)
+     --order: dfs (depth-first, default) or bfs (breadth-first) crawl order
+     --session: keep one smbclient running per share and thread, and send it
+                all the commands, instead of one smbclient (and one login)
+                per path. Not available with smbhelper.
+     --checkpoint: journal file recording the progress of the crawl
+     --resume: resume the crawl recorded in the --checkpoint journal, with
+               the same URLs to crawl, instead of starting over
+     --index: file keeping the date and size of the files read, so that the
+              next crawls with the same --index only read new and changed
+              files (directories are always listed)
   -D,--debug: verbosity level (0-5, default to 0)
   -h,--help: print this message\n
   -N,--noprompt: do not prompt for password\n
@@ -304,36 +353,111 @@ def UrlUnscape(url):
       "&apos;", "'").replace("&quot;", "\"")
 
 
+def EncodeTimestamp(timestamp):
+  """Encodes a datetime object to a string, for journal and index files.
+
+  Args:
+    timestamp: datetime object, or None.
+
+  Returns:
+    colon separated date and time fields, empty for None.
+  """
+
+  if timestamp is None:
+    return ""
+  return ":".join(map(str, (
+      timestamp.year, timestamp.month, timestamp.day, timestamp.hour,
+      timestamp.minute, timestamp.second, timestamp.microsecond)))
+
+
+def DecodeTimestamp(timestamp):
+  """Reverts EncodeTimestamp effect.
+
+  Args:
+    timestamp: colon separated date and time fields, or empty string.
+
+  Returns:
+    datetime object, None for an empty string.
+  """
+
+  if not timestamp:
+    return None
+  return datetime.datetime(*map(int, timestamp.split(":")))
+
+
 class SitemapParser(object):
-  """Parses XML Sitemaps but takes only URLs and ignores the rest."""
+  """Parses XML Sitemaps but takes only URLs and ignores the rest.
+
+  Iterating over the parser yields the URLs while the sitemap is read, in
+  chunks of SITEMAP_CHUNK_SIZE bytes.  Gzipped sitemaps are uncompressed on
+  the fly.  For a sitemap index, the URLs of the sitemaps it lists are
+  yielded in turn; relative locations are taken from the index directory.
+  """
 
   def __init__(self, input_file):
-    """Parses an input file."""
-    self.url = None
-    self.opentag = None
-    
+    """Prepares to parse a sitemap file or URL."""
+    self.input_file = input_file
+    self.loc = None
+    self.index = False
+
+  def __iter__(self):
+    locs = []
+
     def StartElement(name, attrs):
-      self.url = ""
-      self.opentag = name
+      name = name.split(":")[-1]
+      if name == "sitemapindex":
+        self.index = True
+      elif name == "loc":
+        self.loc = []
 
     def CharData(data):
-      if self.opentag == "loc":
-        self.url += data
+      if self.loc is not None:
+        self.loc.append(data)
 
     def EndElement(name):
-      if self.opentag == "loc":
-        self.urls.append(self.url)
-      self.opentag = None
-    self.urls = []
-    self.p = expat.ParserCreate()
-    self.p.StartElementHandler = StartElement
-    self.p.CharacterDataHandler = CharData
-    self.p.EndElementHandler = EndElement
-    fd = open(input_file, "r")
-    data = fd.read()
-    self.p.Parse(data, 1)
+      if self.loc is not None and name.split(":")[-1] == "loc":
+        locs.append("".join(self.loc).strip())
+        self.loc = None
+    p = expat.ParserCreate()
+    p.StartElementHandler = StartElement
+    p.CharacterDataHandler = CharData
+    p.EndElementHandler = EndElement
+    fd = self.Open(self.input_file)
+    decompressor = None
+    chunk = fd.read(SITEMAP_CHUNK_SIZE)
+    if chunk[:2] == GZIP_MAGIC:
+      decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+      data = chunk
+      if decompressor is not None:
+        data = decompressor.decompress(chunk)
+        if not chunk:
+          data += decompressor.flush()
+      p.Parse(data, not chunk)
+      for loc in locs:
+        if self.index:
+          for url in SitemapParser(self.Resolve(loc)):
+            yield url
+        else:
+          yield loc
+      del locs[:]
+      if not chunk:
+        break
+      chunk = fd.read(SITEMAP_CHUNK_SIZE)
     fd.close()
 
+  def Open(self, name):
+    """Opens a sitemap from a local file or an URL."""
+    if re.match("^[a-z]+://", name):
+      return urllib2.urlopen(name)
+    return open(name, "rb")
+
+  def Resolve(self, loc):
+    """Returns the location of a sitemap listed in this sitemap index."""
+    if re.match("^[a-z]+://", loc) or re.match("^[a-z]+://", self.input_file):
+      return urlparse.urljoin(self.input_file, loc)
+    return os.path.join(os.path.dirname(self.input_file), loc)
+
 
 class Config(object):
   """Parses and keeps flags-driven configuration."""
@@ -432,16 +556,16 @@ class Config(object):
           self.oformat = ext
         else:
           self.oformat = "csv"
-    # Convert lines ranges to sequence
+    # Convert lines ranges to set
     for attr in ("ilines", "olines"):
       if self.__getattribute__(attr) is not None:
-        lines = []
+        lines = set()
         for token in self.__getattribute__(attr).split(","):
           numbers = map(int, token.split("-"))
           if len(numbers) == 1:
-            lines.append(numbers[0])
+            lines.add(numbers[0])
           elif len(numbers) == 2:
-            lines.extend(range(numbers[0], 1 + numbers[1]))
+            lines.update(range(numbers[0], 1 + numbers[1]))
           else:
             print ("\nBad range for --lines option: %s\n" %
                    self.__getattribute__(attr))
@@ -471,6 +595,16 @@ class Config(object):
     # Show debug info
     self.debug = int(self.debug)
     self.maxdepth = int(self.maxdepth)
+    self.threads = int(self.threads)
+    self.perserver = int(self.perserver)
+    if self.order not in ("dfs", "bfs"):
+      print "\nBad crawl order: %s, use dfs or bfs\n" % self.order
+      print Usage()
+      sys.exit(1)
+    if self.resume and self.checkpoint is None:
+      print "\nMissing --checkpoint journal to resume from\n"
+      print Usage()
+      sys.exit(1)
     if self.debug > 3:
       for option in COMMAND_OPTIONS:
         option = option.split("=")[0]
@@ -492,38 +626,51 @@ class Config(object):
       shares: List of Share objects.
     """
 
-    shares = []
-    urls = self.args
+    return list(self.IterShares())
+
+  def Urls(self):
+    """Yields the URLs to crawl, from arguments then from the input file.
+
+    The input file is read as the URLs are consumed, and no further than
+    the last of the --ilines.
+    """
 
-    # Extract URLs from input file
-    if self.input:
+    for url in self.args:
+      yield url
+    if not self.input:
+      return
+    last_line = None
+    if self.ilines:
+      last_line = max(self.ilines)
+    if self.iformat == "xml":
+      lines = SitemapParser(self.input)
+    elif self.iformat in ("csv", "txt"):
+      lines = open(self.input, "r")
+    else:
+      print "\nBad format (%s) for input file '%s'\n" % (
+          self.iformat, self.input)
+      print Usage()
+      sys.exit(1)
+    line_counter = 0
+    for line in lines:
+      line_counter += 1
+      if last_line is not None and line_counter > last_line:
+        break
+      if self.ilines and line_counter not in self.ilines:
+        continue
       if self.iformat == "xml":
-        urls_from_xml = SitemapParser(self.input).urls
-        if self.ilines:
-          for i in range(len(urls_from_xml)):
-            if i + 1 in self.ilines:
-              urls.append(urls_from_xml[i])
-        else:
-          urls.extend(urls_from_xml)
-      elif self.iformat in ("csv", "txt"):
-        fd = open(self.input, "r")
-        line_counter = 1
-        for line in fd:
-          if not self.ilines or line_counter in self.ilines:
-            url = line.strip().split(self.isep)[self.ifield - 1]
-            if self.iquot:
-              url = url[len(self.iquot):-len(self.iquot)]
-            urls.append(UrlUnscape(url))
-          line_counter += 1
-        fd.close()
+        yield line
       else:
-        print "\nBad format (%s) for input file '%s'\n" % (
-            self.iformat, self.input)
-        print Usage()
-        sys.exit(1)
+        url = line.strip().split(self.isep)[self.ifield - 1]
+        if self.iquot:
+          url = url[len(self.iquot):-len(self.iquot)]
+        yield UrlUnscape(url)
+
+  def IterShares(self):
+    """Yields the shares to crawl, while reading the input file if any."""
 
     # Extract URLs from command line arguments and input files
-    for url in urls:
+    for url in self.Urls():
       hostname = None
       share = None
       filename = None
@@ -548,10 +695,9 @@ class Config(object):
       hostname = url[2:slash_1]
       share = url[slash_1 + 1: slash_2]
       filename = "/" + url[slash_2 + 1:]
-      shares.append(Share(hostname=hostname, share=share, filename=filename,
-                          domain=self.workgroup, username=self.username,
-                          password=self.password))
-    return shares
+      yield Share(hostname=hostname, share=share, filename=filename,
+                  domain=self.workgroup, username=self.username,
+                  password=self.password)
 
 
 class Share(object):
@@ -602,6 +748,9 @@ class Share(object):
 class Document(object):
   """Holds minimal info about a single file file for reporting purposes."""
 
+  __slots__ = ("share", "filename", "lastmod", "status", "real_size",
+               "list_size", "id")
+
   def __init__(self, share, filename=None, lastmod=None, status=None):
     self.share = share
     self.filename = filename
@@ -611,6 +760,7 @@ class Document(object):
     self.status = status
     self.real_size = None
     self.list_size = 0
+    self.id = None
 
   def __str__(self):
     return self.Url()
@@ -697,8 +847,82 @@ class Document(object):
       return ["unreachable"]
 
 
+class Bitset(object):
+  """Set of document ids, one bit per document."""
+
+  __slots__ = ("bits", "size")
+
+  def __init__(self):
+    self.bits = array.array("B")
+    self.size = 0
+
+  def __len__(self):
+    return self.size
+
+  def __contains__(self, i):
+    byte = i >> 3
+    return byte < len(self.bits) and bool(self.bits[byte] & (1 << (i & 7)))
+
+  def __iter__(self):
+    """Yields the ids in the set, in increasing order."""
+    for byte, bits in enumerate(self.bits):
+      if bits:
+        for bit in range(8):
+          if bits & (1 << bit):
+            yield (byte << 3) | bit
+
+  def Add(self, i):
+    byte = i >> 3
+    if byte >= len(self.bits):
+      # Grow geometrically, for constant amortized time
+      self.bits.extend([0] * max(byte + 1 - len(self.bits), len(self.bits)))
+    if not self.bits[byte] & (1 << (i & 7)):
+      self.bits[byte] |= 1 << (i & 7)
+      self.size += 1
+
+
+class ReportWriter(object):
+  """Writes report documents to a file in XML, CSV or plain text."""
+
+  def __init__(self, config):
+    self.config = config
+    self.fd = open(config.output, "w")
+    if config.oformat == "xml":
+      self.fd.write(
+          "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
+          "<urlset xmlns=\"http://www.google.com/schemas/sitemap/0.84\"\n"
+          "  xmlns:xsi=\"http://www.w3.org/2001/XMLSchema-instance\"\n"
+          "  xsi:schemaLocation=\"http://www.google.com/schemas/sitemap/0.84\n"
+          "  http://www.google.com/schemas/sitemap/0.84/sitemap.xsd\">\n")
+
+  def Write(self, doc):
+    config = self.config
+    url = doc.Url()
+    if config.oformat == "xml":
+      self.fd.write("  <url>\n    <loc>%s</loc>\n  </url>\n" % url)
+    elif config.oformat == "csv":
+      self.fd.write(config.osep.join(
+          ["%s%s%s" % (config.oquot, data, config.oquot) for data in (
+              saxutils.escape(url), doc.HttpStatus(), doc.list_size)]) + "\n")
+    elif config.oformat == "txt":
+      self.fd.write("%s\n" % url)
+    else:
+      raise Exception("This should never happen!")
+
+  def Close(self):
+    if self.config.oformat == "xml":
+      self.fd.write("</urlset>\n")
+    self.fd.close()
+
+
 class Report(object):
-  """Stores the result of crawling URLs."""
+  """Stores the result of crawling URLs.
+
+  Each document gets an id, its index in the docs list, and the groups of
+  documents (by status, zero-sized, size mismatch and status groups) are
+  kept as bitsets of ids.  Once opened for output, documents are written
+  as soon as they are crawled, rather than all of them when saving.
+  """
 
   def __init__(self):
     """Creates and empty report."""
@@ -706,56 +930,98 @@ class Report(object):
     self.groups_map = dict()
     self.status_map = dict()
     self.urls_map = dict()
-    self.zero_sized = []
-    self.size_mismatch = []
+    self.docs = []
+    self.zero_sized = Bitset()
+    self.size_mismatch = Bitset()
+    self.completed = Bitset()
+    # Crawler threads update the report concurrently
+    self.lock = threading.RLock()
+    # Journal recording the changes, if any
+    self.journal = None
+    # Writer of the documents crawled, once opened
+    self.writer = None
+    self.groups = None
 
   def __str__(self):
     """Prints the report in human-friendly format."""
 
-    output = "Successfully crawled documents:\n"
-    for doc in self.urls_map.values():
+    fd = StringIO.StringIO()
+    self.Print(fd)
+    return fd.getvalue()
+
+  def Urls(self, ids):
+    """Yields the URLs of a sequence of document ids."""
+    for i in ids:
+      yield self.docs[i].Url()
+
+  def Print(self, fd):
+    """Writes the report in human-friendly format to a file object."""
+
+    fd.write("Successfully crawled documents:\n")
+    for doc in self.docs:
       if doc.status is None and doc.real_size not in (0, None):
         if doc.IsFile():
-          output += " - %s  --  size %d\n" % (doc.Url(), doc.list_size)
+          fd.write(" - %s  --  size %d\n" % (doc.Url(), doc.list_size))
         elif doc.IsDirectory():
-          output += " - %s\n" % (doc.Url())
+          fd.write(" - %s\n" % (doc.Url()))
     if self.zero_sized:
-      output += "Empty documents:\n - %s\n" % "\n - ".join(self.zero_sized)
+      fd.write("Empty documents:\n - %s\n" % "\n - ".join(
+          self.Urls(self.zero_sized)))
     if self.size_mismatch:
-      output += "Empty documents listed as non-empty:\n - %s\n" % "\n - ".join(
-          self.size_mismatch)
-    for status, urls in self.status_map.iteritems():
-      if urls:
-        output += "%s was returned for these URLs:\n - %s\n" % (
-            status, "\n - ".join(urls))
-    return output
+      fd.write("Empty documents listed as non-empty:\n - %s\n" % (
+          "\n - ".join(self.Urls(self.size_mismatch))))
+    for status, ids in self.status_map.iteritems():
+      if ids:
+        fd.write("%s was returned for these URLs:\n - %s\n" % (
+            status, "\n - ".join(self.Urls(ids))))
 
   def Add(self, doc):
     """Adds a document to the report."""
 
-    self.urls_map[doc.Url()] = doc
+    self.lock.acquire()
+    try:
+      url = doc.Url()
+      if url in self.urls_map:
+        doc.id = self.urls_map[url].id
+        self.docs[doc.id] = doc
+      else:
+        doc.id = len(self.docs)
+        self.docs.append(doc)
+      self.urls_map[url] = doc
+    finally:
+      self.lock.release()
+    if self.journal is not None:
+      self.journal.Add(doc)
 
   def Update(self, url, **kwargs):
     """Updates a document already present in the report."""
 
+    self.lock.acquire()
+    try:
+      self._Update(url, **kwargs)
+    finally:
+      self.lock.release()
+    if self.journal is not None:
+      self.journal.Update(url, kwargs)
+
+  def _Update(self, url, **kwargs):
+    doc = self.urls_map[url]
     for key, value in kwargs.iteritems():
-      self.urls_map[url].__setattr__(key, value)
+      doc.__setattr__(key, value)
     size = kwargs.get("real_size")
     if size is 0:
-      self.zero_sized.append(url)
-      if size != self.urls_map[url].list_size:
-        self.size_mismatch.append(url)
+      self.zero_sized.Add(doc.id)
+      if size != doc.list_size:
+        self.size_mismatch.Add(doc.id)
     status = kwargs.get("status")
     if status is not None:
-      if status in self.status_map:
-        self.status_map[status].append(url)
-      else:
-        self.status_map[status] = [url]
-    for group in self.urls_map[url].GroupsByStatus():
-      if group in self.groups_map:
-        self.groups_map[group].append(url)
-      else:
-        self.groups_map[group] = [url]
+      if status not in self.status_map:
+        self.status_map[status] = Bitset()
+      self.status_map[status].Add(doc.id)
+    for group in doc.GroupsByStatus():
+      if group not in self.groups_map:
+        self.groups_map[group] = Bitset()
+      self.groups_map[group].Add(doc.id)
 
   def Lookup(self, url):
     """Returns the document object which URL is the one received.
@@ -768,10 +1034,54 @@ class Report(object):
     """
     return self.urls_map[url]
 
+  def InGroups(self, doc):
+    """Returns true iff the document belongs to the groups to output."""
+    if self.groups is None:
+      return True
+    for group in self.groups:
+      if group in self.groups_map and doc.id in self.groups_map[group]:
+        return True
+    return False
+
+  def Complete(self, url):
+    """Marks a document as crawled, writing it out if the report is open."""
+
+    self.lock.acquire()
+    try:
+      doc = self.urls_map[url]
+      if doc.id in self.completed:
+        return
+      self.completed.Add(doc.id)
+      if self.writer is not None and self.InGroups(doc):
+        self.writer.Write(doc)
+    finally:
+      self.lock.release()
+
+  def Open(self, config):
+    """Opens the output file, documents are then written once crawled.
+
+    Only CSV includes status and size, XML and text include only URLs.
+
+    Args:
+      config: flag-drive configuration.
+    """
+
+    self.lock.acquire()
+    try:
+      if config.output is None:
+        config.output = "/dev/stdout"
+      self.groups = config.groups
+      self.writer = ReportWriter(config)
+      for i in self.completed:
+        if self.InGroups(self.docs[i]):
+          self.writer.Write(self.docs[i])
+    finally:
+      self.lock.release()
+
   def Save(self, config):
     """Saves the report to a file accordingly to the configuration.
        
-    Only CSV includes status and size, XML and text include only URLs.
+    Writes the documents not written yet, and closes the output file.
        
     Args:
       config: flag-drive configuration.
@@ -780,41 +1090,658 @@ class Report(object):
       Exception: a generic exception.
     """
 
-    if config.output is None:
-      config.output = "/dev/stdout"
-      if config.oformat is None:
+    if self.writer is None:
+      if config.output is None and config.oformat is None:
         return
-    fd = open(config.output, "w")
-    if config.oformat == "xml":
-      fd.write(
-          "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
-          "<urlset xmlns=\"http://www.google.com/schemas/sitemap/0.84\"\n"
-          "  xmlns:xsi=\"http://www.w3.org/2001/XMLSchema-instance\"\n"
-          "  xsi:schemaLocation=\"http://www.google.com/schemas/sitemap/0.84\n"
-          "  http://www.google.com/schemas/sitemap/0.84/sitemap.xsd\">\n")
-    # Check for groups
-    if config.groups is None:
-      urls = self.urls_map.keys()
-    else:
-      urls = []
-      for group in config.groups:
-        if group in self.groups_map:
-          urls.extend(self.groups_map[group])
-    for url in urls:
-      doc = self.urls_map[url]
-      if config.oformat == "xml":
-        fd.write("  <url>\n    <loc>%s</loc>\n  </url>\n" % url)
-      elif config.oformat == "csv":
-        fd.write(config.osep.join(
-            ["%s%s%s" % (config.oquot, data, config.oquot) for data in (
-                saxutils.escape(url), doc.HttpStatus(), doc.list_size)]) + "\n")
-      elif config.oformat == "txt":
-        fd.write("%s\n" % url)
+      self.Open(config)
+    self.lock.acquire()
+    try:
+      for doc in self.docs:
+        if doc.id not in self.completed and self.InGroups(doc):
+          self.writer.Write(doc)
+      self.writer.Close()
+      self.writer = None
+    finally:
+      self.lock.release()
+
+
+class Frontier(object):
+  """Holds the paths left to crawl, and remembers the ones already seen.
+
+  Paths are queued in one deque per file server, so that a path can be
+  picked on a server that is not busy without scanning the whole queue.
+  Paths are popped from the end of the deques for a depth-first crawl,
+  from the start for a breadth-first crawl.  Adding a path already seen is
+  a set lookup, whatever the size of the crawl.
+  """
+
+  def __init__(self, depth_first=True):
+    self.depth_first = depth_first
+    self.queues = {}
+    self.seen = set()
+    self.size = 0
+
+  def __len__(self):
+    return self.size
+
+  def Add(self, share, filename):
+    """Queues a path of a share, unless it has already been seen.
+
+    Returns:
+      True iff the path was queued.
+    """
+    if (share, filename) in self.seen:
+      return False
+    self.seen.add((share, filename))
+    if share.hostname not in self.queues:
+      self.queues[share.hostname] = collections.deque()
+    self.queues[share.hostname].append((share, filename))
+    self.size += 1
+    return True
+
+  def Seen(self, share, filename):
+    """Remembers a path of a share without queueing it.
+
+    Returns:
+      True iff the path had not been seen yet.
+    """
+    if (share, filename) in self.seen:
+      return False
+    self.seen.add((share, filename))
+    return True
+
+  def Pop(self, available=None):
+    """Returns the next (share, filename) to crawl, or None.
+
+    Args:
+      available: if set, a function telling whether a file server can take
+        one more request.
+    """
+    for hostname, queue in self.queues.iteritems():
+      if available is None or available(hostname):
+        if self.depth_first:
+          item = queue.pop()
+        else:
+          item = queue.popleft()
+        if not queue:
+          del self.queues[hostname]
+        self.size -= 1
+        return item
+    return None
+
+
+class CrawlPool(object):
+  """Crawls the paths of file shares on a pool of threads.
+
+  The crawl queue holds (share, path) items.  Each worker thread takes an
+  item, crawls it with the crawl_path function, and queues the paths found
+  in directory listings.  No more than per_server items are crawled at the
+  same time on a given file server.  Shares can be added while crawling,
+  until Close is called.
+  """
+
+  def __init__(self, config, report, crawl_path):
+    self.config = config
+    self.report = report
+    self.crawl_path = crawl_path
+    self.threads = max(config.threads, 1)
+    self.per_server = config.perserver
+    self.condition = threading.Condition()
+    self.frontier = Frontier(config.order == "dfs")
+    self.running = 0
+    self.running_per_server = {}
+    self.error = None
+    self.closed = False
+    self.workers = []
+    # Journal recording the progress of the crawl, if any
+    self.journal = None
+    # Index of the files read by the previous crawl, if any
+    self.index = None
+
+  def AddShare(self, share):
+    """Adds a share to the report, and queues its root path to crawl."""
+    self.condition.acquire()
+    try:
+      if self.journal is not None:
+        self.journal.AddShare(share)
+      self.report.Add(Document(share))
+      if self.frontier.Add(share, share.filename) and self.journal is not None:
+        self.journal.Queue(share, share.filename)
+      if self.journal is not None:
+        self.journal.Commit()
+      self.condition.notify()
+    finally:
+      self.condition.release()
+
+  def Close(self):
+    """Tells that no more shares will be added."""
+    self.condition.acquire()
+    try:
+      self.closed = True
+      self.condition.notifyAll()
+    finally:
+      self.condition.release()
+
+  def Available(self, hostname):
+    """Returns true iff a path can be crawled now on this file server."""
+    return (not self.per_server or
+            self.running_per_server.get(hostname, 0) < self.per_server)
+
+  def Next(self):
+    """Waits for a path to crawl, returns None once the crawl is over."""
+    self.condition.acquire()
+    try:
+      while True:
+        if self.error is not None:
+          return None
+        item = self.frontier.Pop(self.Available)
+        if item is not None:
+          share, filename = item
+          self.running += 1
+          self.running_per_server[share.hostname] = (
+              self.running_per_server.get(share.hostname, 0) + 1)
+          return item
+        if not self.frontier and not self.running and self.closed:
+          self.condition.notifyAll()
+          return None
+        self.condition.wait()
+    finally:
+      self.condition.release()
+
+  def Done(self, share, filename, paths, crawled=True, unchanged=()):
+    """Queues the paths found while crawling filename.
+
+    Args:
+      share: Share object the path belongs to
+      filename: path crawled
+      paths: paths found in a directory listing, to crawl
+      crawled: false if crawling the path failed
+      unchanged: paths found in a directory listing, already up to date in
+        the report
+    """
+    completed = []
+    self.condition.acquire()
+    try:
+      for path in paths:
+        if self.frontier.Add(share, path) and self.journal is not None:
+          self.journal.Queue(share, path)
+      for path in unchanged:
+        if self.frontier.Seen(share, path):
+          completed.append(path)
+          if self.journal is not None:
+            self.journal.Queue(share, path)
+            self.journal.Crawled(share, path)
+      if crawled:
+        completed.append(filename)
+      self.running -= 1
+      self.running_per_server[share.hostname] -= 1
+      if self.journal is not None:
+        # Commit while holding the lock, so that the records of a path
+        # are written after the ones of the directory listing it.
+        if crawled:
+          self.journal.Crawled(share, filename)
+          self.journal.Commit()
+        else:
+          self.journal.Discard()
+      self.condition.notifyAll()
+    finally:
+      self.condition.release()
+    for path in completed:
+      self.report.Complete(share.Url(path))
+    if self.journal is not None:
+      self.journal.Checkpoint()
+
+  def Worker(self):
+    while True:
+      item = self.Next()
+      if item is None:
+        return
+      share, filename = item
+      paths = []
+      unchanged = []
+      crawled = False
+      try:
+        paths = self.crawl_path(self.config, self.report, share, filename)
+        if self.index is not None:
+          paths, unchanged = self.index.Filter(self.report, share, paths)
+        crawled = True
+      except Exception:
+        # Stop the other workers, the error is raised again by Run
+        self.condition.acquire()
+        self.error = sys.exc_info()
+        self.condition.release()
+      self.Done(share, filename, paths, crawled, unchanged)
+
+  def Start(self):
+    """Starts the worker threads."""
+    self.workers = [threading.Thread(target=self.Worker)
+                    for _ in range(self.threads)]
+    for worker in self.workers:
+      worker.setDaemon(True)
+      worker.start()
+
+  def Join(self):
+    """Waits until the pool is closed and nothing is left to crawl."""
+    for worker in self.workers:
+      # join with a timeout lets the main thread get KeyboardInterrupt
+      while worker.isAlive():
+        worker.join(1)
+    if self.error is not None:
+      raise self.error[0], self.error[1], self.error[2]
+
+
+class Journal(object):
+  """Records the progress of a crawl in a file, so that it can be resumed.
+
+  The journal is a text file of tab separated records, with backslash
+  escapes in the fields:
+
+    S  share_id  share           a share to crawl, in command line order
+    A  share_id  filename  lastmod  list_size  real_size  status
+                                 a document added to the report
+    U  url  attribute  value     a document of the report updated
+    Q  share_id  filename        a path queued for crawling
+    C  share_id  filename        a path crawled
+
+  The records found while crawling a path are buffered by the crawling
+  thread and written together with its C record, so that a path
+  interrupted halfway through is crawled again on resume.  Records are
+  flushed to disk every CHECKPOINT_INTERVAL seconds.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.shares = []
+    self.share_ids = {}
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.fd = None
+    self.flushed = time.time()
+
+  def Open(self, report, frontier, shares, resume=False):
+    """Opens the journal file, after replaying it if resuming.
+
+    Args:
+      report: Report object to replay the documents into
+      frontier: Frontier object to replay the paths left to crawl into
+      shares: iterator over the shares to crawl, the ones in the journal are
+        taken from it
+      resume: replay the journal file if it exists, instead of starting over
+
+    Returns:
+      True iff a previous crawl was replayed.
+    """
+    if not resume or not os.path.exists(self.filename):
+      self.fd = open(self.filename, "w")
+      return False
+    fd = open(self.filename, "r+")
+    offset = 0
+    queued = []
+    crawled = set()
+    while True:
+      line = fd.readline()
+      if not line.endswith("\n"):
+        break   # End of file, or a record cut short by a crash
+      offset += len(line)
+      fields = [field.decode("string_escape")
+                for field in line[:-1].split("\t")]
+      kind = fields[0]
+      if kind == "S":
+        try:
+          share = shares.next()
+        except StopIteration:
+          share = None
+        if share is None or repr(share) != fields[2]:
+          print ("\nThe journal '%s' was recorded for other URLs to crawl, "
+                 "starting with:\n - %s\n" % (self.filename, "\n - ".join(
+                     map(repr, self.shares) + [fields[2]])))
+          sys.exit(1)
+        self.share_ids[share] = len(self.shares)
+        self.shares.append(share)
+      elif kind == "A":
+        report.Add(self.DecodeDocument(fields[1:]))
+      elif kind == "U":
+        url, key, value = fields[1:]
+        if key in ("list_size", "real_size"):
+          value = int(value)
+        report.Update(url, **{key: value})
+      elif kind == "Q":
+        queued.append((int(fields[1]), fields[2]))
+      elif kind == "C":
+        crawled.add((int(fields[1]), fields[2]))
+        report.Complete(self.shares[int(fields[1])].Url(fields[2]))
+    for share_id, filename in queued:
+      share = self.shares[share_id]
+      if (share_id, filename) in crawled:
+        frontier.seen.add((share, filename))
       else:
-        raise Exception("This should never happen!")
-    if config.oformat == "xml":
-      fd.write("</urlset>\n")
+        frontier.Add(share, filename)
+    # Append after the last complete record
+    fd.seek(offset)
+    fd.truncate()
+    self.fd = fd
+    return True
+
+  def Records(self):
+    """Returns the records buffered by the current thread."""
+    if not hasattr(self.local, "records"):
+      self.local.records = []
+    return self.local.records
+
+  def Record(self, *fields):
+    """Buffers a record until the current thread commits."""
+    self.Records().append(fields)
+
+  def Add(self, doc):
+    self.Record("A", *self.EncodeDocument(doc))
+
+  def Update(self, url, kwargs):
+    for key, value in kwargs.iteritems():
+      self.Record("U", url, key, value)
+
+  def AddShare(self, share):
+    self.share_ids[share] = len(self.shares)
+    self.shares.append(share)
+    self.Record("S", self.share_ids[share], repr(share))
+
+  def Queue(self, share, filename):
+    self.Record("Q", self.share_ids[share], filename)
+
+  def Crawled(self, share, filename):
+    self.Record("C", self.share_ids[share], filename)
+
+  def EncodeDocument(self, doc):
+    """Returns the fields of an A record for a document."""
+    return (self.share_ids[doc.share], doc.filename,
+            EncodeTimestamp(doc.lastmod), doc.list_size, doc.real_size,
+            doc.status)
+
+  def DecodeDocument(self, fields):
+    """Returns the document of an A record, from its fields."""
+    share_id, filename, lastmod, list_size, real_size, status = fields
+    doc = Document(self.shares[int(share_id)], filename,
+                   lastmod=DecodeTimestamp(lastmod), status=status or None)
+    doc.list_size = int(list_size)
+    if real_size:
+      doc.real_size = int(real_size)
+    return doc
+
+  def Write(self, *fields):
+    line = []
+    for field in fields:
+      if field is None:
+        field = ""
+      line.append(str(field).encode("string_escape"))
+    self.fd.write("\t".join(line) + "\n")
+
+  def Commit(self):
+    """Writes the records buffered by the current thread."""
+    records = self.Records()
+    self.lock.acquire()
+    try:
+      if self.fd is not None:
+        for fields in records:
+          self.Write(*fields)
+    finally:
+      self.lock.release()
+    del records[:]
+
+  def Discard(self):
+    """Drops the records buffered by the current thread."""
+    del self.Records()[:]
+
+  def Checkpoint(self):
+    """Flushes the journal to disk, if not done for CHECKPOINT_INTERVAL."""
+    if time.time() - self.flushed < CHECKPOINT_INTERVAL:
+      return
+    self.lock.acquire()
+    try:
+      if self.fd is not None:
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+      self.flushed = time.time()
+    finally:
+      self.lock.release()
+
+  def Close(self):
+    self.lock.acquire()
+    try:
+      if self.fd is not None:
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+        self.fd.close()
+        self.fd = None
+    finally:
+      self.lock.release()
+
+
+class Index(object):
+  """Keeps the date and size of the files read by the previous crawl.
+
+  The index is a text file with one line per file successfully read: URL,
+  last modification time, size on directory listing and size read, tab
+  separated with backslash escapes.  A file listed with the same date and
+  size as in the index is not read again, its size read is taken from the
+  index.  Files that could not be read are always tried again.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.files = {}
+    self.skipped = 0
+    self.lock = threading.Lock()
+    if os.path.exists(filename):
+      fd = open(filename, "r")
+      for line in fd:
+        url, lastmod, list_size, real_size = [
+            field.decode("string_escape")
+            for field in line.rstrip("\n").split("\t")]
+        self.files[url] = (lastmod, int(list_size), int(real_size))
+      fd.close()
+
+  def Filter(self, report, share, paths):
+    """Skips the files unchanged since the previous crawl.
+
+    Args:
+      report: Report object holding the documents listed for the paths
+      share: Share object the paths belong to
+      paths: paths found in a directory listing
+
+    Returns:
+      (changed, unchanged): the paths to crawl, and the unchanged files,
+        updated in the report from the index instead.
+    """
+    changed = []
+    unchanged = []
+    for path in paths:
+      url = share.Url(path)
+      if path[-1] != "/" and url in self.files:
+        lastmod, list_size, real_size = self.files[url]
+        doc = report.Lookup(url)
+        if (EncodeTimestamp(doc.lastmod) == lastmod and
+            doc.list_size == list_size):
+          report.Update(url, real_size=real_size)
+          self.lock.acquire()
+          self.skipped += 1
+          self.lock.release()
+          unchanged.append(path)
+          continue
+      changed.append(path)
+    return changed, unchanged
+
+  def Save(self, report):
+    """Writes the files successfully read to the index file."""
+    fd = open(self.filename + ".tmp", "w")
+    for url, doc in report.urls_map.iteritems():
+      if (doc.IsFile() and doc.status is None and doc.real_size is not None
+          and doc.lastmod is not None):
+        fd.write("\t".join([str(field).encode("string_escape") for field in (
+            url, EncodeTimestamp(doc.lastmod), doc.list_size,
+            doc.real_size)]) + "\n")
     fd.close()
+    os.rename(self.filename + ".tmp", self.filename)
+
+
+def CrawlShares(config, crawl_path):
+  """Crawls a list of SMB file shares.
+
+  Args:
+    config: Config object holding global configuration from commands flags
+    crawl_path: function crawling a single path, see SmbclientCrawlPath
+
+  Returns:
+    report: Report object holding the results from the crawling the shares.
+  """
+
+  shares = config.IterShares()
+  report = Report()
+  pool = CrawlPool(config, report, crawl_path)
+  if config.index is not None:
+    pool.index = Index(config.index)
+  if config.output is not None:
+    # Opened first, so that a resumed crawl rewrites the documents crawled
+    # as they are replayed from the journal
+    report.Open(config)
+  journal = None
+  resumed = False
+  if config.checkpoint is not None:
+    journal = Journal(config.checkpoint)
+    resumed = journal.Open(report, pool.frontier, shares, config.resume)
+    if resumed:
+      print "Resuming crawl from '%s': %d documents, %d paths left." % (
+          config.checkpoint, len(report.urls_map), len(pool.frontier))
+    report.journal = pool.journal = journal
+  try:
+    # Crawl the first shares while reading the others
+    pool.Start()
+    found = resumed
+    for share in shares:
+      if pool.error is not None:
+        break
+      if config.debug > 0:
+        print "Share to crawl: %s" % share
+      pool.AddShare(share)
+      found = True
+    pool.Close()
+    if not found:
+      print "No shares found!"
+      sys.exit(1)
+    pool.Join()
+  finally:
+    if journal is not None:
+      journal.Close()
+  if pool.index is not None:
+    if config.debug > 0:
+      print "%d files unchanged since the previous crawl were not read." % (
+          pool.index.skipped,)
+    pool.index.Save(report)
+  return report
+
+
+def GetStatusOutput(cmd):
+  """Runs a shell command, like commands.getstatusoutput.
+
+  The command runs in a process group of its own, so that Ctrl-C stops the
+  crawler without killing the commands being run: their empty output would
+  be recorded as empty files and directories in the --checkpoint journal.
+
+  Args:
+    cmd: shell command line
+
+  Returns:
+    (status, output): exit status and output of the command, stderr included.
+  """
+  process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, close_fds=True,
+                             preexec_fn=os.setpgrp)
+  output = process.communicate()[0]
+  if output[-1:] == "\n":
+    output = output[:-1]
+  return process.returncode, output
+
+
+class SmbclientSession(object):
+  """A long-lived interactive smbclient connected to a share.
+
+  Commands are written to the standard input of smbclient, each followed
+  by a marker, an unknown command: smbclient answers it with "<marker>:
+  command not found", which tells where the output of the command ends.
+  This saves a new process and a new login to the file server per path.
+  """
+
+  MARKER = "smbcrawler_end_of_output"
+
+  def __init__(self, args):
+    self.args = args
+    self.process = None
+
+  def Run(self, cmd):
+    """Runs a smbclient command.
+
+    Args:
+      cmd: the smbclient command, e.g. ls or get.
+
+    Returns:
+      (status, output) like GetStatusOutput.
+    """
+    if self.process is None:
+      # (Re)connects, e.g. after the server dropped the connection
+      self.process = subprocess.Popen(
+          self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+          stderr=subprocess.STDOUT, close_fds=True, preexec_fn=os.setpgrp)
+    lines = []
+    try:
+      self.process.stdin.write("%s\n%s\n" % (cmd, self.MARKER))
+      self.process.stdin.flush()
+      for line in iter(self.process.stdout.readline, ""):
+        line = PROMPT_REGEX.sub("", line.rstrip("\n"))
+        if line.startswith(self.MARKER):
+          return 0, "\n".join(lines)
+        lines.append(line)
+    except IOError:
+      pass
+    # smbclient exited, most likely with an error in its output
+    status = self.process.wait()
+    self.process = None
+    return status or 1, "\n".join(lines)
+
+  def Close(self):
+    if self.process is not None:
+      try:
+        self.process.stdin.write("exit\n")
+        self.process.stdin.close()
+      except IOError:
+        pass
+      self.process.wait()
+      self.process = None
+
+
+class SmbclientSessions(object):
+  """The smbclient sessions of the crawler threads, one per share."""
+
+  def __init__(self):
+    self.local = threading.local()
+    self.lock = threading.Lock()
+    self.sessions = []
+
+  def Get(self, share, args):
+    """Returns the session of the current thread for share."""
+    sessions = self.local.__dict__.setdefault("sessions", {})
+    if share not in sessions:
+      sessions[share] = SmbclientSession(args)
+      self.lock.acquire()
+      self.sessions.append(sessions[share])
+      self.lock.release()
+    return sessions[share]
+
+  def Close(self):
+    for session in self.sessions:
+      session.Close()
+    self.sessions = []
+    self.local = threading.local()
+
+
+SMBCLIENT_SESSIONS = SmbclientSessions()
 
 
 def CrawlWithSmbclient(config):
@@ -827,104 +1754,124 @@ def CrawlWithSmbclient(config):
     report: Report object holding the results from the crawling the shares.
   """
 
-  shares = config.Shares()
-  if not shares:
-    print "No shares found!"
-    sys.exit(1)
-  if config.debug > 0:
-    print "Shares to crawl: \n - %s" % '\\\n - '.join([str(s) for s in shares])
-  report = Report()
-  for share in shares:
-    # builds SMB client command using either smbclient
-    opts = ["-N"]
+  try:
+    return CrawlShares(config, SmbclientCrawlPath)
+  finally:
+    SMBCLIENT_SESSIONS.Close()
+
+
+def SmbclientCrawlPath(config, report, share, filename):
+  """Crawls a single file or directory of a share, using smbclient.
+
+  Args:
+    config: Config object holding global configuration from commands flags
+    report: Report object updated with the results
+    share: Share object the path belongs to
+    filename: path of the file or directory in the share
+
+  Returns:
+    paths: the paths found in a directory listing, to crawl next.
+  """
+
+  # builds SMB client command using either smbclient
+  opts = ["-N"]
+  if share.domain is not None:
+    opts.append("-W%s" % share.domain)
+  if share.username is not None:
+    if share.password is not None:
+      opts.append('-U"%s%%%%%s"' % (share.username, share.password))
+    else:
+      opts.append('-U"%s"' % share.username)
+  else:
+    opts.append("-Uguest")
+  client = "%s %s //%s/%s -c'%%s'" % (
+      config.client, " ".join(opts), share.hostname, share.share)
+  crawl_queue = []
+  file_url = share.Root() + filename[1:]
+  if config.debug > 1:
+    print "Trying %s" % share.Url(filename)
+  if filename[-1] == "/":
+    cmd = "ls \"%s*\"" % filename.replace("/", '\\')
+  else:
+    cmd = "get \"%s\" /dev/null" % filename.replace("/", '\\')
+  if config.session:
+    args = [config.client, "-N"]
     if share.domain is not None:
-      opts.append("-W%s" % share.domain)
+      args.append("-W%s" % share.domain)
     if share.username is not None:
       if share.password is not None:
-        opts.append('-U"%s%%%%%s"' % (share.username, share.password))
+        args.append("-U%s%%%s" % (share.username, share.password))
       else:
-        opts.append('-U"%s"' % share.username)
+        args.append("-U%s" % share.username)
     else:
-      opts.append("-Uguest")
-    client = "%s %s //%s/%s -c'%%s'" % (
-        config.client, " ".join(opts), share.hostname, share.share)
-    crawl_queue = [share.filename]
-    crawled = []
-    report.Add(Document(share))
-    while crawl_queue:
-      filename = crawl_queue.pop()
-      while filename in crawled:
-        filename = crawl_queue.pop()
-      crawled.append(filename)
-      file_url = share.Root() + filename[1:]
-      if config.debug > 1:
-        print "Trying %s" % share.Url(filename)
-      if filename[-1] == "/":
-        cmd = "ls \"%s*\"" % filename.replace("/", '\\')
+      args.append("-Uguest")
+    args.append("//%s/%s" % (share.hostname, share.share))
+    if config.debug > 3:
+      print "Sending command: %s" % cmd
+    status, output = SMBCLIENT_SESSIONS.Get(share, args).Run(cmd)
+  else:
+    if config.debug > 3:
+      print "Running command: %s" % (client % cmd,)
+    status, output = GetStatusOutput(client % cmd)
+  if filename[-1] == "/":
+    # Get filenames out of directory listing
+    for line in output.split("\n"):
+      if line[:2] == "  " and line[2:4] != "..":
+        parts = line.split()
+        timestamp = ":".join((parts[-1], str(
+            MONTH_NUMBERS[parts[-4]]), parts[-3], parts[-2]))
+        timestamp = datetime.datetime(*map(int, timestamp.split(":")))
+        size = int(parts[-6])
+        child = " ".join(parts[:-6])
+        if child[-1] == "D": child = child[:-2] + "/"   # sript D attribute
+        if ATTRIBUTES_REGEX.match(child[-1]):
+          child = child[:-2]   # strip attributes
+        if child[0] == ".":
+          doc = Document(share, filename, lastmod=timestamp)
+          doc.list_size = doc.real_size = 4096   # Just to avoid zero-sized
+          report.Add(doc)
+          continue
+        path = os.path.join(filename, child)
+        if config.maxdepth != -1 and (
+            path[:-1].count("/") - share.depth) > config.maxdepth:
+          continue
+        doc = Document(share, path, lastmod=timestamp)
+        crawl_queue.append(path)
+        if doc.IsFile:
+          doc.list_size = size
+        report.Add(doc)
+        if config.debug > 3:
+          print "Found '%s' last modified %s" % (doc.Url(), doc.lastmod)
+      elif line[:3] == "NT_":
+        status = line.split()[0]
+        if config.debug > 2:
+          print "%s for %s" % (status, filename)
+        report.Update(file_url, status=status)
       else:
-        cmd = "get \"%s\" /dev/null" % filename.replace("/", '\\')
-      if config.debug > 3:
-        print "Running command: %s" % (client % cmd,)
-      status, output = commands.getstatusoutput(client % cmd)
-      if filename[-1] == "/":
-        # Get filenames out of directory listing
-        for line in output.split("\n"):
-          if line[:2] == "  " and line[2:4] != "..":
-            parts = line.split()
-            timestamp = ":".join((parts[-1], str(
-                SHORT_MONTH_NAMES.index(parts[-4])+1), parts[-3], parts[-2]))
-            timestamp = datetime.datetime(*map(int, timestamp.split(":")))
-            size = int(parts[-6])
-            child = " ".join(parts[:-6])
-            if child[-1] == "D": child = child[:-2] + "/"   # sript D attribute
-            regex = re.compile("^(A|H|S)(A|H|S)?(A|H|S)?$")
-            if regex.match(child[-1]): child = child[:-2]   # strip attributes
-            if child[0] == ".":
-              doc = Document(share, filename, lastmod=timestamp)
-              doc.list_size = doc.real_size = 4096   # Just to avoid zero-sized
-              report.Add(doc)
-              continue
-            path = os.path.join(filename, child)
-            if config.maxdepth != -1 and (
-                path[:-1].count("/") - share.depth) > config.maxdepth:
-              continue
-            doc = Document(share, path, lastmod=timestamp)
-            crawl_queue.append(path)
-            if doc.IsFile:
-              doc.list_size = size
-            report.Add(doc)
-            if config.debug > 3:
-              print "Found '%s' last modified %s" % (doc.Url(), doc.lastmod)
-          elif line[:3] == "NT_":
-            status = line.split()[0]
-            if config.debug > 2:
-              print "%s for %s" % (status, filename)
-            report.Update(file_url, status=status)
-          else:
-            words = line.split()
-            for error in words:
-              if error[:3] == "NT_":
-                report.Update(file_url, status=error)
+        words = line.split()
+        for error in words:
+          if error[:3] == "NT_":
+            report.Update(file_url, status=error)
+  else:
+    # Get result of downloading the file
+    for line in output.split("\n"):
+      if line[:7] == "getting":
+        parts = line.split()
+        size = int(parts[parts.index("size") + 1])
+        if config.debug > 2:
+          print "%s has size %s" % (filename, size)
+        report.Update(file_url, real_size=size)
+      elif line[:3] == "NT_":
+        error = line.split()[0]
+        if config.debug > 2:
+          print "%s for %s" % (error, filename)
+        report.Update(file_url, status=error)
       else:
-        # Get result of downloading the file
-        for line in output.split("\n"):
-          if line[:7] == "getting":
-            parts = line.split()
-            size = int(parts[parts.index("size") + 1])
-            if config.debug > 2:
-              print "%s has size %s" % (filename, size)
-            report.Update(file_url, real_size=size)
-          elif line[:3] == "NT_":
-            error = line.split()[0]
-            if config.debug > 2:
-              print "%s for %s" % (error, filename)
+        words = line.split()
+        for error in words:
+          if error[:3] == "NT_":
             report.Update(file_url, status=error)
-          else:
-            words = line.split()
-            for error in words:
-              if error[:3] == "NT_":
-                report.Update(file_url, status=error)
-  return report
+  return crawl_queue
 
 
 def CrawlWithSmbhelper(config):
@@ -936,106 +1883,107 @@ def CrawlWithSmbhelper(config):
   Returns:
     report: Report object holding the results from the crawling the shares.
   """
-  
-  shares = config.Shares()
-  if not shares:
-    print "No shares found!"
-    sys.exit(1)
-  if config.debug > 0:
-    print "Shares to crawl: \n - %s" % '\\\n - '.join([str(s) for s in shares])
-  report = Report()
-  for share in shares:
-    # builds SMB client command using smbhelper
-    opts = []
-    if share.domain is not None:
-      opts.append("--workgroup=%s" % share.domain)
-    if share.username is not None:
-      if share.password is not None:
-        opts.append("--username='%s' --password='%s'" % (
-            share.username, share.password))
-      else:
-        opts.append("--username='%s'" % share.username)
-    client = "%s %s --%%s --filename='%%s'" % (config.client, " ".join(opts))
-
-    crawl_queue = [share.filename]
-    crawled = []
-    report.Add(Document(share))
-    while crawl_queue:
-      filename = crawl_queue.pop()
-      while filename in crawled:
-        filename = crawl_queue.pop()
-      crawled.append(filename)
-      file_url = share.Root() + filename[1:]
-      if config.debug > 1:
-        print "Trying %s" % share.Url(filename)
-      if filename[-1] == "/":
-        op = "read_dir"
+
+  return CrawlShares(config, SmbhelperCrawlPath)
+
+
+def SmbhelperCrawlPath(config, report, share, filename):
+  """Crawls a single file or directory of a share, using smbhelper.
+
+  Args:
+    config: Config object holding global configuration from commands flags
+    report: Report object updated with the results
+    share: Share object the path belongs to
+    filename: path of the file or directory in the share
+
+  Returns:
+    paths: the paths found in a directory listing, to crawl next.
+  """
+
+  # builds SMB client command using smbhelper
+  opts = []
+  if share.domain is not None:
+    opts.append("--workgroup=%s" % share.domain)
+  if share.username is not None:
+    if share.password is not None:
+      opts.append("--username='%s' --password='%s'" % (
+          share.username, share.password))
+    else:
+      opts.append("--username='%s'" % share.username)
+  client = "%s %s --%%s --filename='%%s'" % (config.client, " ".join(opts))
+
+  crawl_queue = []
+  file_url = share.Root() + filename[1:]
+  if config.debug > 1:
+    print "Trying %s" % share.Url(filename)
+  if filename[-1] == "/":
+    op = "read_dir"
+  else:
+    op = "can_read"
+  cmd = client % (op, UrlEncode(file_url))
+  if config.debug > 3:
+    print "Running command: %s" % cmd
+  status, output = GetStatusOutput(cmd)
+  if filename[-1] == "/":
+    # Get filenames out of directory listing, unless permission is denied
+    for line in output.split("\n"):
+      if line[:6] == "Error:":
+        error = NT_STATUS_FROM_SMBHELPER[line.split(":")[-1].strip()]
+        if config.debug > 2:
+          print "%s returned error: %s" % (filename, error)
+        doc = Document(share, filename, status=error)
+        report.Add(doc)
+        continue
+      child, seconds, size = line.split()
+      timestamp = datetime.datetime(1970, 1, 1) + datetime.timedelta(
+          float(seconds) / (86400))
+      child = UrlDecode(child)
+      if size == "-":
+        child += "/"
+        size = 4096
       else:
-        op = "can_read"
-      cmd = client % (op, UrlEncode(file_url))
+        size = int(size)
+      if child == "../":
+        continue
+      if child == "./":
+        doc = Document(share, filename, lastmod=timestamp)
+        doc.list_size = doc.real_size = 4096   # Just to avoid zero-sized
+        report.Add(doc)
+        continue
+      path = filename + child   # filename already ends with /
+      if config.maxdepth != -1 and (
+          path[:-1].count("/") - share.depth) > config.maxdepth:
+        continue
+      doc = Document(share, path, lastmod=timestamp)
+      crawl_queue.append(path)
+      if doc.IsFile:
+        doc.list_size = size
+      report.Add(doc)
       if config.debug > 3:
-        print "Running command: %s" % cmd
-      status, output = commands.getstatusoutput(cmd)
-      if filename[-1] == "/":
-        # Get filenames out of directory listing, unless permission is denied
-        for line in output.split("\n"):
-          if line[:6] == "Error:":
-            error = NT_STATUS_FROM_SMBHELPER[line.split(":")[-1].strip()]
-            if config.debug > 2:
-              print "%s returned error: %s" % (filename, error)
-            doc = Document(share, filename, status=error)
-            report.Add(doc)
-            continue
-          child, seconds, size = line.split()
-          timestamp = datetime.datetime(1970, 1, 1) + datetime.timedelta(
-              float(seconds) / (86400))
-          child = UrlDecode(child)
-          if size == "-":
-            child += "/"
-            size = 4096
-          else:
-            size = int(size)
-          if child == "../":
-            continue
-          if child == "./":
-            doc = Document(share, filename, lastmod=timestamp)
-            doc.list_size = doc.real_size = 4096   # Just to avoid zero-sized
-            report.Add(doc)
-            continue
-          path = filename + child   # filename already ends with /
-          if config.maxdepth != -1 and (
-              path[:-1].count("/") - share.depth) > config.maxdepth:
-            continue
-          doc = Document(share, path, lastmod=timestamp)
-          crawl_queue.append(path)
-          if doc.IsFile:
-            doc.list_size = size
-          report.Add(doc)
-          if config.debug > 3:
-            print "Found '%s' last modified %s" % (doc.Url(), doc.lastmod)
+        print "Found '%s' last modified %s" % (doc.Url(), doc.lastmod)
+  else:
+    # Get result of downloading the file
+    if not status:
+      doc = report.Lookup(file_url)
+      size = doc.list_size
+      if config.debug > 2:
+        print "%s has size %s" % (filename, size)
+      report.Update(file_url, real_size=size)
+      return crawl_queue
+    for line in output.split("\n"):
+      # smbhelper is known to return these errors:
+      # Error: smbc_stat at "smbhelper.c":234: No such file or directory
+      # Error: smbc_opendir at "smbhelper.c":267: No such file or directory
+      # Error: smbc_opendir at "smbhelper.c":267: Permission denied
+      if line[:6] == "Error:":
+        error = NT_STATUS_FROM_SMBHELPER[line.split(":")[-1].strip()]
+        if config.debug > 2:
+          print "%s returned error: %s" % (filename, error)
+        doc = report.Lookup(file_url)
+        report.Update(file_url, status=error)
       else:
-        # Get result of downloading the file
-        if not status:
-          doc = report.Lookup(file_url)
-          size = doc.list_size
-          if config.debug > 2:
-            print "%s has size %s" % (filename, size)
-          report.Update(file_url, real_size=size)
-          continue
-        for line in output.split("\n"):
-          # smbhelper is known to return these errors:
-          # Error: smbc_stat at "smbhelper.c":234: No such file or directory
-          # Error: smbc_opendir at "smbhelper.c":267: No such file or directory
-          # Error: smbc_opendir at "smbhelper.c":267: Permission denied
-          if line[:6] == "Error:":
-            error = NT_STATUS_FROM_SMBHELPER[line.split(":")[-1].strip()]
-            if config.debug > 2:
-              print "%s returned error: %s" % (filename, error)
-            doc = report.Lookup(file_url)
-            report.Update(file_url, status=error)
-          else:
-            print "\nTHIS SHOULD NEVER HAPPEN!\n"
-  return report
+        print "\nTHIS SHOULD NEVER HAPPEN!\n"
+  return crawl_queue
 
 
 def Crawl(config):
@@ -1062,7 +2010,7 @@ def main(argv):
   config = Config(argv)
   report = Crawl(config)
   if config.output is None:
-    print report
+    report.Print(sys.stdout)
   else:
     report.Save(config)
     print "Report written to '%s'." % config.output
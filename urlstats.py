@@ -36,10 +36,23 @@ content_type
 contentsize_in_bytes
 content_checksum
 fetchtime_in_ms
+
+The file can be read as exported, gzip compressed, or decompressed.  Use
+--processes to spread the work over several CPUs on large exports, and
+--diff to compare two exports.
 """
 
+import collections
 import getopt
+import gzip
+import heapq
+import itertools
+import multiprocessing
+import os
+import shutil
 import sys
+import tempfile
+import zlib
 
 # command line options
 OPTIONS = 'h:'
@@ -49,19 +62,33 @@ LONG_OPTIONS = ['help',
                 'state',
                 'server',
                 'size',
+                'processes=',
+                'diff=',
+                'partitions=',
+                'listchanges',
+                'topservers=',
                 'debug']
 # add a key value pair for each type of report
 REPORT_CFG = {'reportAll': True,
               'reportState': False,
               'reportServer': False,
               'reportSize': False,
-              'listurlslargerthan': -1
+              'listurlslargerthan': -1,
+              'listchanges': False,
+              'topservers': 0
              }
 DEBUG_MODE = False
+PROCESSES = 1
+# Number of temporary files each export is split into by the diff mode.
+# Only one partition of each export is held in memory at a time.
+DIFF_PARTITIONS = 64
 
 
 def main():
   global DEBUG_MODE
+  global PROCESSES
+  global DIFF_PARTITIONS
+  old_file = None
   try:
     opts, args = getopt.getopt(sys.argv[1:], OPTIONS, LONG_OPTIONS)
   except getopt.GetoptError, err:
@@ -83,6 +110,18 @@ def main():
     elif o == '--size':
       REPORT_CFG['reportAll'] = False
       REPORT_CFG['reportSize'] = True  # generate a report based on URL size
+    elif o == '--topservers':
+      REPORT_CFG['reportAll'] = False
+      REPORT_CFG['reportServer'] = True  # approximate top servers
+      REPORT_CFG['topservers'] = int(a)
+    elif o == '--processes':
+      PROCESSES = int(a)  # number of worker processes
+    elif o == '--diff':
+      old_file = a  # compare with a previous export
+    elif o == '--partitions':
+      DIFF_PARTITIONS = int(a)
+    elif o == '--listchanges':
+      REPORT_CFG['listchanges'] = True  # list new, removed, changed urls
     elif o == '--debug':
       DEBUG_MODE = True
     elif o in ('-h', '--help'):
@@ -97,35 +136,135 @@ def main():
   except IndexError:
     log_file = 'all_urls'
 
-  GenReport(log_file)
+  if old_file:
+    DiffReport(old_file, log_file, DIFF_PARTITIONS)
+  else:
+    GenReport(log_file, PROCESSES)
 
 
-def GenReport(log_file):
-  """Read each line of the log file and generate reports."""
-  total_url = 0
-  states = dict()
-  servers = dict()
-  # The content sizes in KB that we want to report on
-  # The for loop below assumes that this list is in ascending order
-  sizes_kb = [4, 8, 16, 32, 64, 128, 256, 512, 1024, 2*1024, 4*1024, 32*1024]
-  # initialize the content size map.  it is a dictionary with
-  # key: content size threshold (up to) # value: number of documents
-  content_size_map = dict([(x*1024, 0) for x in sizes_kb])
-  # files that are larger than all the value in sizes_kb are considered
-  # very large
-  very_large_files = 0
+# The content sizes in KB that we want to report on
+# The for loop in UrlStats.AddLine assumes that this list is in ascending order
+SIZES_KB = [4, 8, 16, 32, 64, 128, 256, 512, 1024, 2*1024, 4*1024, 32*1024]
+# Number of lines handed to a worker at once when the input is gzipped
+GZIP_BATCH_LINES = 50000
+GZIP_MAGIC = '\x1f\x8b'
+# With --topservers=K, the approximate server counts keep track of
+# K * SKETCH_FACTOR servers.  A larger factor gives tighter error bounds.
+SKETCH_FACTOR = 10
 
-  try:
-    f = open(log_file, 'r')
-  except IOError:
-    print 'unable to open file %s' % file
-    Usage()
-    sys.exit()
 
-  # The url file can be large (>1GB), so we don't want to read
-  # the entire file into memory. We do more I/O and keep memory
-  # footprint small.
-  for line in f:
+class SpaceSaving(object):
+  """Approximate counts of the most frequent items in a fixed memory.
+
+  This is the Space-Saving algorithm (Metwally, Agrawal, El Abbadi): at most
+  capacity items are tracked.  When a new item comes in and all the slots
+  are taken, the item with the lowest count is evicted and the new item
+  inherits its count.  The count of a tracked item is an upper bound of its
+  real count, and the real count is at least count - error.  No item has
+  been over counted by more than total / capacity.
+  """
+
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.total = 0
+    self.counts = dict()
+    self.errors = dict()
+    # A min heap of (count, item), one entry per tracked item.  The entries
+    # are not updated on increments, a stale entry is fixed when it shows
+    # up at the top of the heap.
+    self.heap = []
+
+  def Add(self, item, count=1):
+    self.total += count
+    if item in self.counts:
+      self.counts[item] += count
+      return
+    error = 0
+    if len(self.counts) >= self.capacity:
+      error = self.PopMin()
+    self.counts[item] = error + count
+    self.errors[item] = error
+    heapq.heappush(self.heap, (error + count, item))
+
+  def PopMin(self):
+    """Evict the item with the lowest count, and return this count."""
+    while True:
+      count, item = self.heap[0]
+      if count == self.counts[item]:
+        heapq.heappop(self.heap)
+        del self.counts[item]
+        del self.errors[item]
+        return count
+      heapq.heapreplace(self.heap, (self.counts[item], item))
+
+  def MinCount(self):
+    """The largest count an item which is not tracked can have."""
+    if len(self.counts) < self.capacity:
+      return 0
+    return min(self.counts.itervalues())
+
+  def Merge(self, other):
+    """Add the counts of another SpaceSaving to this one.
+
+    An item not tracked by one of the summaries may have been seen up to
+    MinCount() times by it, so this is added to both its count and error.
+    """
+    self_min, other_min = self.MinCount(), other.MinCount()
+    counts, errors = dict(), dict()
+    for item in set(self.counts).union(other.counts):
+      counts[item] = (self.counts.get(item, self_min) +
+                      other.counts.get(item, other_min))
+      errors[item] = (self.errors.get(item, self_min) +
+                      other.errors.get(item, other_min))
+    kept = heapq.nlargest(self.capacity, counts.iteritems(),
+                          key=lambda x: x[1])
+    self.total += other.total
+    self.counts = dict(kept)
+    self.errors = dict((item, errors[item]) for item in self.counts)
+    self.heap = [(count, item) for (item, count) in kept]
+    heapq.heapify(self.heap)
+
+  def Top(self, k):
+    """Return the k items with the largest counts: (item, count, error)."""
+    top = heapq.nlargest(k, self.counts.iteritems(),
+                         key=lambda x: (x[1], x[0]))
+    return [(item, count, self.errors[item]) for (item, count) in top]
+
+
+class UrlStats(object):
+  """Counters collected from an exported URL file, or a part of it.
+
+  Instances built from different parts of the same file can be combined
+  with Merge(), which is how the parallel mode puts its results together.
+  When top_servers is set, the number of URLs per server is approximated in
+  a SpaceSaving summary instead of being counted exactly in a dict.
+  """
+
+  def __init__(self, large_threshold=-1, collect_large=False, top_servers=0):
+    self.total_url = 0
+    self.states = dict()
+    self.servers = dict()
+    if top_servers:
+      self.server_sketch = SpaceSaving(top_servers * SKETCH_FACTOR)
+    else:
+      self.server_sketch = None
+    # initialize the content size map.  it is a dictionary with
+    # key: content size threshold (up to) # value: number of documents
+    self.content_size_map = dict([(x*1024, 0) for x in SIZES_KB])
+    # files that are larger than all the value in SIZES_KB are considered
+    # very large
+    self.very_large_files = 0
+    self.large_threshold = large_threshold
+    # When collect_large is set, the URLs larger than large_threshold are
+    # kept in a list to be printed by the parent process, otherwise they
+    # are printed as soon as they are found.
+    if collect_large:
+      self.large_urls = []
+    else:
+      self.large_urls = None
+
+  def AddLine(self, line):
+    """Update the counters with one line of the exported file."""
     fields = line.split('\t')
 
     # collect url state information
@@ -134,11 +273,8 @@ def GenReport(log_file):
     except IndexError, e:
       print 'IndexError:', e
     else:
-      total_url += 1
-      if state in states:
-        states[state] += 1
-      else:
-        states.update({state: 1})
+      self.total_url += 1
+      self.states[state] = self.states.get(state, 0) + 1
 
     # collect information to group urls by server, prot://host:[port]/
     try:
@@ -148,10 +284,10 @@ def GenReport(log_file):
     except IndexError, e:
       print 'IndexError:', e
     else:
-      if server in servers:
-        servers[server] += 1
+      if self.server_sketch is None:
+        self.servers[server] = self.servers.get(server, 0) + 1
       else:
-        servers.update({server: 1})
+        self.server_sketch.Add(server)
 
     # collect content size in byte
     try:
@@ -170,24 +306,164 @@ def GenReport(log_file):
       MyDebug('IndexError:')
       MyDebug(e)
     else:
-      for size_kb in sizes_kb:
+      for size_kb in SIZES_KB:
         if size < size_kb*1024:
-          content_size_map[size_kb*1024] += 1
+          self.content_size_map[size_kb*1024] += 1
           break
       else:
         # The for loop fell through, the content size is
         # greater than all the size thresholds in the list
         # The file is considered very large
-        very_large_files += 1
-      if (REPORT_CFG['listurlslargerthan'] != -1 and
-          size > REPORT_CFG['listurlslargerthan']):
-        print '%16s\t%s' % (line.split('\t')[11], line.split('\t')[0])
+        self.very_large_files += 1
+      if self.large_threshold != -1 and size > self.large_threshold:
+        large = '%16s\t%s' % (fields[11], fields[0])
+        if self.large_urls is None:
+          print large
+        else:
+          self.large_urls.append(large)
 
     # TODO(Jason): collect extension info
     # TODO(Jason): collect content_type info
     # TODO(Jason): collect URL length info, such as longer than a threshold
     #              or way longer than average, and print the extra long urls
-  f.close()
+
+  def Merge(self, other):
+    """Add the counters of another UrlStats to this one."""
+    self.total_url += other.total_url
+    for state, count in other.states.iteritems():
+      self.states[state] = self.states.get(state, 0) + count
+    for server, count in other.servers.iteritems():
+      self.servers[server] = self.servers.get(server, 0) + count
+    if self.server_sketch is not None:
+      self.server_sketch.Merge(other.server_sketch)
+    for size, count in other.content_size_map.iteritems():
+      self.content_size_map[size] += count
+    self.very_large_files += other.very_large_files
+    if other.large_urls:
+      if self.large_urls is None:
+        print '\n'.join(other.large_urls)
+      else:
+        self.large_urls.extend(other.large_urls)
+
+
+def IsGzipped(log_file):
+  f = open(log_file, 'rb')
+  try:
+    return f.read(2) == GZIP_MAGIC
+  finally:
+    f.close()
+
+
+def OpenUrlFile(log_file):
+  """Open an exported URL file, transparently decompressing gzip files."""
+  if IsGzipped(log_file):
+    return gzip.open(log_file, 'rb')
+  return open(log_file, 'r')
+
+
+def CountByteRange(args):
+  """Collect the counters for the lines starting in [start, end) of a file.
+
+  A line belongs to the range its first byte falls into, so that adjacent
+  ranges never count a line twice.  Runs in a worker process.
+  """
+  log_file, start, end, large_threshold, top_servers = args
+  stats = UrlStats(large_threshold, True, top_servers)
+  f = open(log_file, 'rb')
+  try:
+    if start > 0:
+      # skip the end of the line started in the previous range
+      f.seek(start - 1)
+      f.readline()
+    pos = f.tell()
+    while pos < end:
+      line = f.readline()
+      if not line:
+        break
+      pos += len(line)
+      stats.AddLine(line)
+  finally:
+    f.close()
+  return stats
+
+
+def CountLines(args):
+  """Collect the counters for a batch of lines.  Runs in a worker process."""
+  lines, large_threshold, top_servers = args
+  stats = UrlStats(large_threshold, True, top_servers)
+  for line in lines:
+    stats.AddLine(line)
+  return stats
+
+
+def CountParallel(log_file, processes, large_threshold, top_servers):
+  """Split the work on log_file across a pool of worker processes.
+
+  Uncompressed files are cut in byte ranges, one per process, which the
+  workers read on their own.  A gzip stream can not be split, so this
+  process decompresses it and hands out batches of lines, keeping only a
+  few batches in flight to bound the memory used.
+  """
+  pool = multiprocessing.Pool(processes)
+  total = UrlStats(large_threshold, top_servers=top_servers)
+  try:
+    if not IsGzipped(log_file):
+      size = os.path.getsize(log_file)
+      step = size / processes + 1
+      ranges = [(log_file, start, min(start + step, size), large_threshold,
+                 top_servers) for start in xrange(0, size, step)]
+      for stats in pool.imap(CountByteRange, ranges):
+        total.Merge(stats)
+    else:
+      pending = collections.deque()
+      f = gzip.open(log_file, 'rb')
+      try:
+        while True:
+          lines = list(itertools.islice(f, GZIP_BATCH_LINES))
+          if not lines:
+            break
+          pending.append(pool.apply_async(
+              CountLines, [(lines, large_threshold, top_servers)]))
+          if len(pending) >= 2 * processes:
+            total.Merge(pending.popleft().get())
+      finally:
+        f.close()
+      while pending:
+        total.Merge(pending.popleft().get())
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  pool.join()
+  return total
+
+
+def GenReport(log_file, processes=1):
+  """Read each line of the log file and generate reports."""
+  large_threshold = REPORT_CFG['listurlslargerthan']
+  top_servers = REPORT_CFG['topservers']
+  try:
+    if processes > 1:
+      stats = CountParallel(log_file, processes, large_threshold, top_servers)
+    else:
+      stats = UrlStats(large_threshold, top_servers=top_servers)
+      f = OpenUrlFile(log_file)
+      # The url file can be large (>1GB), so we don't want to read
+      # the entire file into memory. We do more I/O and keep memory
+      # footprint small.
+      for line in f:
+        stats.AddLine(line)
+      f.close()
+  except IOError:
+    print 'unable to open file %s' % log_file
+    Usage()
+    sys.exit()
+
+  total_url = stats.total_url
+  states = stats.states
+  servers = stats.servers
+  content_size_map = stats.content_size_map
+  very_large_files = stats.very_large_files
 
   # remove the header
   try:
@@ -227,13 +503,31 @@ def GenReport(log_file):
     PrintSeparatorLine()
 
   # generate a summary of number of URLs per server
-  if REPORT_CFG['reportServer'] or REPORT_CFG['reportAll']:
+  if ((REPORT_CFG['reportServer'] or REPORT_CFG['reportAll']) and
+      not top_servers):
     PrintTwoCol('NUMBER OF URLS', 'SERVERS (total: %i)' % len(servers_sorted))
     PrintTwoCol ('--------------------', '---------------------')
     for (server, count) in servers_sorted:
       PrintTwoCol(str(count).rjust(16), '%s//%s' % server)
     PrintSeparatorLine()
 
+  # approximate number of URLs for the top servers
+  if top_servers and (REPORT_CFG['reportServer'] or REPORT_CFG['reportAll']):
+    sketch = stats.server_sketch
+    PrintTwoCol('NUMBER OF URLS', 'TOP %i SERVERS (lower bound)'
+                % top_servers)
+    PrintTwoCol('--------------------', '---------------------')
+    for (server, count, error) in sketch.Top(top_servers):
+      PrintTwoCol(str(count).rjust(16),
+                  '%s//%s (%i)' % (server + (count - error,)))
+    print ('Counts are upper bounds, the number in parentheses is a lower '
+           'bound.')
+    print ('Tracked %i servers: no count is over by more than %i URLs, and '
+           'servers not listed have at most %i URLs.'
+           % (sketch.capacity, sketch.total / sketch.capacity,
+              sketch.MinCount()))
+    PrintSeparatorLine()
+
   # generate a summary of URL size
   if REPORT_CFG['reportSize'] or REPORT_CFG['reportAll']:
     PrintTwoCol('CONTENT SIZE (UP TO)', 'NUMBER OF URLS')
@@ -247,6 +541,150 @@ def GenReport(log_file):
 # END of GenReport
 
 
+def GetServer(url):
+  """Return the (protocol, host) of a URL, or None if it is malformed."""
+  url_elems = url.split('/', 3)
+  if len(url_elems) < 3:
+    return None
+  return (url_elems[0], url_elems[2])
+
+
+def PartitionUrls(log_file, tmp_dir, prefix, partitions):
+  """Split an export into partitions of "url<TAB>state" lines by URL hash.
+
+  Both exports are split with the same hash, so a URL is always found in
+  partitions with the same number.
+
+  Returns:
+    a dict, the number of URLs per server
+  """
+  servers = dict()
+  outs = [open(os.path.join(tmp_dir, '%s-%04d' % (prefix, i)), 'wb')
+          for i in xrange(partitions)]
+  f = OpenUrlFile(log_file)
+  try:
+    for line in f:
+      fields = line.split('\t', 3)
+      if len(fields) < 3:
+        MyDebug('Encountered a bad line:')
+        MyDebug(line)
+        continue
+      url, state = fields[0], fields[2].strip()
+      if url == 'url' and state == 'state':
+        continue  # the header
+      server = GetServer(url)
+      if server is not None:
+        servers[server] = servers.get(server, 0) + 1
+      outs[zlib.crc32(url) % partitions].write('%s\t%s\n' % (url, state))
+  finally:
+    f.close()
+    for out in outs:
+      out.close()
+  return servers
+
+
+def ReadPartition(path):
+  """Yield (url, state) tuples from a partition written by PartitionUrls."""
+  f = open(path, 'rb')
+  try:
+    for line in f:
+      url, state = line.rstrip('\n').rsplit('\t', 1)
+      yield url, state
+  finally:
+    f.close()
+
+
+def DiffReport(old_file, new_file, partitions):
+  """Compare two exports and report what changed between them.
+
+  The exports are split into hashed partitions on disk, then compared one
+  partition at a time, so the memory used is bounded by the size of one
+  partition of the older export rather than by the number of URLs.
+  """
+  tmp_dir = tempfile.mkdtemp(prefix='urlstats-')
+  try:
+    try:
+      old_servers = PartitionUrls(old_file, tmp_dir, 'old', partitions)
+      new_servers = PartitionUrls(new_file, tmp_dir, 'new', partitions)
+    except IOError, e:
+      print 'unable to open file: %s' % e
+      Usage()
+      sys.exit()
+
+    # key: (old state, new state), value: number of URLs
+    # A new URL has None as old state, a removed URL has None as new state.
+    transitions = dict()
+    added = dict()
+    removed = dict()
+    for i in xrange(partitions):
+      old_states = dict(
+          ReadPartition(os.path.join(tmp_dir, 'old-%04d' % i)))
+      for url, state in ReadPartition(os.path.join(tmp_dir, 'new-%04d' % i)):
+        old_state = old_states.pop(url, None)
+        if old_state is None:
+          server = GetServer(url)
+          added[server] = added.get(server, 0) + 1
+          if REPORT_CFG['listchanges']:
+            print '+\t%s\t%s' % (state, url)
+        elif old_state != state and REPORT_CFG['listchanges']:
+          print '~\t%s -> %s\t%s' % (old_state, state, url)
+        transition = (old_state, state)
+        transitions[transition] = transitions.get(transition, 0) + 1
+      # whatever is left in the old partition is gone from the new export
+      for url, state in old_states.iteritems():
+        server = GetServer(url)
+        removed[server] = removed.get(server, 0) + 1
+        if REPORT_CFG['listchanges']:
+          print '-\t%s\t%s' % (state, url)
+        transition = (state, None)
+        transitions[transition] = transitions.get(transition, 0) + 1
+  finally:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+  PrintSeparatorLine()
+  PrintTwoCol('Total URLs in %s' % old_file, sum(old_servers.itervalues()))
+  PrintTwoCol('Total URLs in %s' % new_file, sum(new_servers.itervalues()))
+  PrintTwoCol('New URLs', sum(added.itervalues()))
+  PrintTwoCol('Removed URLs', sum(removed.itervalues()))
+  PrintSeparatorLine()
+
+  # state transitions, largest first, unchanged states are not shown
+  PrintTwoCol('NUMBER OF URLS', 'STATE TRANSITION')
+  PrintTwoCol('--------------------', '---------------------')
+  transitions_sorted = [(t, count) for (t, count) in transitions.items()
+                        if t[0] != t[1]]
+  transitions_sorted.sort(key=lambda x: (x[1], x[0]), reverse=True)
+  for ((old_state, new_state), count) in transitions_sorted:
+    if old_state is None:
+      old_state = '(new)'
+    if new_state is None:
+      new_state = '(removed)'
+    PrintTwoCol(str(count).rjust(16), '%s -> %s' % (old_state, new_state))
+  PrintSeparatorLine()
+
+  # per server growth, largest change first
+  all_servers = set(old_servers)
+  all_servers.update(new_servers)
+  all_servers.update(s for s in added if s is not None)
+  all_servers.update(s for s in removed if s is not None)
+  growth = [(server,
+             old_servers.get(server, 0),
+             new_servers.get(server, 0),
+             added.get(server, 0),
+             removed.get(server, 0)) for server in all_servers]
+  growth.sort(key=lambda x: (abs(x[2] - x[1]), x[3] + x[4], x[0]),
+              reverse=True)
+  PrintTwoCol('GROWTH (OLD/NEW/+/-)', 'SERVERS (total: %i)' % len(growth))
+  PrintTwoCol('--------------------', '---------------------')
+  for (server, old_count, new_count, n_added, n_removed) in growth:
+    if old_count == new_count and not n_added and not n_removed:
+      continue
+    PrintTwoCol('%+16d' % (new_count - old_count),
+                '%s//%s (%i/%i/+%i/-%i)' % (server + (old_count, new_count,
+                                                       n_added, n_removed)))
+  PrintSeparatorLine()
+
+
 def MyDebug(s):
   if DEBUG_MODE:
     print s
@@ -264,11 +702,13 @@ def PrintTwoCol(col1, col2):
 def Usage():
   """Print the help message."""
   print """
-Usage: urlstats.py [--state|size|listurlslargerthan|debug][FILE]
+Usage: urlstats.py [--state|size|listurlslargerthan|topservers|processes|debug]
+                   [FILE]
+       urlstats.py --diff=OLD_FILE [--listchanges|partitions] [FILE]
 
   Generate a report from FILE, which is the file exported from the
 "Status and Reports > Export All URLs" page in the Admin Console
-on a Google Search Appliance.
+on a Google Search Appliance.  FILE can be gzip compressed.
 
 Examples:
 
@@ -288,6 +728,23 @@ Examples:
 4. Only print a report about URL state
 
    urlstats.py --state
+
+5. To read a gzipped export using 8 worker processes
+
+   urlstats.py --processes=8 all_urls.gz
+
+6. To compare two exports: growth per server, state transitions, and the
+   number of new and removed URLs.  --listchanges also lists the URLs,
+   --partitions sets the number of temporary files the exports are split
+   into, raise it to lower the memory used on very large exports.
+
+   urlstats.py --diff=all_urls_last_week.gz --listchanges all_urls.gz
+
+7. To list the 100 servers with the most URLs in a fixed amount of memory,
+   when the export has too many distinct servers to count them all.  The
+   counts are approximate, the report shows how far off they can be.
+
+   urlstats.py --topservers=100
   """
 
 